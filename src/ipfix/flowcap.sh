@@ -37,6 +37,12 @@ export SILK_LIBFIXBUF_SUPPRESS_WARNINGS="1"
 # Update the firewall rules
 /usr/bin/python3 /opt/obsrvbl-ona/ona_service/flowcap_config.py -f
 
+# Use the built-in collector instead of SiLK if requested
+if [ "$OBSRVBL_IPFIX_NATIVE_COLLECTOR" = "true" ]
+then
+    exec /usr/bin/python3 /opt/obsrvbl-ona/ona_service/flow_collector.py
+fi
+
 exec /opt/silk/sbin/flowcap \
     --destination-directory="$OBSRVBL_IPFIX_LOGDIR" \
     --sensor-configuration="$OBSRVBL_IPFIX_CONF" \
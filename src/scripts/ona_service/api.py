@@ -67,6 +67,35 @@ retry_kwargs = {
 }
 
 
+class SizedStream:
+    """
+    An upload body made of the chunks of bytes from `get_data()`, whose
+    total is `length`. Since its length is known, requests sends it with a
+    Content-Length header rather than with chunked transfer encoding.
+    """
+    def __init__(self, get_data, length):
+        self.chunks = iter(get_data())
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Generators are closed in case the upload stopped partway through
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
 class Api:
     """
     Handles communications with Observable Networks.
@@ -95,16 +124,9 @@ class Api:
         else:
             self.sensor_ext_only = False
 
-    @retry(**retry_kwargs)
-    def send_file(self, data_type, path, now, prefix=None, suffix=None):
-        """
-        Send a file to the ON service.
-
-        Args:
-            data_type: type of data that is being sent.
-            path: local file path.
-            now: the time period that corresponds to the file.
-        """
+    def _upload(self, data_type, open_data, now, prefix=None, suffix=None):
+        # Gets a signed upload URL, then sends the body returned by
+        # `open_data()` (a context manager) to it
         name_parts = [prefix, self.ona_name, suffix]
         name = '_'.join(part for part in name_parts if part)
         url = '{server}/sign/{type}/{year}/{month}/{day}/{time}/{name}'
@@ -134,7 +156,7 @@ class Api:
                 'Parameters missing from response'
             )
 
-        with open(path, mode='rb') as data:
+        with open_data() as data:
             logging.info('Sending file: {} {}'.format(method, url))
             resp = requests.request(
                 method,
@@ -152,6 +174,47 @@ class Api:
         resp.raise_for_status()
         return remote_path
 
+    @retry(**retry_kwargs)
+    def send_file(self, data_type, path, now, prefix=None, suffix=None):
+        """
+        Send a file to the ON service.
+
+        Args:
+            data_type: type of data that is being sent.
+            path: local file path.
+            now: the time period that corresponds to the file.
+        """
+        return self._upload(
+            data_type, lambda: open(path, mode='rb'), now, prefix, suffix
+        )
+
+    def send_stream(self, data_type, get_data, now, prefix=None, suffix=None):
+        """
+        Send generated data to the ON service, without storing it first.
+        Signed upload URLs need to know the data's length, so it's generated
+        once to measure it, and then again for each attempt to send it.
+
+        Args:
+            data_type: type of data that is being sent.
+            get_data: a callable that returns an iterable of bytes. It must
+                give the same data each time it's called.
+            now: the time period that corresponds to the data.
+        """
+        length = sum(len(chunk) for chunk in get_data())
+        return self._send_sized(
+            data_type, get_data, length, now, prefix, suffix
+        )
+
+    @retry(**retry_kwargs)
+    def _send_sized(self, data_type, get_data, length, now, prefix, suffix):
+        return self._upload(
+            data_type,
+            lambda: SizedStream(get_data, length),
+            now,
+            prefix,
+            suffix,
+        )
+
     @retry(**retry_kwargs)
     def send_signal(self, data_type, data=None):
         """
@@ -0,0 +1,367 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks for the stages of the IPFIXPusher pipeline, using synthetic
+flows. Run with:
+    python3 -m ona_service.benchmarks.ipfix --rows 1000000 --output new.json
+
+The *_native stages time the in-process code paths on their own. The
+create_archives stage times the pusher's whole pass over a bin of files
+from the built-in collector: filtering, aggregating, writing CSV and
+archiving. Files from flowcap are handled by rwfilter and rwuniq, which
+need the SiLK tools and aren't covered here.
+"""
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from gzip import open as gz_open
+from os.path import join
+from random import Random
+from tempfile import TemporaryDirectory
+
+from ona_service.flow_collector import (
+    FILE_FMT,
+    NATIVE_FIELDS,
+    NATIVE_SUFFIX,
+)
+from ona_service.flow_filter import FlowFilter
+from ona_service.ipfix_pusher import (
+    CSV_HEADER,
+    get_source_quirks,
+    IPFIXPusher,
+)
+from ona_service.benchmarks.runner import (
+    measure,
+    print_results,
+    save_results,
+)
+from ona_service.utils import timestamp
+
+SOURCES = [None, 'asa', 'meraki', 'sonicwall']
+BIN_START = datetime(2017, 7, 14, 2, 40)
+BIN_SECONDS = 600
+FILES_PER_BIN = 10
+MONITOR_NETS = ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+
+# (port, protocol, weight)
+SERVICES = [
+    (443, 6, 50),
+    (80, 6, 15),
+    (53, 17, 15),
+    (123, 17, 3),
+    (22, 6, 3),
+    (445, 6, 3),
+    (3389, 6, 2),
+    (8080, 6, 2),
+    (0, 1, 3),
+    (5060, 17, 2),
+    (25, 6, 2),
+]
+
+
+class FlowGenerator:
+    """
+    Produces reproducible synthetic flows, as dictionaries with the same keys
+    and string values as the pusher reads from its input files.
+
+    Host popularity follows a power law, so a few talkers dominate, and
+    about 20% of flows don't touch a monitored network.
+    """
+    def __init__(self, seed=0, source=None):
+        self.rng = Random(seed)
+        self.source = source
+        self.internal = [
+            '10.{}.{}.{}'.format(
+                self.rng.randint(0, 3), self.rng.randint(0, 255), i % 254 + 1
+            )
+            for i in range(2000)
+        ]
+        self.external = [
+            '{}.{}.{}.{}'.format(
+                self.rng.choice([23, 52, 104, 151, 198, 203]),
+                self.rng.randint(0, 255),
+                self.rng.randint(0, 255),
+                self.rng.randint(1, 254),
+            )
+            for __ in range(20000)
+        ]
+        self.services = [(p, proto) for p, proto, __ in SERVICES]
+        self.weights = [w for __, __, w in SERVICES]
+
+    def _pick(self, pool):
+        # Power-law choice: low indexes are picked much more often
+        i = int(self.rng.paretovariate(1.2)) - 1
+        return pool[i % len(pool)]
+
+    def conversation(self):
+        port, protocol = self.rng.choices(self.services, self.weights)[0]
+        client = self._pick(self.internal)
+        if self.rng.random() < 0.2:
+            client = self._pick(self.external)
+        server = self._pick(self.external)
+        client_port = self.rng.randint(32768, 60999) if protocol != 1 else 0
+        return [client, server, client_port, port, protocol]
+
+    def _counts(self):
+        bytes_ = int(self.rng.lognormvariate(7, 2)) + 40
+        packets = max(1, bytes_ // self.rng.randint(60, 1500))
+        return bytes_, packets
+
+    def _times(self):
+        start = timestamp(BIN_START) + self.rng.randrange(BIN_SECONDS)
+        end = start + int(self.rng.expovariate(1 / 30))
+        if self.source == 'sonicwall' and self.rng.random() < 0.5:
+            # SonicWALL timestamps can't be trusted
+            start = end = self.rng.randint(0, 2 ** 32 - 1)
+        return start, end
+
+    def _row(self, five_tuple, bytes_, packets):
+        start, end = self._times()
+        values = five_tuple + [
+            bytes_,
+            packets,
+            start,
+            end,
+            self.rng.randint(1, 8),
+            self.rng.randint(1, 8),
+        ]
+        return dict(zip(NATIVE_FIELDS, (str(x) for x in values)))
+
+    def _meraki_rows(self, five_tuple):
+        # Cumulative counters that occasionally reset
+        bytes_ = packets = 0
+        for __ in range(self.rng.randint(1, 6)):
+            if self.rng.random() < 0.2:
+                bytes_ = packets = 0
+            delta_bytes, delta_packets = self._counts()
+            bytes_ += delta_bytes
+            packets += delta_packets
+            yield self._row(five_tuple, bytes_, packets)
+
+    def _rows_for(self, five_tuple):
+        if self.source == 'meraki':
+            yield from self._meraki_rows(five_tuple)
+            return
+
+        yield self._row(five_tuple, *self._counts())
+        if self.source == 'asa' and self.rng.random() < 0.1:
+            # The ASA reports some reverse flows with protocol 0
+            src, dst, sport, dport, __ = five_tuple
+            yield self._row([dst, src, dport, sport, 0], *self._counts())
+
+    def generate(self, count):
+        """
+        Returns a list of `count` flows. Conversations repeat, so the same
+        5-tuple shows up many times.
+        """
+        conversations = [self.conversation() for __ in range(count // 4 + 1)]
+        ret = []
+        while len(ret) < count:
+            ret.extend(self._rows_for(self._pick(conversations)))
+        return ret[:count]
+
+
+def generate_flows(count, seed=0, source=None):
+    return FlowGenerator(seed, source).generate(count)
+
+
+def _setup(count, seed, source):
+    temp_dir = TemporaryDirectory()
+    pusher = IPFIXPusher(input_dir=temp_dir.name)
+    pusher.flow_filter = FlowFilter(MONITOR_NETS)
+    rows = generate_flows(count, seed, source)
+    return {'temp_dir': temp_dir, 'pusher': pusher, 'rows': rows}
+
+
+def _teardown(state):
+    state['temp_dir'].cleanup()
+
+
+def _run_filter(state):
+    rows = state['rows']
+    for __ in state['pusher'].flow_filter.filter(rows):
+        pass
+    return len(rows)
+
+
+def _run_aggregate(state):
+    rows = state['rows']
+    for __ in state['pusher']._aggregate_native(iter(rows)):
+        pass
+    return len(rows)
+
+
+def _setup_quirks(count, seed, source):
+    state = _setup(count, seed, source)
+    state['quirks'] = get_source_quirks(source)
+    return state
+
+
+def _run_quirks(state):
+    rows = (r.copy() for r in state['rows'])
+    ts_received = timestamp(BIN_START)
+    for __ in state['pusher']._apply_quirks(
+        rows, state['quirks'], ts_received
+    ):
+        pass
+    return len(state['rows'])
+
+
+def _write_text(rows, file_path):
+    fieldnames = CSV_HEADER.split(',')
+    with open(file_path, 'wt') as outfile:
+        for row in rows:
+            print(','.join(row[x] for x in fieldnames), file=outfile)
+
+
+def _setup_csv_gzip(count, seed, source):
+    state = _setup(count, seed, source)
+    file_name = '{}_S1.tmp'.format(BIN_START.strftime('%Y%m%d%H%M%S'))
+    state['input_path'] = join(state['temp_dir'].name, file_name)
+    state['output_path'] = join(state['temp_dir'].name, 'output.csv.gz')
+    _write_text(state['rows'], state['input_path'])
+    return state
+
+
+def _run_csv_gzip(state):
+    state['pusher']._silk_to_csv(
+        state['input_path'], state['output_path'], {}
+    )
+    return len(state['rows'])
+
+
+def _setup_tar(count, seed, source):
+    state = _setup(count, seed, source)
+    rows = state['rows']
+    fieldnames = CSV_HEADER.split(',')
+    state['file_list'] = []
+    for i in range(FILES_PER_BIN):
+        file_path = join(
+            state['temp_dir'].name, '{}_S1.{:06}'.format(
+                BIN_START.strftime('%Y%m%d%H%M%S'), i
+            )
+        )
+        with gz_open(file_path, 'wt') as outfile:
+            for row in rows[i::FILES_PER_BIN]:
+                print(','.join(row[x] for x in fieldnames), file=outfile)
+        state['file_list'].append(file_path)
+    state['archive_path'] = join(state['temp_dir'].name, 'archive.tar')
+    return state
+
+
+def _run_tar(state):
+    state['pusher']._archive_files(state['file_list'], state['archive_path'])
+    return len(state['rows'])
+
+
+def _setup_create_archives(count, seed, source):
+    # Writes the bin's flows to files like the built-in collector's, plus an
+    # empty later bin so the pusher considers the first one complete.
+    state = _setup(count, seed, source)
+    rows = state['rows']
+    file_list = []
+    for i in range(FILES_PER_BIN):
+        file_path = join(
+            state['temp_dir'].name, '{}_S1.{:06}{}'.format(
+                BIN_START.strftime(FILE_FMT), i, NATIVE_SUFFIX
+            )
+        )
+        with open(file_path, 'wt') as outfile:
+            for row in rows[i::FILES_PER_BIN]:
+                print(','.join(row[x] for x in NATIVE_FIELDS), file=outfile)
+        file_list.append(file_path)
+
+    state['pusher'].output_dir = join(state['temp_dir'].name, 'output')
+    state['D_archive'] = {
+        BIN_START: file_list,
+        BIN_START + timedelta(seconds=BIN_SECONDS): [],
+    }
+    return state
+
+
+def _run_create_archives(state):
+    state['pusher']._create_archives(state['D_archive'])
+    return len(state['rows'])
+
+
+STAGES = {
+    'filter_native': (_setup, _run_filter),
+    'aggregate_native': (_setup, _run_aggregate),
+    'quirks': (_setup_quirks, _run_quirks),
+    'csv_gzip': (_setup_csv_gzip, _run_csv_gzip),
+    'archive_files': (_setup_tar, _run_tar),
+    'create_archives': (_setup_create_archives, _run_create_archives),
+}
+
+
+def run_benchmarks(count, seed=0, source=None, stages=None, isolate=True):
+    """
+    Runs the requested `stages` (by default, all of them) over `count`
+    synthetic flows and returns a results dictionary. The quirks stage needs
+    a `source`; without one it's left out by default, and ValueError is
+    raised if it's requested.
+    """
+    if stages is None:
+        stages = [x for x in STAGES if source or (x != 'quirks')]
+    if (source is None) and ('quirks' in stages):
+        raise ValueError('The quirks stage needs a source')
+
+    results = {
+        'suite': 'ipfix',
+        'rows': count,
+        'seed': seed,
+        'source': source,
+        'stages': {},
+    }
+    for stage in stages:
+        setup, run = STAGES[stage]
+        results['stages'][stage] = measure(
+            setup,
+            run,
+            args=(count, seed, source),
+            teardown=_teardown,
+            isolate=isolate,
+        )
+
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark the IPFIX pipeline')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--source',
+        choices=[x for x in SOURCES if x],
+        help='Generate quirky traffic for this type of exporter',
+    )
+    parser.add_argument(
+        '--stages',
+        help='Comma-separated stages to run (default: all that apply)',
+    )
+    parser.add_argument('--output', help='Save the results to this file')
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(',') if args.stages else None
+    results = run_benchmarks(args.rows, args.seed, args.source, stages)
+    print_results(results)
+    if args.output:
+        save_results(results, args.output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks for the log watcher's upload compression. Uses synthetic auth
+log lines, or the lines of a real log given with --input. Run with:
+    python3 -m ona_service.benchmarks.logs --input /var/log/auth.log
+"""
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from gzip import compress as gz_compress
+from io import BytesIO
+from itertools import cycle, islice
+from random import Random
+
+from ona_service.benchmarks.runner import (
+    measure,
+    print_results,
+    save_results,
+)
+from ona_service.log_watcher import (
+    DEFAULT_LOG_WATCHER_COMPRESS_LEVEL,
+    write_compressed,
+)
+
+LOG_START = datetime(2017, 7, 14, 2, 40)
+KEY_CHARS = 'ABCDEFabcdef0123456789'
+USERS = ['root', 'admin', 'ubuntu', 'deploy', 'backup', 'test', 'oracle']
+TEMPLATES = [
+    (
+        'sshd[{pid}]: Accepted publickey for {user} from {addr} port {port} '
+        'ssh2: RSA SHA256:{key}'
+    ),
+    'sshd[{pid}]: Failed password for invalid user {user} from {addr} '
+    'port {port} ssh2',
+    'sshd[{pid}]: Connection closed by {addr} port {port} [preauth]',
+    'sshd[{pid}]: pam_unix(sshd:session): session opened for user {user} '
+    'by (uid=0)',
+    'sudo: {user} : TTY=pts/0 ; PWD=/home/{user} ; USER=root ; '
+    'COMMAND=/usr/bin/systemctl restart nginx',
+    'CRON[{pid}]: pam_unix(cron:session): session closed for user root',
+]
+
+
+def generate_auth_lines(count, seed=0):
+    """
+    Returns a list of `count` reproducible auth.log-style lines, as bytes.
+    """
+    rng = Random(seed)
+    ret = []
+    dt = LOG_START
+    for __ in range(count):
+        dt += timedelta(seconds=rng.randint(0, 5))
+        template = rng.choice(TEMPLATES)
+        message = template.format(
+            pid=rng.randint(1000, 40000),
+            user=rng.choice(USERS),
+            addr='203.0.113.{}'.format(rng.randint(1, 254)),
+            port=rng.randint(32768, 60999),
+            key=''.join(rng.choice(KEY_CHARS) for __ in range(8)),
+        )
+        line = '{} ona-host {}\n'.format(
+            dt.strftime('%b %d %H:%M:%S'), message
+        )
+        ret.append(line.encode('utf-8'))
+
+    return ret
+
+
+def read_lines(file_path, count):
+    """
+    Returns `count` lines from the file at `file_path`, repeating it if it's
+    too short.
+    """
+    with open(file_path, 'rb') as infile:
+        lines = infile.readlines()
+    return list(islice(cycle(lines), count))
+
+
+def _compress_per_line(lines, compresslevel):
+    # The previous behavior: one gzip member per line
+    return b''.join(gz_compress(x, compresslevel) for x in lines)
+
+
+def _compress_streaming(lines, compresslevel):
+    fileobj = BytesIO()
+    write_compressed(lines, fileobj, compresslevel)
+    return fileobj.getvalue()
+
+
+STAGES = {
+    'per_line': _compress_per_line,
+    'streaming': _compress_streaming,
+}
+
+
+def _setup(lines, stage, compresslevel):
+    return {'lines': lines, 'stage': stage, 'compresslevel': compresslevel}
+
+
+def _run(state):
+    STAGES[state['stage']](state['lines'], state['compresslevel'])
+    return len(state['lines'])
+
+
+def run_benchmarks(lines, compresslevel=None, stages=None, isolate=True):
+    """
+    Compresses `lines` with each of the requested `stages` (by default, all
+    of them) and returns a results dictionary. Each stage also records its
+    input and output sizes.
+    """
+    if compresslevel is None:
+        compresslevel = int(DEFAULT_LOG_WATCHER_COMPRESS_LEVEL)
+    stages = list(STAGES) if stages is None else stages
+    results = {
+        'suite': 'logs',
+        'rows': len(lines),
+        'compresslevel': compresslevel,
+        'stages': {},
+    }
+    raw_bytes = sum(len(x) for x in lines)
+    for stage in stages:
+        values = measure(
+            _setup,
+            _run,
+            args=(lines, stage, compresslevel),
+            isolate=isolate,
+        )
+        values['raw_bytes'] = raw_bytes
+        values['compressed_bytes'] = len(
+            STAGES[stage](lines, compresslevel)
+        )
+        results['stages'][stage] = values
+
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark log upload compression')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--input', help='Use the lines from this log file')
+    parser.add_argument('--compresslevel', type=int)
+    parser.add_argument(
+        '--stages',
+        default=','.join(STAGES),
+        help='Comma-separated stages to run',
+    )
+    parser.add_argument('--output', help='Save the results to this file')
+    args = parser.parse_args(argv)
+
+    if args.input:
+        lines = read_lines(args.input, args.rows)
+    else:
+        lines = generate_auth_lines(args.rows, args.seed)
+
+    results = run_benchmarks(
+        lines, args.compresslevel, args.stages.split(',')
+    )
+    print_results(results)
+    for stage, values in results['stages'].items():
+        print(
+            '{}: {} bytes -> {} bytes ({:.1f}x)'.format(
+                stage,
+                values['raw_bytes'],
+                values['compressed_bytes'],
+                values['raw_bytes'] / values['compressed_bytes'],
+            )
+        )
+    if args.output:
+        save_results(results, args.output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shared helpers for the benchmark suites in this package: running a stage
+in its own process to measure its throughput and peak RSS, saving results,
+and comparing two sets of results.
+
+Compare two runs with:
+    python3 -m ona_service.benchmarks.runner old.json new.json
+"""
+import json
+import multiprocessing
+import resource
+import sys
+
+from argparse import ArgumentParser
+from queue import Empty
+from time import perf_counter
+
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_TIMEOUT = 3600
+POLL_SECONDS = 1
+
+
+def _run_stage(setup, run, args, teardown=None, queue=None):
+    # Prepares the stage's input, then times the run. Returns a dictionary
+    # of measurements (or puts it on `queue` when called in a child).
+    state = setup(*args)
+    start = perf_counter()
+    rows = run(state)
+    seconds = perf_counter() - start
+    if teardown is not None:
+        teardown(state)
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ret = {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else 0.0,
+        'peak_rss_kb': peak_rss_kb,
+    }
+    if queue is not None:
+        queue.put(ret)
+    return ret
+
+
+def _wait_for_result(process, queue, timeout):
+    # Polls for the child's result, giving up if it exits without one (e.g.
+    # it crashed or was OOM-killed) or takes longer than `timeout` seconds.
+    # Liveness is checked before reading so a result that was sent just
+    # before the child exited isn't missed.
+    deadline = perf_counter() + timeout
+    while True:
+        is_alive = process.is_alive()
+        try:
+            return queue.get(timeout=POLL_SECONDS)
+        except Empty:
+            pass
+
+        if not is_alive:
+            raise RuntimeError(
+                'Stage exited with code {}'.format(process.exitcode)
+            )
+        if perf_counter() > deadline:
+            process.terminate()
+            process.join()
+            raise RuntimeError('Stage timed out after {}s'.format(timeout))
+
+
+def measure(
+    setup, run, args=(), teardown=None, isolate=True, timeout=DEFAULT_TIMEOUT
+):
+    """
+    Calls `setup(*args)` and then times `run(state)` with the result. `run`
+    should return the number of rows it processed. `teardown(state)` is
+    called afterward, if given.
+
+    With `isolate`, the stage runs in a forked child so that its peak RSS
+    isn't affected by earlier stages. The peak includes the stage's input.
+    RuntimeError is raised if the child fails or runs for more than
+    `timeout` seconds.
+    """
+    if not isolate:
+        return _run_stage(setup, run, args, teardown)
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(
+        target=_run_stage, args=(setup, run, args, teardown, queue)
+    )
+    process.start()
+    ret = _wait_for_result(process, queue, timeout)
+    process.join()
+    if process.exitcode:
+        raise RuntimeError(
+            'Stage exited with code {}'.format(process.exitcode)
+        )
+    return ret
+
+
+def save_results(results, file_path):
+    with open(file_path, 'wt') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+
+
+def load_results(file_path):
+    with open(file_path, 'rt') as infile:
+        return json.load(infile)
+
+
+def compare_results(old, new, threshold=DEFAULT_THRESHOLD):
+    """
+    Given two result dictionaries from the same suite, return a list of
+    (stage, metric, old value, new value) for each regression: throughput
+    that fell, or peak RSS that rose, by more than `threshold` (a fraction).
+    ValueError is raised if the runs' settings (e.g. the suite, row count,
+    seed, or source) differ, since their numbers aren't comparable.
+    """
+    for key in sorted((set(old) | set(new)) - {'stages'}):
+        if old.get(key) != new.get(key):
+            raise ValueError(
+                'Runs differ in {}: {!r} vs. {!r}'.format(
+                    key, old.get(key), new.get(key)
+                )
+            )
+
+    regressions = []
+    old_stages = old.get('stages', {})
+    new_stages = new.get('stages', {})
+    for stage in sorted(set(old_stages) & set(new_stages)):
+        old_stage, new_stage = old_stages[stage], new_stages[stage]
+
+        old_rate = old_stage['rows_per_sec']
+        new_rate = new_stage['rows_per_sec']
+        if new_rate < old_rate * (1 - threshold):
+            regressions.append((stage, 'rows_per_sec', old_rate, new_rate))
+
+        old_rss = old_stage['peak_rss_kb']
+        new_rss = new_stage['peak_rss_kb']
+        if new_rss > old_rss * (1 + threshold):
+            regressions.append((stage, 'peak_rss_kb', old_rss, new_rss))
+
+    return regressions
+
+
+def print_results(results, file=sys.stdout):
+    print(
+        '{:<20}{:>12}{:>12}{:>16}{:>14}'.format(
+            'stage', 'rows', 'seconds', 'rows/s', 'peak RSS KiB'
+        ),
+        file=file,
+    )
+    for stage, values in results['stages'].items():
+        print(
+            '{:<20}{:>12}{:>12.3f}{:>16.0f}{:>14}'.format(
+                stage,
+                values['rows'],
+                values['seconds'],
+                values['rows_per_sec'],
+                values['peak_rss_kb'],
+            ),
+            file=file,
+        )
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Compare two benchmark runs and flag regressions'
+    )
+    parser.add_argument('old', help='Results file for the baseline run')
+    parser.add_argument('new', help='Results file for the candidate run')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='Allowed fractional change before flagging (default: 0.1)',
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        regressions = compare_results(
+            load_results(args.old), load_results(args.new), args.threshold
+        )
+    except ValueError as e:
+        print('Cannot compare: {}'.format(e))
+        return 2
+
+    for stage, metric, old_value, new_value in regressions:
+        print(
+            'REGRESSION {} {}: {:.1f} -> {:.1f}'.format(
+                stage, metric, old_value, new_value
+            )
+        )
+    if not regressions:
+        print('No regressions')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,366 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks for parsing the remote Active Directory log, using synthetic
+events in both of the formats that rsyslog writes. Run with:
+    python3 -m ona_service.benchmarks.syslog_ad --rows 100000
+
+The sharded-N stages parse with N worker processes, to show how parsing
+scales with OBSRVBL_SYSLOG_AD_WORKERS.
+"""
+import sys
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from random import Random
+
+from ona_service.benchmarks.runner import (
+    measure,
+    print_results,
+    save_results,
+)
+from ona_service.syslog_ad_watcher import (
+    ADEventParser,
+    CP1252_UNDEFINED,
+    DEFAULT_ENCODING,
+    format_events,
+    get_interesting_events,
+    LOGON_EVENT_CODE,
+    ShardedADEventParser,
+)
+
+LOG_START = datetime(2016, 5, 21, 6, 49)
+# (event code, weight)
+EVENT_CODES = [('4624', 70), ('4634', 15), ('4672', 10), ('4768', 5)]
+SYSTEM_SIDS = ['S-1-0-0', 'S-1-5-7', 'S-1-5-18']
+# Lines per batch for the formatted stages, like the log node's reads
+BATCH_LINES = 100000
+SHARDED_PREFIX = 'sharded-'
+MULTILINE_TEMPLATE = (
+    'obsrvbl_remote-ad|{date}| {syslog_date}\t{event_code}\t'
+    'Microsoft-Windows-Security-Auditing\t\tN/A\tAudit Success\t'
+    'DC1.example.local\t12544\tAn account was successfully logged on.\n'
+    'Subject:\n'
+    '\tSecurity ID:\t\tS-1-0-0\n'
+    '\tAccount Name:\t\t-\n'
+    '\tAccount Domain:\t\t-\n'
+    '\tLogon ID:\t\t0x0\n'
+    'Logon Type:\t\t\t3\n'
+    'Impersonation Level:\t\tImpersonation\n'
+    'New Logon:\n'
+    '\tSecurity ID:\t\t{sid}\n'
+    '\tAccount Name:\t\t{user}\n'
+    '\tAccount Domain:\t\tEXAMPLE\n'
+    '\tLogon ID:\t\t0x3E4614B3\n'
+    '\tLogon GUID:\t\t{{58534C60-0A0A-7CF7-F596-D9959A706044}}\n'
+    'Process Information:\n'
+    '\tProcess ID:\t\t0x0\n'
+    '\tProcess Name:\t\t-\n'
+    'Network Information:\n'
+    '\tWorkstation Name:\t{computer}\n'
+    '\tSource Network Address:\t{addr}\n'
+    '\tSource Port:\t\t{port}\n'
+    'Detailed Authentication Information:\n'
+    '\tLogon Process:\t\tKerberos\n'
+    '\tAuthentication Package:\tKerberos\n'
+    '\tTransited Services:\t-\n'
+    '\tPackage Name (NTLM only):\t-\n'
+    '\tKey Length:\t\t0\n'
+    'This event is generated when a logon session is created.\n'
+)
+ONELINE_TEMPLATE = (
+    'obsrvbl_remote-ad_oneline|{date}| {syslog_date},{event_code},'
+    'Microsoft-Windows-Security-Auditing,EXAMPLE\\{user},N/A,Success Audit,'
+    'DC2.example.local,Logon,,An account was successfully logged on.    '
+    'Subject:   Security ID:  S-1-0-0   Account Name:  -   '
+    'Account Domain:  -   Logon ID:  0x0    Logon Type:   3    '
+    'Impersonation Level:  Delegation    New Logon:   '
+    'Security ID:  {sid}   Account Name:  {user}   Account Domain:  EXAMPLE   '
+    'Network Information:   Workstation Name:  {computer}   '
+    'Source Network Address: {addr}   Source Port:  {port}    '
+    '<truncated 2791 bytes>,1045983 \n'
+)
+
+
+def generate_ad_lines(count, seed=0, oneline_share=0.5):
+    """
+    Returns the lines (as cp1252 bytes) of `count` reproducible events.
+    About `oneline_share` of them are in the one-line format, and the rest
+    are multi-line. Each multi-line event is only complete once the next one
+    starts.
+    """
+    rng = Random(seed)
+    codes = [x for x, __ in EVENT_CODES]
+    weights = [w for __, w in EVENT_CODES]
+    ret = []
+    dt = LOG_START
+    for __ in range(count):
+        dt += timedelta(seconds=rng.randint(0, 1))
+        is_system = rng.random() < 0.1
+        user = 'user{}'.format(rng.randint(1, 500))
+        if rng.random() < 0.1:
+            user = 'HOST{}$'.format(rng.randint(1, 50))
+        if rng.random() < 0.05:
+            user = 'usér{}'.format(rng.randint(1, 50))
+        addr = '10.0.{}.{}'.format(rng.randint(0, 3), rng.randint(1, 254))
+        if rng.random() < 0.05:
+            addr = rng.choice(['-', '::1', 'fe80::1'])
+        values = {
+            'date': dt.strftime('%Y-%m-%d %H:%M'),
+            'syslog_date': dt.strftime('%b %d %H:%M:%S %Y'),
+            'event_code': rng.choices(codes, weights)[0],
+            'sid': (
+                rng.choice(SYSTEM_SIDS) if is_system else
+                'S-1-5-21-1979579619-958697405-47085797-{}'.format(
+                    rng.randint(1000, 9999)
+                )
+            ),
+            'user': user,
+            'computer': 'WK{}'.format(rng.randint(1, 300)),
+            'addr': addr,
+            'port': rng.randint(1024, 65535),
+        }
+        if rng.random() < oneline_share:
+            text = ONELINE_TEMPLATE.format(**values)
+        else:
+            text = MULTILINE_TEMPLATE.format(**values)
+        ret.extend(text.encode(DEFAULT_ENCODING).splitlines(keepends=True))
+
+    return ret
+
+
+def process_multiline(entry):
+    """
+    The old parser for a decoded multi-line entry, which returns a dictionary
+    with all of its sections. This is the reference for parse_multiline.
+    """
+    D = {}
+    __, date_str, summary = entry[0].split('|', 2)
+    summary_fields = summary.split('\t')
+    D['Received time'] = date_str
+    D['Event Code'] = summary_fields[1]
+
+    lines = (x for x in entry[1:] if x)
+    for line in lines:
+        fields = [x for x in line.split('\t')]
+        collapsed_fields = [x for x in fields if x]
+        if fields[0].endswith(':') and len(collapsed_fields) == 1:
+            section = collapsed_fields[0].rstrip(':')
+            D[section] = {}
+        elif fields[0] and len(collapsed_fields) == 2:
+            key = collapsed_fields[0].rstrip(':')
+            value = collapsed_fields[1]
+            D[key] = value
+        elif not fields[0] and len(collapsed_fields) == 2:
+            key = collapsed_fields[0].rstrip(':')
+            value = collapsed_fields[1]
+            D[section][key] = value
+        else:
+            continue
+    return D
+
+
+def process_oneline(entry):
+    """
+    The old parser for a decoded one-line entry. This is the reference for
+    parse_oneline.
+    """
+    __, date_str, rest = entry.split('|', 2)
+    fields = rest.split(',')
+    event_code = fields[1].strip()
+    D = {
+        'Security ID': None,
+        'Account Name': None,
+        'Workstation Name': None,
+        'Source Network Address': None,
+        'Event Code': event_code,
+        'Received time': date_str,
+    }
+    data = fields[-2]
+    for item in data.split('   '):
+        item = item.strip().split(':', 1)
+        if len(item) != 2:
+            continue
+        key, value = [x.strip() for x in item]
+        if (key not in D) or (not value):
+            continue
+        D[key] = value
+
+    return D
+
+
+def parse_legacy(lines, encoding=DEFAULT_ENCODING, errors='ignore'):
+    """
+    Parses `lines` the way RemoteADLogNode used to: a round trip through
+    the encoding, then decoding and splitting every line.
+    """
+    ret = []
+    entry = []
+    is_complete = False
+    lines = [x.decode(encoding, errors).encode(encoding) for x in lines]
+    for line in lines:
+        line = line.decode(encoding, errors=errors)
+        if line.startswith('obsrvbl_remote-ad_oneline|'):
+            ret.append(process_oneline(line))
+            continue
+
+        if not line.startswith('obsrvbl_remote-ad|'):
+            entry.append(line.rstrip())
+            continue
+
+        if is_complete:
+            ret.append(process_multiline(entry))
+        entry = [line.rstrip()]
+        is_complete = True
+
+    return ret
+
+
+def parse_compiled(lines, encoding=DEFAULT_ENCODING, event_codes=None):
+    """
+    Parses `lines` the way RemoteADLogNode does now.
+    """
+    lines = [x.translate(None, CP1252_UNDEFINED) for x in lines]
+    return list(ADEventParser(encoding, event_codes).parse(lines))
+
+
+def parse_logons(lines):
+    """
+    Parses `lines` the way SyslogADWatcher does, skipping events other than
+    logons.
+    """
+    return parse_compiled(lines, event_codes={LOGON_EVENT_CODE})
+
+
+def _batches(lines, batch_lines):
+    lines = [x.translate(None, CP1252_UNDEFINED) for x in lines]
+    return [
+        lines[i:i + batch_lines] for i in range(0, len(lines), batch_lines)
+    ]
+
+
+def parse_formatted(lines, batch_lines=BATCH_LINES):
+    """
+    Parses `lines` into output rows in batches, the way SyslogADWatcher
+    does with one process.
+    """
+    parser = ADEventParser(event_codes={LOGON_EVENT_CODE})
+    ret = []
+    for batch in _batches(lines, batch_lines):
+        events = get_interesting_events(parser.parse(batch))
+        ret.extend(format_events(events, 0, ''))
+    return ret
+
+
+def parse_sharded(lines, workers, batch_lines=BATCH_LINES):
+    """
+    Parses `lines` into output rows in batches, the way SyslogADWatcher
+    does with `workers` processes.
+    """
+    parser = ShardedADEventParser(
+        ADEventParser(event_codes={LOGON_EVENT_CODE}), workers
+    )
+    ret = []
+    try:
+        for batch in _batches(lines, batch_lines):
+            ret.extend(parser.parse(batch, 0, ''))
+    finally:
+        parser.close()
+    return ret
+
+
+STAGES = {
+    'legacy': parse_legacy,
+    'compiled': parse_compiled,
+    'logons': parse_logons,
+    'formatted': parse_formatted,
+}
+
+
+def _get_stage(stage):
+    if stage.startswith(SHARDED_PREFIX):
+        workers = int(stage[len(SHARDED_PREFIX):])
+        return lambda lines: parse_sharded(lines, workers)
+    return STAGES[stage]
+
+
+def _setup(lines, stage):
+    return {'lines': lines, 'stage': stage}
+
+
+def _run(state):
+    return len(_get_stage(state['stage'])(state['lines']))
+
+
+def run_benchmarks(lines, stages=None, isolate=True):
+    """
+    Parses `lines` with each of the requested `stages` (by default, all of
+    the STAGES) and returns a results dictionary. Rows are the events that
+    each stage keeps. Stages can also be sharded-N, for N workers.
+    """
+    stages = list(STAGES) if stages is None else stages
+    results = {
+        'suite': 'syslog_ad',
+        'rows': len(lines),
+        'stages': {},
+    }
+    for stage in stages:
+        results['stages'][stage] = measure(
+            _setup, _run, args=(lines, stage), isolate=isolate
+        )
+
+    return results
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Benchmark remote AD log parsing')
+    parser.add_argument(
+        '--rows', type=int, default=100000, help='Number of events'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--oneline-share',
+        type=float,
+        default=0.5,
+        help='Fraction of events in the one-line format',
+    )
+    parser.add_argument(
+        '--stages',
+        default=','.join(STAGES),
+        help='Comma-separated stages to run',
+    )
+    parser.add_argument(
+        '--workers',
+        default='1,2,4',
+        help='Comma-separated worker counts for the sharded stages',
+    )
+    parser.add_argument('--output', help='Save the results to this file')
+    args = parser.parse_args(argv)
+
+    lines = generate_ad_lines(args.rows, args.seed, args.oneline_share)
+    stages = args.stages.split(',') if args.stages else []
+    if args.workers:
+        stages.extend(
+            SHARDED_PREFIX + x.strip() for x in args.workers.split(',')
+        )
+    results = run_benchmarks(lines, stages)
+    print_results(results)
+    if args.output:
+        save_results(results, args.output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
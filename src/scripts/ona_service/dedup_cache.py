@@ -0,0 +1,153 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# python builtins
+import logging
+
+from collections import OrderedDict
+from os import fsync, rename
+from struct import error as struct_error, Struct
+
+DEFAULT_MAX_ENTRIES = 100000
+# Snapshots are a header followed by (key, timestamp) records
+SNAPSHOT_HEADER = Struct('<4sI')
+SNAPSHOT_MAGIC = b'ODC1'
+SNAPSHOT_RECORD = Struct('<QI')
+
+
+class DedupCache:
+    """
+    Remembers 64-bit keys for `window` seconds, for suppressing repeated
+    events across ticks. A key is a duplicate if it was last let through
+    less than `window` seconds (by the events' timestamps) before. Hits
+    don't extend a key's time, so a repeating event is let through once per
+    window.
+
+    At most `max_entries` keys are kept; beyond that, the oldest keys are
+    evicted first. If `snapshot_path` is given, the cache is loaded from
+    there at startup and can be saved back with `save`.
+    """
+    def __init__(
+        self, window, max_entries=DEFAULT_MAX_ENTRIES, snapshot_path=None
+    ):
+        self.window = window
+        self.max_entries = max_entries
+        self.snapshot_path = snapshot_path
+        # key -> timestamp, oldest first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.is_dirty = False
+        if snapshot_path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def check(self, key, ts):
+        """
+        Returns True if `key` was let through within the window around the
+        timestamp `ts`. Unlike `is_duplicate`, `key` isn't remembered.
+        """
+        seen_ts = self.entries.get(key)
+        if (seen_ts is not None) and (abs(ts - seen_ts) < self.window):
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, key, ts):
+        """
+        Remembers `key` as having been let through at the timestamp `ts`.
+        """
+        self.entries[key] = ts
+        self.entries.move_to_end(key)
+        self.is_dirty = True
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def is_duplicate(self, key, ts):
+        """
+        Returns True if `key` was let through within the window around the
+        timestamp `ts`. Otherwise, remembers `key` at `ts` and returns False.
+        """
+        if self.check(key, ts):
+            return True
+
+        self.add(key, ts)
+        return False
+
+    def expire(self, now_ts):
+        """
+        Drops the keys that are older than the window as of `now_ts`.
+        """
+        entries = self.entries
+        while entries:
+            key, ts = next(iter(entries.items()))
+            if now_ts - ts < self.window:
+                break
+            del entries[key]
+            self.is_dirty = True
+
+    def load(self):
+        self.entries.clear()
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return
+
+        try:
+            magic, count = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError('Unknown format')
+            records = SNAPSHOT_RECORD.iter_unpack(
+                data[SNAPSHOT_HEADER.size:]
+            )
+            for __, (key, ts) in zip(range(count), records):
+                self.entries[key] = ts
+        except (struct_error, ValueError) as e:
+            logging.error('Could not load %s: %s', self.snapshot_path, e)
+            self.entries.clear()
+            return
+
+        # The snapshot can be from an older run with a larger budget
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """
+        Writes the cache to the snapshot file, if it's changed.
+        """
+        if (self.snapshot_path is None) or (not self.is_dirty):
+            return
+
+        temp_path = '{}.tmp'.format(self.snapshot_path)
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(self.entries)))
+            f.write(
+                b''.join(
+                    SNAPSHOT_RECORD.pack(key, ts)
+                    for key, ts in self.entries.items()
+                )
+            )
+            f.flush()
+            fsync(f.fileno())
+        rename(temp_path, self.snapshot_path)
+        self.is_dirty = False
@@ -0,0 +1,142 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Decoder for DNS response messages (RFC 1035), for passive DNS.
+"""
+# python builtins
+import socket
+
+from collections import namedtuple
+from struct import error as struct_error, Struct
+
+DNS_HEADER = Struct('!HHHHHH')
+QUESTION = Struct('!HH')
+RESOURCE_RECORD = Struct('!HHIH')
+UINT16 = Struct('!H')
+
+# Compression pointers can't be followed more than this many times
+MAX_POINTERS = 32
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_AAAA = 28
+TYPE_DNAME = 39
+# Types whose data is a single domain name
+NAME_TYPES = {TYPE_NS, TYPE_CNAME, TYPE_PTR, TYPE_DNAME}
+
+DNSResponse = namedtuple(
+    'DNSResponse', ['qname', 'qtype', 'rcode', 'answers']
+)
+DNSAnswer = namedtuple('DNSAnswer', ['rtype', 'ttl', 'data'])
+
+
+def _decode_labels(message, offset):
+    # Returns (labels, offset just past the name) for the name at `offset`
+    labels = []
+    end = None
+    pointers = 0
+    while True:
+        length = message[offset]
+        if length >= 0xc0:
+            pointers += 1
+            if pointers > MAX_POINTERS:
+                raise ValueError('Too many compression pointers')
+            if end is None:
+                end = offset + 2
+            offset = UINT16.unpack_from(message, offset)[0] & 0x3fff
+            continue
+        if length > 63:
+            raise ValueError('Invalid label length: {}'.format(length))
+        offset += 1
+        if length == 0:
+            break
+        label = bytes(message[offset:offset + length])
+        if len(label) != length:
+            raise ValueError('Truncated label')
+        labels.append(label)
+        offset += length
+
+    return labels, (offset if end is None else end)
+
+
+def decode_name(message, offset):
+    """
+    Returns (name, offset just past it) for the domain name that starts at
+    `offset` in `message`, following compression pointers. Names are
+    lowercase with no trailing dot; the root is ''. Raises ValueError if
+    the name is invalid.
+    """
+    try:
+        labels, offset = _decode_labels(message, offset)
+    except (IndexError, struct_error) as e:
+        raise ValueError('Truncated name') from e
+
+    name = b'.'.join(labels).lower().decode('ascii', 'backslashreplace')
+    return name, offset
+
+
+def _decode_rdata(message, rtype, offset, rdlength):
+    # Returns the answer's data as a string: addresses for A and AAAA
+    # records, names for name-like ones and hex for everything else.
+    rdata = message[offset:offset + rdlength]
+    if len(rdata) != rdlength:
+        raise ValueError('Truncated record')
+    if (rtype == TYPE_A) and (rdlength == 4):
+        return socket.inet_ntop(socket.AF_INET, rdata)
+    if (rtype == TYPE_AAAA) and (rdlength == 16):
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype in NAME_TYPES:
+        return decode_name(message, offset)[0]
+    if rtype == TYPE_MX:
+        return decode_name(message, offset + 2)[0]
+    return bytes(rdata).hex()
+
+
+def decode_response(message):
+    """
+    Decodes the DNS response in `message` (bytes or a memoryview) and
+    returns a DNSResponse with the first question and the records in the
+    answer section. Raises ValueError if `message` isn't a valid response.
+    """
+    try:
+        __, flags, qdcount, ancount, __, __ = DNS_HEADER.unpack_from(message)
+        if not flags & 0x8000:
+            raise ValueError('Not a response')
+        if qdcount < 1:
+            raise ValueError('No question')
+
+        offset = DNS_HEADER.size
+        qname, offset = decode_name(message, offset)
+        qtype, __ = QUESTION.unpack_from(message, offset)
+        offset += QUESTION.size
+        for __ in range(qdcount - 1):
+            offset = decode_name(message, offset)[1] + QUESTION.size
+
+        answers = []
+        for __ in range(ancount):
+            offset = decode_name(message, offset)[1]
+            rtype, __, ttl, rdlength = RESOURCE_RECORD.unpack_from(
+                message, offset
+            )
+            offset += RESOURCE_RECORD.size
+            data = _decode_rdata(message, rtype, offset, rdlength)
+            answers.append(DNSAnswer(rtype, ttl, data))
+            offset += rdlength
+    except (IndexError, struct_error) as e:
+        raise ValueError('Truncated message') from e
+
+    return DNSResponse(qname, qtype, flags & 0x000f, answers)
@@ -12,13 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # python builtins
-from os import getenv
+import logging
+
+from glob import iglob
+from itertools import chain
+from os import getenv, remove, rename
+from os.path import join
 
 # local
-from ona_service.tcpdump_pusher import TcpdumpPusher
+from ona_service.flow_export import (
+    iter_export_messages,
+    TemplateStore,
+    write_messages,
+)
+from ona_service.tcpdump_pusher import CODECS, TcpdumpPusher, TEMP_SUFFIX
+from ona_service.utils import utcnow
 
 ENV_ETA_PCAP_DIR = 'OBSRVBL_ETA_PCAP_DIR'
 DEFAULT_ETA_PCAP_DIR = './logs'
+# Set to "messages" to upload the export messages instead of pcaps
+ENV_ETA_FORMAT = 'OBSRVBL_ETA_FORMAT'
+DEFAULT_ETA_FORMAT = 'pcap'
+MESSAGES_SUFFIX = '.messages'
 
 
 class EtaPusher(TcpdumpPusher):
@@ -31,13 +46,99 @@ class EtaPusher(TcpdumpPusher):
         kwargs.update(init_kwargs)
         super().__init__(*args, **kwargs)
 
+        self.eta_format = getenv(ENV_ETA_FORMAT, DEFAULT_ETA_FORMAT)
+        if self.eta_format not in ('pcap', 'messages'):
+            logging.error('Unknown format %s, using pcap', self.eta_format)
+            self.eta_format = DEFAULT_ETA_FORMAT
+        self.templates = TemplateStore()
+
+    def _iter_messages(self, file_path):
+        # Yields (ts, exporter, message) for each of the messages in the pcap,
+        # starting with the templates from earlier captures.
+        messages = iter_export_messages(file_path)
+        first = next(messages, None)
+        if first is None:
+            return
+
+        for exporter, message in self.templates.get_messages(int(first.ts)):
+            yield first.ts, exporter, message
+        for ts, exporter, message in chain([first], messages):
+            self.templates.update(exporter, message)
+            yield ts, exporter, message
+
+    def _extract(self, file_path):
+        # Writes the compressed messages file for a pcap. Returns True on
+        # success.
+        __, open_codec = CODECS[self.codec]
+        level = self.compress_level
+        out_path = file_path + MESSAGES_SUFFIX + self.compress_suffix
+        temp_path = out_path + TEMP_SUFFIX
+        try:
+            with open(temp_path, 'wb') as raw:
+                with open_codec(raw, level, file_path) as outfile:
+                    write_messages(self._iter_messages(file_path), outfile)
+            rename(temp_path, out_path)
+        except (OSError, ValueError) as e:
+            logging.error('Error extracting %s: %s', file_path, e)
+            try:
+                remove(temp_path)
+            except OSError:
+                pass
+            return False
+
+        return True
+
+    def extract_pcaps(self):
+        """
+        Writes out the export messages from the finished pcap files in the
+        capture directory, then removes the pcaps.
+        """
+        self._remove_partial()
+        for file_path in self._get_finished_pcaps():
+            logging.info('Extracting export messages from %s', file_path)
+            if self._extract(file_path):
+                remove(file_path)
+
+    def push_messages(self, now):
+        """
+        Sends out the export message files in the capture directory, then
+        removes them.
+        """
+        ret = []
+        ts = now.replace(
+            minute=(now.minute // 10) * 10,
+            second=0,
+            microsecond=0
+        )
+
+        glob_pattern = join(
+            self.pcap_dir,
+            '{}_*.pcap{}{}'.format(
+                self.data_type, MESSAGES_SUFFIX, self.compress_suffix
+            ),
+        )
+        for i, file_path in enumerate(sorted(iglob(glob_pattern))):
+            suffix = '{:04}{}'.format(i, self.upload_suffix)
+            remote_path = self.api.send_file(
+                self.data_type, file_path, ts, suffix=suffix
+            )
+            ret.append(remote_path)
+            remove(file_path)
+
+        return ret
+
     def execute(self, now=None):
-        all_remote_paths = super().execute(now=now)
+        if self.eta_format == 'pcap':
+            all_remote_paths = super().execute(now=now)
+        else:
+            self.extract_pcaps()
+            all_remote_paths = self.push_messages(now or utcnow())
 
+        log_type = 'eta-{}'.format(self.eta_format)
         for remote_path in all_remote_paths:
             self.api.send_signal(
                 self.data_type,
-                data={'path': remote_path, 'log_type': 'eta-pcap'}
+                data={'path': remote_path, 'log_type': log_type}
             )
 
 
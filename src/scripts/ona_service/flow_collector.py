@@ -0,0 +1,745 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# python builtins
+import asyncio
+import logging
+import socket
+
+from datetime import datetime
+from os import environ, makedirs, rename
+from os.path import join
+from struct import error as struct_error, Struct
+from time import time
+
+# local
+from ona_service.flowcap_config import FlowcapConfig
+from ona_service.pcap_reader import iter_udp
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+ENV_IPFIX_LOGDIR = 'OBSRVBL_IPFIX_LOGDIR'
+DEFAULT_IPFIX_LOGDIR = './logs'
+
+# Match flowcap's rotation settings (see flowcap.sh)
+ROTATE_PERIOD = 60
+ENV_FLOWCAP_MAX_FILE_SIZE = 'OBSRVBL_FLOWCAP_MAX_FILE_SIZE'
+DEFAULT_FLOWCAP_MAX_FILE_SIZE = '104857600'
+
+# Files written by the collector end with this; IPFIXPusher uses it to tell
+# them apart from flowcap's SiLK files.
+NATIVE_SUFFIX = '.csv'
+FILE_FMT = '%Y%m%d%H%M%S'
+
+# Like the pusher's CSV_HEADER, but with the interface indexes that are needed
+# for OBSRVBL_IPFIX_INDEX_RANGES filtering.
+NATIVE_FIELDS = [
+    'srcaddr',
+    'dstaddr',
+    'srcport',
+    'dstport',
+    'protocol',
+    'bytes',
+    'packets',
+    'start',
+    'end',
+    'input',
+    'output',
+]
+
+# Maximum number of datagrams to read per socket wake-up
+RECV_BATCH = 256
+RECV_BUFSIZE = 65535
+SOCKET_RCVBUF = 8 * 1024 * 1024
+
+V5_HEADER = Struct('!HHIIIIBBH')
+V5_RECORD = Struct('!4s4s4sHHIIIIHHBBBBHHBBH')
+V9_HEADER = Struct('!HHIIII')
+IPFIX_HEADER = Struct('!HHIII')
+SET_HEADER = Struct('!HH')
+FIELD_SPEC = Struct('!HH')
+UINT8 = Struct('!B')
+UINT16 = Struct('!H')
+UINT32 = Struct('!I')
+SFLOW_SAMPLE = Struct('!8I')
+SFLOW_EXPANDED_SAMPLE = Struct('!11I')
+SFLOW_RECORD = Struct('!II')
+SFLOW_RAW_HEADER = Struct('!4I')
+
+# Information elements we care about, by IANA number. NetFlow v9 shares these
+# numbers for the elements below.
+FIELD_NAMES = {
+    1: 'bytes',
+    2: 'packets',
+    4: 'protocol',
+    7: 'srcport',
+    8: 'srcaddr',
+    10: 'input',
+    11: 'dstport',
+    12: 'dstaddr',
+    14: 'output',
+    21: 'last_uptime',
+    22: 'first_uptime',
+    27: 'srcaddr',
+    28: 'dstaddr',
+    150: 'start_sec',
+    151: 'end_sec',
+    152: 'start_msec',
+    153: 'end_msec',
+    # Cisco ASA reports initiator counts instead of the delta counts
+    231: 'bytes',
+    298: 'packets',
+}
+ADDRESS_FIELDS = {'srcaddr', 'dstaddr'}
+VARIABLE_LENGTH = 65535
+
+
+def _ntop(packed):
+    if len(packed) == 4:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def decode_v5(data):
+    """
+    Given a NetFlow v5 export packet, return a list of flow tuples in
+    NATIVE_FIELDS order.
+    """
+    (
+        __, count, sys_uptime, unix_secs, __, __, __, __, __
+    ) = V5_HEADER.unpack_from(data)
+
+    ret = []
+    offset = V5_HEADER.size
+    for __ in range(count):
+        if offset + V5_RECORD.size > len(data):
+            break
+        (
+            srcaddr, dstaddr, __, input_, output, packets, bytes_,
+            first, last, srcport, dstport, __, __, protocol, __,
+            __, __, __, __, __
+        ) = V5_RECORD.unpack_from(data, offset)
+        offset += V5_RECORD.size
+
+        # First and last are in milliseconds of system uptime
+        start = unix_secs - (sys_uptime - first) // 1000
+        end = unix_secs - (sys_uptime - last) // 1000
+        ret.append((
+            _ntop(srcaddr), _ntop(dstaddr), srcport, dstport, protocol,
+            bytes_, packets, start, end, input_, output
+        ))
+
+    return ret
+
+
+class Template:
+    """
+    A compiled NetFlow v9 or IPFIX data template. Templates made up entirely of
+    fixed-length fields are decoded with a single precompiled `Struct`.
+    """
+    def __init__(self, fields):
+        """
+        `fields` is a sequence of (element_id, length) pairs.
+        """
+        self.fields = fields
+        self.names = [FIELD_NAMES.get(f_id) for f_id, __ in fields]
+        self.variable = any(x == VARIABLE_LENGTH for __, x in fields)
+
+        parts = ['!']
+        self.extract = []
+        for i, (f_id, length) in enumerate(fields):
+            name = self.names[i]
+            if name is None:
+                parts.append('{}x'.format(length))
+            else:
+                parts.append('{}s'.format(length))
+                self.extract.append(name)
+        self.struct = None if self.variable else Struct(''.join(parts))
+        self.length = None if self.variable else self.struct.size
+        # Variable-length fields take at least their one-byte length
+        self.min_length = sum(
+            1 if x == VARIABLE_LENGTH else x for __, x in fields
+        )
+
+    def _convert(self, items):
+        values = {}
+        for name, raw in items:
+            if name in ADDRESS_FIELDS:
+                values[name] = _ntop(raw)
+            else:
+                values[name] = int.from_bytes(raw, 'big')
+        return values
+
+    def _decode_variable(self, data, offset, end):
+        # Returns (items, offset), or None if the record runs past `end`
+        items = []
+        for name, (__, length) in zip(self.names, self.fields):
+            if length == VARIABLE_LENGTH:
+                if offset >= end:
+                    return None
+                length = data[offset]
+                offset += 1
+                if length == 255:
+                    if offset + 2 > end:
+                        return None
+                    length = UINT16.unpack_from(data, offset)[0]
+                    offset += 2
+            if name is not None:
+                items.append((name, data[offset:offset + length]))
+            offset += length
+        if offset > end:
+            return None
+        return items, offset
+
+    def decode(self, data, offset, end):
+        """
+        Yields dictionaries of the interesting fields for each record in
+        `data[offset:end]`. Bytes after the last complete record are taken
+        to be padding.
+        """
+        while offset + self.min_length <= end:
+            if self.variable:
+                result = self._decode_variable(data, offset, end)
+                if result is None:
+                    break
+                items, offset = result
+            else:
+                raw = self.struct.unpack_from(data, offset)
+                items = zip(self.extract, raw)
+                offset += self.length
+            yield self._convert(items)
+
+
+class TemplateCache:
+    """
+    Holds the templates seen from each exporter. Keys are
+    (exporter, observation domain / source ID, template ID).
+    """
+    def __init__(self):
+        self.templates = {}
+
+    def get(self, exporter, domain, template_id):
+        return self.templates.get((exporter, domain, template_id))
+
+    def add(self, exporter, domain, template_id, fields):
+        # Records from a template with no length would never end
+        if not sum(length for __, length in fields):
+            logging.warning('Ignoring empty template %s', template_id)
+            return
+        key = (exporter, domain, template_id)
+        old = self.templates.get(key)
+        if (old is None) or (old.fields != fields):
+            self.templates[key] = Template(fields)
+
+    def remove(self, exporter, domain, template_id):
+        self.templates.pop((exporter, domain, template_id), None)
+
+
+def _parse_template_set(data, offset, end, is_ipfix):
+    # Yields (template_id, fields) for each template in the set
+    while offset + 4 <= end:
+        template_id, field_count = FIELD_SPEC.unpack_from(data, offset)
+        offset += 4
+        fields = []
+        for __ in range(field_count):
+            f_id, length = FIELD_SPEC.unpack_from(data, offset)
+            offset += 4
+            # IPFIX enterprise-specific elements carry an enterprise number;
+            # we don't interpret any of them.
+            if is_ipfix and (f_id & 0x8000):
+                offset += 4
+                f_id = None
+            fields.append((f_id, length))
+        yield template_id, fields
+
+
+def _to_flow(values, export_secs, sys_uptime):
+    # Convert a decoded record to a flow tuple in NATIVE_FIELDS order
+    if 'start_sec' in values:
+        start = values['start_sec']
+    elif 'start_msec' in values:
+        start = values['start_msec'] // 1000
+    elif 'first_uptime' in values:
+        start = export_secs - (sys_uptime - values['first_uptime']) // 1000
+    else:
+        start = export_secs
+
+    if 'end_sec' in values:
+        end = values['end_sec']
+    elif 'end_msec' in values:
+        end = values['end_msec'] // 1000
+    elif 'last_uptime' in values:
+        end = export_secs - (sys_uptime - values['last_uptime']) // 1000
+    else:
+        end = start
+
+    return (
+        values.get('srcaddr', '0.0.0.0'),
+        values.get('dstaddr', '0.0.0.0'),
+        values.get('srcport', 0),
+        values.get('dstport', 0),
+        values.get('protocol', 0),
+        values.get('bytes', 0),
+        values.get('packets', 0),
+        start,
+        end,
+        values.get('input', 0),
+        values.get('output', 0),
+    )
+
+
+def _decode_sets(data, offset, set_ids, cache, exporter, domain, times):
+    # Shared by the v9 and IPFIX decoders: walks the (Flow)Sets in a message,
+    # updating the template cache and decoding data records.
+    template_set_id, options_set_id, is_ipfix = set_ids
+    ret = []
+    while offset + SET_HEADER.size <= len(data):
+        set_id, set_length = SET_HEADER.unpack_from(data, offset)
+        if set_length < SET_HEADER.size:
+            break
+        start = offset + SET_HEADER.size
+        end = min(offset + set_length, len(data))
+        offset += set_length
+
+        if set_id == template_set_id:
+            for template_id, fields in _parse_template_set(
+                data, start, end, is_ipfix
+            ):
+                if fields:
+                    cache.add(exporter, domain, template_id, fields)
+                else:
+                    # A template with no fields is a withdrawal
+                    cache.remove(exporter, domain, template_id)
+        elif set_id == options_set_id:
+            continue
+        elif set_id >= 256:
+            template = cache.get(exporter, domain, set_id)
+            if template is None:
+                continue
+            ret.extend(
+                _to_flow(values, *times)
+                for values in template.decode(data, start, end)
+                if 'srcaddr' in values
+            )
+
+    return ret
+
+
+def decode_v9(data, cache, exporter):
+    """
+    Given a NetFlow v9 export packet, update the `cache` of templates for
+    `exporter` and return a list of flow tuples.
+    """
+    (
+        __, __, sys_uptime, unix_secs, __, source_id
+    ) = V9_HEADER.unpack_from(data)
+    return _decode_sets(
+        data,
+        V9_HEADER.size,
+        (0, 1, False),
+        cache,
+        exporter,
+        source_id,
+        (unix_secs, sys_uptime),
+    )
+
+
+def decode_ipfix(data, cache, exporter):
+    """
+    Given an IPFIX message, update the `cache` of templates for `exporter` and
+    return a list of flow tuples.
+    """
+    __, length, export_time, __, domain = IPFIX_HEADER.unpack_from(data)
+    return _decode_sets(
+        data[:length],
+        IPFIX_HEADER.size,
+        (2, 3, True),
+        cache,
+        exporter,
+        domain,
+        (export_time, 0),
+    )
+
+
+def _decode_packet_header(header):
+    # Given the start of a sampled Ethernet frame, return
+    # (srcaddr, dstaddr, srcport, dstport, protocol) or None.
+    offset = 12
+    ethertype = UINT16.unpack_from(header, offset)[0]
+    offset += 2
+    if ethertype == 0x8100:
+        ethertype = UINT16.unpack_from(header, offset + 2)[0]
+        offset += 4
+
+    if ethertype == 0x0800:
+        ihl = (header[offset] & 0x0F) * 4
+        protocol = header[offset + 9]
+        srcaddr = header[offset + 12:offset + 16]
+        dstaddr = header[offset + 16:offset + 20]
+        offset += ihl
+    elif ethertype == 0x86DD:
+        protocol = header[offset + 6]
+        srcaddr = header[offset + 8:offset + 24]
+        dstaddr = header[offset + 24:offset + 40]
+        offset += 40
+    else:
+        return None
+
+    srcport = dstport = 0
+    if protocol in (6, 17) and (offset + 4 <= len(header)):
+        srcport, dstport = FIELD_SPEC.unpack_from(header, offset)
+
+    return _ntop(srcaddr), _ntop(dstaddr), srcport, dstport, protocol
+
+
+def _decode_sflow_sample(data, offset, expanded, now):
+    # Returns a list of flow tuples from one sFlow flow sample
+    if expanded:
+        __, __, __, rate, __, __, __, input_, __, output, num_records = (
+            SFLOW_EXPANDED_SAMPLE.unpack_from(data, offset)
+        )
+        offset += 44
+    else:
+        __, __, rate, __, __, input_, output, num_records = (
+            SFLOW_SAMPLE.unpack_from(data, offset)
+        )
+        input_ &= 0x3FFFFFFF
+        output &= 0x3FFFFFFF
+        offset += 32
+
+    ret = []
+    for __ in range(num_records):
+        record_format, record_length = SFLOW_RECORD.unpack_from(data, offset)
+        offset += 8
+        # Raw packet header (Ethernet)
+        if record_format == 1:
+            header_protocol, frame_length, __, header_length = (
+                SFLOW_RAW_HEADER.unpack_from(data, offset)
+            )
+            header = data[offset + 16:offset + 16 + header_length]
+            if header_protocol == 1:
+                five_tuple = _decode_packet_header(header)
+                if five_tuple is not None:
+                    ret.append(
+                        five_tuple +
+                        (frame_length * rate, rate, now, now, input_, output)
+                    )
+        offset += record_length
+
+    return ret
+
+
+def decode_sflow(data, now=None):
+    """
+    Given an sFlow v5 datagram, return a list of flow tuples estimated from
+    the sampled packet headers.
+    """
+    now = int(time()) if now is None else now
+
+    offset = 4
+    address_type = UINT32.unpack_from(data, offset)[0]
+    offset += 4 + (16 if address_type == 2 else 4)
+    offset += 12  # sub-agent ID, sequence number, uptime
+    num_samples = UINT32.unpack_from(data, offset)[0]
+    offset += 4
+
+    ret = []
+    for __ in range(num_samples):
+        sample_type, sample_length = SFLOW_RECORD.unpack_from(data, offset)
+        offset += 8
+        # Flow samples (standard and expanded); counter samples are skipped
+        if sample_type in (1, 3):
+            ret.extend(
+                _decode_sflow_sample(data, offset, sample_type == 3, now)
+            )
+        offset += sample_length
+
+    return ret
+
+
+class ProbeWriter:
+    """
+    Writes flows for one probe to a file in the pusher's input directory. The
+    file is hidden while it's being written and is rotated every
+    ROTATE_PERIOD seconds or when it reaches `max_size` bytes.
+    """
+    def __init__(self, probe_id, output_dir, max_size):
+        self.probe_id = probe_id
+        self.output_dir = output_dir
+        self.max_size = max_size
+        self.file_name = None
+        self.outfile = None
+        self.opened_at = None
+        self.flow_count = 0
+        # Like flowcap, files are numbered so that several can be opened
+        # in the same second
+        self.sequence = 0
+
+    def _open(self, now):
+        dt = datetime.utcfromtimestamp(now)
+        self.file_name = '{}_{}.{:06}{}'.format(
+            dt.strftime(FILE_FMT), self.probe_id, self.sequence, NATIVE_SUFFIX
+        )
+        self.sequence += 1
+        temp_path = join(self.output_dir, '.{}'.format(self.file_name))
+        self.outfile = open(temp_path, 'wt')
+        self.opened_at = now
+
+    def close(self):
+        if self.outfile is None:
+            return
+
+        self.outfile.close()
+        temp_path = join(self.output_dir, '.{}'.format(self.file_name))
+        rename(temp_path, join(self.output_dir, self.file_name))
+        self.outfile = None
+
+    def check_rotate(self, now):
+        if self.outfile is None:
+            return
+        if (now - self.opened_at >= ROTATE_PERIOD) or (
+            self.outfile.tell() >= self.max_size
+        ):
+            self.close()
+
+    def write(self, flows, now):
+        if not flows:
+            return
+        self.check_rotate(now)
+        if self.outfile is None:
+            self._open(now)
+        self.outfile.write(
+            ''.join(
+                '{},{},{},{},{},{},{},{},{},{},{}\n'.format(*f) for f in flows
+            )
+        )
+        self.flow_count += len(flows)
+
+
+class FlowCollector:
+    """
+    Receives NetFlow v5, NetFlow v9, IPFIX and sFlow exports for the probes
+    configured with OBSRVBL_IPFIX_PROBE_* and writes them to
+    OBSRVBL_IPFIX_LOGDIR for IPFIXPusher. This is a replacement for SiLK's
+    flowcap.
+    """
+    def __init__(self, *args, **kwargs):
+        self.output_dir = kwargs.pop(
+            'output_dir', environ.get(ENV_IPFIX_LOGDIR, DEFAULT_IPFIX_LOGDIR)
+        )
+        self.max_size = int(
+            environ.get(
+                ENV_FLOWCAP_MAX_FILE_SIZE, DEFAULT_FLOWCAP_MAX_FILE_SIZE
+            )
+        )
+        makedirs(self.output_dir, exist_ok=True)
+
+        self.cache = TemplateCache()
+        self.writers = {}
+        self.sockets = []
+        self.servers = []
+        self.decoders = {
+            'netflow-v5': lambda data, exporter: decode_v5(data),
+            'netflow-v9': lambda data, exporter: decode_v9(
+                data, self.cache, exporter
+            ),
+            'ipfix': lambda data, exporter: decode_ipfix(
+                data, self.cache, exporter
+            ),
+            'sflow': lambda data, exporter: decode_sflow(data),
+        }
+        probes = kwargs.pop('probes', None)
+        if probes is None:
+            flowcap_config = FlowcapConfig()
+            flowcap_config.update()
+            probes = flowcap_config.valid_probes()
+        self.probes = self._get_unique_probes(probes)
+
+    def _get_unique_probes(self, probes):
+        # Only one probe can listen on each port, like with flowcap
+        ret = []
+        added = set()
+        for probe in probes:
+            port_protocol = probe.port, probe.protocol
+            if port_protocol in added:
+                logging.warning(
+                    'Duplicate configuration detected for %s/%s',
+                    probe.port,
+                    probe.protocol
+                )
+                continue
+            added.add(port_protocol)
+            ret.append(probe)
+
+        return ret
+
+    def _get_writer(self, probe):
+        probe_id = 'S{}'.format(probe.index)
+        if not probe.index.isdigit():
+            probe_id = probe.index
+        writer = self.writers.get(probe_id)
+        if writer is None:
+            writer = ProbeWriter(probe_id, self.output_dir, self.max_size)
+            self.writers[probe_id] = writer
+        return writer
+
+    def handle_packet(self, probe, data, exporter, now=None):
+        """
+        Decodes one export packet received from `exporter` and writes its
+        flows.
+        """
+        now = int(time()) if now is None else now
+        try:
+            flows = self.decoders[probe.type_](data, (probe.index, exporter))
+        except (IndexError, ValueError, struct_error):
+            logging.warning('Could not decode packet from %s', exporter)
+            return
+        self._get_writer(probe).write(flows, now)
+
+    def _read_datagrams(self, probe, sock):
+        # Drain up to RECV_BATCH datagrams each time the socket is readable
+        now = int(time())
+        for __ in range(RECV_BATCH):
+            try:
+                data, addr = sock.recvfrom(RECV_BUFSIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.handle_packet(probe, data, addr[0], now)
+
+    async def _handle_stream(self, probe, reader, writer):
+        # IPFIX over TCP is framed by the length in the message header
+        exporter = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                header = await reader.readexactly(IPFIX_HEADER.size)
+                length = UINT16.unpack_from(header, 2)[0]
+                if length < IPFIX_HEADER.size:
+                    break
+                body = await reader.readexactly(length - IPFIX_HEADER.size)
+                self.handle_packet(probe, header + body, exporter)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _bind_udp(self, loop, probe):
+        host = '127.0.0.1' if probe.local else '0.0.0.0'
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+        sock.bind((host, probe.port))
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._read_datagrams, probe, sock)
+        self.sockets.append(sock)
+
+    async def _bind_tcp(self, probe):
+        if probe.type_ != 'ipfix':
+            logging.error('TCP transport is only supported for IPFIX')
+            return
+        host = '127.0.0.1' if probe.local else '0.0.0.0'
+        server = await asyncio.start_server(
+            lambda r, w: self._handle_stream(probe, r, w), host, probe.port
+        )
+        self.servers.append(server)
+
+    async def _rotate(self):
+        while True:
+            await asyncio.sleep(1)
+            now = int(time())
+            for writer in self.writers.values():
+                writer.check_rotate(now)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for probe in self.probes:
+            logging.info(
+                'Listening for %s on %s/%s',
+                probe.type_,
+                probe.port,
+                probe.protocol,
+            )
+            if probe.protocol == 'udp':
+                self._bind_udp(loop, probe)
+            else:
+                await self._bind_tcp(probe)
+
+        await self._rotate()
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        for server in self.servers:
+            server.close()
+        for writer in self.writers.values():
+            writer.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.close()
+
+
+def iter_pcap_payloads(file_path):
+    """
+    Yields the UDP payloads in a pcap file (see pcap_reader.iter_udp for
+    the supported link types). Use this to replay captured exports.
+    """
+    for packet in iter_udp(file_path):
+        yield bytes(packet.payload)
+
+
+def replay(payloads, port, host='127.0.0.1', repeat=1):
+    """
+    Sends each of the `payloads` to `host`:`port` over UDP `repeat` times.
+    Returns (packets sent, seconds taken).
+    """
+    payloads = list(payloads)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    count = 0
+    start = time()
+    try:
+        for __ in range(repeat):
+            for payload in payloads:
+                sock.sendto(payload, (host, port))
+                count += 1
+    finally:
+        sock.close()
+
+    return count, time() - start
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--replay',
+        help='Send the UDP payloads from this pcap file instead of listening',
+    )
+    parser.add_argument('--port', type=int, help='Port to replay to')
+    parser.add_argument(
+        '--repeat', type=int, default=1, help='Times to replay the pcap file'
+    )
+    args = parser.parse_args()
+
+    if args.replay:
+        count, elapsed = replay(
+            iter_pcap_payloads(args.replay), args.port, repeat=args.repeat
+        )
+        print(
+            'Sent {} packets in {:.3f}s ({:.0f} packets/s)'.format(
+                count, elapsed, count / max(elapsed, 1e-9)
+            )
+        )
+    else:
+        FlowCollector().run()
@@ -0,0 +1,199 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# python builtins
+from array import array
+from heapq import heapify, heappop, heappush
+from itertools import count
+from random import Random
+
+DEFAULT_MAX_ROLLUPS = 100000
+SKETCH_DEPTH = 4
+MIN_SKETCH_BITS = 10
+MASK_64 = (1 << 64) - 1
+OVERFLOW_ADDR = '0.0.0.0'
+
+
+class CountMinSketch:
+    """
+    Fixed-size estimator of per-key totals. Estimates are never too low, and
+    are only too high when keys collide in every row.
+
+    Each row has 2 ** `bits` counters. Keys are assigned to counters with
+    multiply-shift hashing, so that collisions in different rows are
+    independent.
+    """
+    def __init__(self, bits, depth=SKETCH_DEPTH):
+        self.shift = 64 - bits
+        rng = Random(depth)
+        self.multipliers = [
+            rng.getrandbits(64) | 1 for __ in range(depth)
+        ]
+        self.rows = [array('Q', bytes(8 << bits)) for __ in range(depth)]
+
+    def add(self, key, value):
+        """
+        Adds `value` to the total for `key` and returns the new estimate.
+        """
+        h = hash(key) & MASK_64
+        shift = self.shift
+        ret = None
+        for multiplier, row in zip(self.multipliers, self.rows):
+            j = ((h * multiplier) & MASK_64) >> shift
+            row[j] += value
+            ret = row[j] if ret is None else min(ret, row[j])
+        return ret
+
+
+class FlowCompactor:
+    """
+    Bounded-memory compaction for flows. The top `top_k` 5-tuples by bytes are
+    kept as exact records; all other flows are folded into
+    per-(src, dst, protocol) rollups. No bytes or packets are lost.
+
+    A Count-Min sketch estimates each 5-tuple's total bytes. A 5-tuple that
+    isn't being tracked is admitted to the top-K table if its estimate beats
+    the smallest tracked entry, which is evicted into the rollups. Records
+    for a 5-tuple from before it was admitted stay in its rollup.
+
+    At most `max_rollups` rollups are kept. Once that's reached, flows for
+    new (src, dst, protocol) keys go to one overflow rollup per protocol,
+    with 0.0.0.0 for its addresses.
+    """
+    def __init__(self, top_k, max_rollups=DEFAULT_MAX_ROLLUPS):
+        self.top_k = top_k
+        self.max_rollups = max_rollups
+        self.sketch = CountMinSketch(
+            max(MIN_SKETCH_BITS, (16 * top_k - 1).bit_length())
+        )
+        # 5-tuple -> [estimated bytes, bytes, packets, start, end]
+        self.monitored = {}
+        # Lazily-updated heap of (estimated bytes, sequence, 5-tuple)
+        self.heap = []
+        self.sequence = count()
+        # (src, dst, protocol) -> [bytes, packets, start, end]
+        self.rollups = {}
+
+    def _push(self, key, estimate):
+        heappush(self.heap, (estimate, next(self.sequence), key))
+        # Entries for updated keys are stale; clean them out occasionally
+        if len(self.heap) > 4 * self.top_k + 16:
+            self.heap = [
+                (v[0], next(self.sequence), k)
+                for k, v in self.monitored.items()
+            ]
+            heapify(self.heap)
+
+    def _peek_min(self):
+        # Returns the smallest current heap entry, dropping stale ones
+        while True:
+            estimate, __, key = self.heap[0]
+            values = self.monitored.get(key)
+            if (values is not None) and (values[0] == estimate):
+                return estimate, key
+            heappop(self.heap)
+
+    def _roll_up(self, key, bytes_, packets, start, end):
+        srcaddr, dstaddr, __, __, protocol = key
+        rollup_key = (srcaddr, dstaddr, protocol)
+        if rollup_key not in self.rollups:
+            if len(self.rollups) >= self.max_rollups:
+                rollup_key = (OVERFLOW_ADDR, OVERFLOW_ADDR, protocol)
+        rollup = self.rollups.get(rollup_key)
+        if rollup is None:
+            self.rollups[rollup_key] = [bytes_, packets, start, end]
+            return
+        rollup[0] += bytes_
+        rollup[1] += packets
+        rollup[2] = min(rollup[2], start)
+        rollup[3] = max(rollup[3], end)
+
+    def add(self, key, bytes_, packets, start, end):
+        """
+        Accounts for one flow record. `key` is the 5-tuple.
+        """
+        estimate = self.sketch.add(key, bytes_)
+
+        values = self.monitored.get(key)
+        if values is not None:
+            values[0] = estimate
+            values[1] += bytes_
+            values[2] += packets
+            values[3] = min(values[3], start)
+            values[4] = max(values[4], end)
+            self._push(key, estimate)
+            return
+
+        if len(self.monitored) >= self.top_k:
+            min_estimate, min_key = self._peek_min()
+            if estimate <= min_estimate:
+                self._roll_up(key, bytes_, packets, start, end)
+                return
+            heappop(self.heap)
+            self._roll_up(min_key, *self.monitored.pop(min_key)[1:])
+
+        self.monitored[key] = [estimate, bytes_, packets, start, end]
+        self._push(key, estimate)
+
+    def results(self):
+        """
+        Yields (5-tuple, bytes, packets, start, end, is_rollup) tuples: the
+        exact records by descending bytes, then the rollups. Rollups have
+        0 for their ports.
+        """
+        exact = sorted(
+            self.monitored.items(), key=lambda x: x[1][1], reverse=True
+        )
+        for key, values in exact:
+            yield (key,) + tuple(values[1:]) + (False,)
+
+        for (srcaddr, dstaddr, protocol), values in self.rollups.items():
+            key = (srcaddr, dstaddr, 0, 0, protocol)
+            yield (key,) + tuple(values) + (True,)
+
+    def compact(self, rows):
+        """
+        Given an iterable of flow dictionaries with the pusher's CSV fields,
+        yields compacted flow dictionaries with an extra 'rollup' field
+        ('1' for rollups, '0' otherwise).
+        """
+        for row in rows:
+            key = (
+                row['srcaddr'],
+                row['dstaddr'],
+                row['srcport'],
+                row['dstport'],
+                row['protocol'],
+            )
+            self.add(
+                key,
+                int(row['bytes']),
+                int(row['packets']),
+                int(row['start']),
+                int(row['end']),
+            )
+
+        for key, bytes_, packets, start, end, is_rollup in self.results():
+            srcaddr, dstaddr, srcport, dstport, protocol = key
+            yield {
+                'srcaddr': srcaddr,
+                'dstaddr': dstaddr,
+                'srcport': srcport,
+                'dstport': dstport,
+                'protocol': protocol,
+                'bytes': bytes_,
+                'packets': packets,
+                'start': start,
+                'end': end,
+                'rollup': '1' if is_rollup else '0',
+            }
@@ -0,0 +1,218 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tools for the NetFlow v9 and IPFIX export messages in captured pcaps.
+
+Messages are stored in a simple container: a FILE_HEADER, then for each
+message a RECORD_HEADER (capture time, exporter address length, message
+length), the exporter's packed address and the message itself.
+"""
+# python builtins
+from collections import namedtuple
+from struct import error as struct_error, Struct
+
+# local
+from ona_service.flow_collector import (
+    FIELD_SPEC,
+    IPFIX_HEADER,
+    SET_HEADER,
+    UINT16,
+    V9_HEADER,
+)
+from ona_service.pcap_reader import iter_udp
+
+FILE_MAGIC = b'ONAX'
+FILE_VERSION = 1
+FILE_HEADER = Struct('!4sH')
+RECORD_HEADER = Struct('!dBH')
+
+# Version -> (message header, template set ID, options template set ID)
+VERSIONS = {
+    9: (V9_HEADER, 0, 1),
+    10: (IPFIX_HEADER, 2, 3),
+}
+V9_OPTIONS_RECORD = Struct('!HHH')
+IPFIX_OPTIONS_RECORD = Struct('!HHH')
+
+ExportMessage = namedtuple('ExportMessage', ['ts', 'exporter', 'message'])
+
+
+def iter_export_messages(file_path):
+    """
+    Yields an ExportMessage for each of the NetFlow v9 and IPFIX messages in
+    the pcap file at `file_path`. Exporters are packed addresses, and messages
+    are memoryview slices (see pcap_reader.iter_packets). Other packets,
+    and IPFIX messages that were cut short, are skipped.
+    """
+    for packet in iter_udp(file_path):
+        message = packet.payload
+        if len(message) < 2:
+            continue
+        version = UINT16.unpack_from(message)[0]
+        if version not in VERSIONS:
+            continue
+        header = VERSIONS[version][0]
+        if len(message) < header.size:
+            continue
+        if version == 10:
+            length = UINT16.unpack_from(message, 2)[0]
+            if length > len(message):
+                continue
+            message = message[:length]
+        yield ExportMessage(packet.ts, packet.src, message)
+
+
+def _template_length(data, offset, is_ipfix):
+    # Returns the length of the template record at `offset`
+    __, field_count = FIELD_SPEC.unpack_from(data, offset)
+    length = 4
+    for __ in range(field_count):
+        f_id = UINT16.unpack_from(data, offset + length)[0]
+        length += 8 if (is_ipfix and (f_id & 0x8000)) else 4
+    return length
+
+
+def _options_length(data, offset, is_ipfix):
+    # Returns the length of the options template record at `offset`
+    if not is_ipfix:
+        __, scope_length, option_length = V9_OPTIONS_RECORD.unpack_from(
+            data, offset
+        )
+        return V9_OPTIONS_RECORD.size + scope_length + option_length
+
+    __, field_count, __ = IPFIX_OPTIONS_RECORD.unpack_from(data, offset)
+    length = IPFIX_OPTIONS_RECORD.size
+    for __ in range(field_count):
+        f_id = UINT16.unpack_from(data, offset + length)[0]
+        length += 8 if (f_id & 0x8000) else 4
+    return length
+
+
+def _iter_template_records(data, offset, end, is_options, is_ipfix):
+    # Yields (template_id, raw record) for each template in the set. Anything
+    # too short to be a record is padding.
+    get_length = _options_length if is_options else _template_length
+    while offset + 4 <= end:
+        template_id = UINT16.unpack_from(data, offset)[0]
+        length = get_length(data, offset, is_ipfix)
+        if offset + length > end:
+            raise ValueError('Truncated template')
+        yield template_id, bytes(data[offset:offset + length])
+        offset += length
+
+
+class TemplateStore:
+    """
+    Holds the most recent template records seen from each exporter, so they
+    can be sent again ahead of the data records that need them. Keys are
+    (exporter, version, observation domain / source ID).
+    """
+    def __init__(self):
+        # Key -> {(set ID, template ID): raw record}
+        self.records = {}
+
+    def _update_set(self, key, version, set_id, data, start, end):
+        __, template_set_id, options_set_id = VERSIONS[version]
+        is_options = set_id == options_set_id
+        templates = self.records.setdefault(key, {})
+        for template_id, raw in _iter_template_records(
+            data, start, end, is_options, version == 10
+        ):
+            # A template with no fields is a withdrawal
+            if (not is_options) and (UINT16.unpack_from(raw, 2)[0] == 0):
+                templates.pop((set_id, template_id), None)
+            else:
+                templates[(set_id, template_id)] = raw
+
+    def update(self, exporter, message):
+        """
+        Saves the template records in `message`, which came from `exporter`.
+        Messages that can't be parsed are ignored.
+        """
+        version = UINT16.unpack_from(message)[0]
+        header, template_set_id, options_set_id = VERSIONS[version]
+        key = (exporter, version, header.unpack_from(message)[-1])
+
+        offset = header.size
+        while offset + SET_HEADER.size <= len(message):
+            set_id, set_length = SET_HEADER.unpack_from(message, offset)
+            if set_length < SET_HEADER.size:
+                break
+            start = offset + SET_HEADER.size
+            end = min(offset + set_length, len(message))
+            offset += set_length
+            if set_id not in (template_set_id, options_set_id):
+                continue
+            try:
+                self._update_set(key, version, set_id, message, start, end)
+            except (ValueError, struct_error):
+                continue
+
+    def get_messages(self, export_time):
+        """
+        Yields (exporter, message) with a message holding the saved templates
+        for each exporter and observation domain.
+        """
+        for (exporter, version, domain), templates in self.records.items():
+            if not templates:
+                continue
+            sets = {}
+            for (set_id, __), raw in templates.items():
+                sets.setdefault(set_id, []).append(raw)
+            body = b''.join(
+                SET_HEADER.pack(set_id, SET_HEADER.size + sum(map(len, raws)))
+                + b''.join(raws)
+                for set_id, raws in sorted(sets.items())
+            )
+            if version == 9:
+                header = V9_HEADER.pack(
+                    9, len(templates), 0, export_time, 0, domain
+                )
+            else:
+                header = IPFIX_HEADER.pack(
+                    10, IPFIX_HEADER.size + len(body), export_time, 0, domain
+                )
+            yield exporter, header + body
+
+
+def write_messages(messages, outfile):
+    """
+    Writes `messages`, an iterable of (ts, exporter, message) tuples, to the
+    binary file `outfile` in the container format.
+    """
+    outfile.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+    for ts, exporter, message in messages:
+        outfile.write(RECORD_HEADER.pack(ts, len(exporter), len(message)))
+        outfile.write(exporter)
+        outfile.write(message)
+
+
+def read_messages(infile):
+    """
+    Yields an ExportMessage for each of the messages in the binary file
+    `infile`, which is in the container format. Raises ValueError for other
+    files.
+    """
+    magic, version = FILE_HEADER.unpack(infile.read(FILE_HEADER.size))
+    if (magic != FILE_MAGIC) or (version != FILE_VERSION):
+        raise ValueError('Not an export message file')
+
+    while True:
+        header = infile.read(RECORD_HEADER.size)
+        if not header:
+            break
+        ts, exporter_length, message_length = RECORD_HEADER.unpack(header)
+        exporter = infile.read(exporter_length)
+        message = infile.read(message_length)
+        yield ExportMessage(ts, exporter, message)
@@ -0,0 +1,185 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# python builtins
+import logging
+import socket
+
+from bisect import bisect_right
+from ipaddress import ip_network
+from itertools import islice
+
+MAX_INDEX = 65535
+BATCH_SIZE = 10000
+# Resolved addresses are remembered, up to this many
+MAX_CACHE_SIZE = 1000000
+
+
+def parse_index_ranges(ranges_str):
+    """
+    Given strings like '0-5,7-10', yield (min, max) pairs for the valid
+    ranges. Integers must be between 0 and 65535 inclusive.
+
+    Example: '0-5,7-10' -> (0, 5), (7, 10)
+    """
+    for index_range in ranges_str.split(','):
+        range_parts = index_range.strip().split('-')
+        if len(range_parts) != 2:
+            continue
+        try:
+            min_index, max_index = int(range_parts[0]), int(range_parts[1])
+        except ValueError:
+            continue
+        if not (min_index < max_index <= MAX_INDEX):
+            continue
+        yield min_index, max_index
+
+
+class IntervalSet:
+    """
+    A sorted array of non-overlapping integer intervals, built from CIDR
+    prefixes. Membership tests are a binary search, so they cost the same
+    for 3 networks as for 30,000.
+    """
+    def __init__(self, intervals):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(intervals):
+            # Merge overlapping and adjacent intervals
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __contains__(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return (i >= 0) and (value <= self.ends[i])
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class FlowFilter:
+    """
+    Compiled equivalent of rwfilter's --any-cidr and --any-index switches.
+    A flow passes if either of its addresses is in one of the `networks` and
+    (if `index_ranges` is given) either of its interface indexes is in one of
+    the ranges.
+    """
+    def __init__(self, networks, index_ranges=''):
+        """
+        `networks` is a sequence of CIDR strings (IPv4 or IPv6). Invalid
+        ones are skipped.
+        `index_ranges` is a string like '0-5,7-10'.
+        """
+        v4_intervals = []
+        v6_intervals = []
+        for network in networks:
+            try:
+                net = ip_network(network, strict=False)
+            except ValueError:
+                logging.warning('Skipping invalid network: %s', network)
+                continue
+            interval = (
+                int(net.network_address), int(net.broadcast_address)
+            )
+            if net.version == 4:
+                v4_intervals.append(interval)
+            else:
+                v6_intervals.append(interval)
+        self.v4 = IntervalSet(v4_intervals)
+        self.v6 = IntervalSet(v6_intervals)
+
+        # One byte per interface index
+        self.index_map = None
+        for min_index, max_index in parse_index_ranges(index_ranges):
+            if self.index_map is None:
+                self.index_map = bytearray(MAX_INDEX + 1)
+            length = max_index - min_index + 1
+            self.index_map[min_index:max_index + 1] = b'\x01' * length
+
+        self.cache = {}
+
+    def match_address(self, addr):
+        """
+        Returns True if the address string `addr` is in one of the networks.
+        """
+        try:
+            return self.cache[addr]
+        except KeyError:
+            pass
+
+        try:
+            if ':' in addr:
+                value = int.from_bytes(
+                    socket.inet_pton(socket.AF_INET6, addr), 'big'
+                )
+                ret = value in self.v6
+            else:
+                value = int.from_bytes(socket.inet_aton(addr), 'big')
+                ret = value in self.v4
+        except OSError:
+            ret = False
+
+        if len(self.cache) >= MAX_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[addr] = ret
+        return ret
+
+    def _index_mask(self, inputs, outputs):
+        index_map = self.index_map
+        if index_map is None:
+            return [True] * len(inputs)
+        ret = []
+        for i, o in zip(inputs, outputs):
+            i, o = int(i), int(o)
+            ret.append(
+                bool(
+                    ((i <= MAX_INDEX) and index_map[i]) or
+                    ((o <= MAX_INDEX) and index_map[o])
+                )
+            )
+        return ret
+
+    def mask(self, srcaddrs, dstaddrs, inputs, outputs):
+        """
+        Evaluates a batch of flows given as columns. Returns a list of
+        booleans, one per flow. Each distinct address in the batch is only
+        resolved once.
+        """
+        match = self.match_address
+        resolved = {x: match(x) for x in set(srcaddrs).union(dstaddrs)}
+        index_mask = self._index_mask(inputs, outputs)
+        return [
+            m and (resolved[s] or resolved[d])
+            for s, d, m in zip(srcaddrs, dstaddrs, index_mask)
+        ]
+
+    def filter(self, rows):
+        """
+        Given an iterable of dictionaries with 'srcaddr', 'dstaddr', 'input'
+        and 'output' keys, yields the ones that pass the filter.
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            mask = self.mask(
+                [r['srcaddr'] for r in batch],
+                [r['dstaddr'] for r in batch],
+                [r['input'] for r in batch],
+                [r['output'] for r in batch],
+            )
+            yield from (r for r, m in zip(batch, mask) if m)
@@ -0,0 +1,130 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Minimal ctypes binding for the Linux inotify API.
+"""
+# python builtins
+import ctypes
+import os
+
+from collections import namedtuple
+from ctypes.util import find_library
+from select import poll, POLLIN
+from struct import Struct
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = Struct('iIII')
+READ_SIZE = 64 * 1024
+
+InotifyEvent = namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])
+
+
+def _load_libc():
+    libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+    func_names = ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch')
+    for func_name in func_names:
+        if not hasattr(libc, func_name):
+            raise OSError('{} is not available'.format(func_name))
+    return libc
+
+
+def _check(ret):
+    if ret == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ret
+
+
+def parse_events(data):
+    """
+    Yields an InotifyEvent for each event in the bytes `data`, which should
+    come from reading an inotify file descriptor.
+    """
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        yield InotifyEvent(wd, mask, cookie, os.fsdecode(name))
+
+
+class Inotify:
+    """
+    An inotify instance. Raises OSError if inotify isn't available.
+    """
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.poller = poll()
+        self.poller.register(self.fd, POLLIN)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """
+        Starts watching `path` for the events in `mask`. Returns the watch
+        descriptor. Watching a path again returns the same descriptor, unless
+        the path now refers to a different file.
+        """
+        return _check(
+            self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        )
+
+    def remove_watch(self, wd):
+        _check(self.libc.inotify_rm_watch(self.fd, wd))
+
+    def read_events(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever if None) for events, and
+        returns a list of all the events that are ready.
+        """
+        timeout_ms = None if (timeout is None) else int(timeout * 1000)
+        if not self.poller.poll(timeout_ms):
+            return []
+
+        ret = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            ret.extend(parse_events(data))
+
+        return ret
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -19,11 +19,14 @@ from csv import DictReader, DictWriter
 from datetime import datetime
 from gzip import open as gz_open
 from os import environ, remove
-from os.path import basename, join, split
+from os.path import basename, exists, join, split
 from shutil import copy
 from subprocess import call
 
 # local
+from ona_service.flow_collector import NATIVE_FIELDS, NATIVE_SUFFIX
+from ona_service.flow_compactor import DEFAULT_MAX_ROLLUPS, FlowCompactor
+from ona_service.flow_filter import FlowFilter, parse_index_ranges
 from ona_service.pusher import Pusher
 from ona_service.utils import timestamp
 
@@ -38,7 +41,22 @@ DEFAULT_MONITOR_NETS = "10.0.0.0/8 172.16.0.0/12 192.168.0.0/16"
 
 ENV_IPFIX_INDEX_RANGES = 'OBSRVBL_IPFIX_INDEX_RANGES'
 
+# When 'true', all of a probe's files in a 10-minute bin are aggregated
+# together rather than one at a time.
+ENV_IPFIX_MERGE_BINS = 'OBSRVBL_IPFIX_MERGE_BINS'
+
+# When 'true', flowcap's files are filtered in-process with FlowFilter rather
+# than with rwfilter.
+ENV_IPFIX_INPROCESS_FILTER = 'OBSRVBL_IPFIX_INPROCESS_FILTER'
+
+# When set to a positive number, only that many 5-tuples (the top talkers by
+# bytes) are kept per file; the rest are rolled up by source, destination,
+# and protocol.
+ENV_IPFIX_COMPACT_TOP_K = 'OBSRVBL_IPFIX_COMPACT_TOP_K'
+ENV_IPFIX_COMPACT_MAX_ROLLUPS = 'OBSRVBL_IPFIX_COMPACT_MAX_ROLLUPS'
+
 CSV_HEADER = 'srcaddr,dstaddr,srcport,dstport,protocol,bytes,packets,start,end'
+COMPACT_CSV_HEADER = CSV_HEADER + ',rollup'
 RWFILTER_PATH = '/opt/silk/bin/rwfilter'
 RWUNIQ_PATH = '/opt/silk/bin/rwuniq'
 RWCUT_PATH = '/opt/silk/bin/rwcut'
@@ -54,19 +72,32 @@ def get_index_filter(ranges_str):
     Example: '0-5,7-10' -> '0,1,2,4,5,7,8,9,10'
     """
     index_filter = []
-    for index_range in ranges_str.split(','):
-        range_parts = index_range.strip().split('-')
-        if len(range_parts) != 2:
-            continue
-        min_index, max_index = int(range_parts[0]), int(range_parts[1])
-        if not (min_index < max_index <= 65535):
-            continue
+    for min_index, max_index in parse_index_ranges(ranges_str):
         for i in range(min_index, max_index + 1):
             index_filter.append(str(i))
 
     return ','.join(index_filter)
 
 
+def get_source_quirks(source):
+    """
+    Returns a dictionary of the processing quirks for the given probe
+    `source` (e.g. 'asa', 'meraki').
+    """
+    ret = {}
+    if source == 'asa':
+        ret['fix_zero_protocol'] = True
+    elif source == 'sonicwall':
+        ret['replace_timestamps'] = True
+    elif source == 'meraki':
+        ret['no_aggregation'] = True
+        ret['fix_meraki_counters'] = True
+        ret['replace_timestamps'] = True
+        ret['reverse_directions'] = True
+
+    return ret
+
+
 class IPFIXPusher(Pusher):
     """Combines IPFIX data into 10 minute segments and send them to
     Observable Networks.
@@ -88,6 +119,21 @@ class IPFIXPusher(Pusher):
         index_ranges = environ.get(ENV_IPFIX_INDEX_RANGES, '')
         self.index_filter = get_index_filter(index_ranges)
 
+        # The in-process filter is built when it's first needed
+        self.monitor_nets = monitor_nets.replace(',', ' ').split()
+        self.index_ranges = index_ranges
+        self.flow_filter = None
+        self.inprocess_filter = (
+            environ.get(ENV_IPFIX_INPROCESS_FILTER) == 'true'
+        )
+
+        self.compact_top_k = int(environ.get(ENV_IPFIX_COMPACT_TOP_K, '0'))
+        self.compact_max_rollups = int(
+            environ.get(ENV_IPFIX_COMPACT_MAX_ROLLUPS, DEFAULT_MAX_ROLLUPS)
+        )
+
+        self.merge_bins = environ.get(ENV_IPFIX_MERGE_BINS) == 'true'
+
         environ['SILK_CLOBBER'] = 'true'
         environ['TZ'] = 'Etc/UTC'
 
@@ -115,9 +161,10 @@ class IPFIXPusher(Pusher):
 
         return True
 
-    def _aggregate_silk(self, input_path, output_path):
+    def _aggregate_silk(self, input_paths, output_path):
         # Calls out to rwuniq, which aggregates flows with the same 5-tuple
-        # key; converting the binary SiLK format to text in the process.
+        # key across all of the `input_paths`; converting the binary SiLK
+        # format to text in the process.
         command = [
             RWUNIQ_PATH,
             '--no-titles',
@@ -129,16 +176,16 @@ class IPFIXPusher(Pusher):
             '--fields', 'sIp,dIp,sPort,dPort,protocol',
             '--values', 'Bytes,Packets,sTime-Earliest,eTime-Latest',
             '--output-path', output_path,
-            input_path,
         ]
+        command.extend(input_paths)
         return_code = call(command)
         if return_code:
-            logging.warning('rwuniq error processing %s', input_path)
+            logging.warning('rwuniq error processing %s', input_paths)
             return False
 
         return True
 
-    def _dump_silk(self, input_path, output_path):
+    def _dump_silk(self, input_paths, output_path):
         # Calls out to rwcut, which converts the binary SiLK format to text
         # without doing further processing.
         command = [
@@ -151,11 +198,85 @@ class IPFIXPusher(Pusher):
             '--fields',
             'sIp,dIp,sPort,dPort,protocol,Bytes,Packets,sTime,eTime',
             '--output-path', output_path,
-            input_path,
         ]
+        command.extend(input_paths)
+        return_code = call(command)
+        if return_code:
+            logging.warning('rwcut error processing %s', input_paths)
+            return False
+
+        return True
+
+    def _aggregate_native(self, rows):
+        # The equivalent of rwuniq: sum the counts and find the time bounds
+        # for each 5-tuple.
+        D_flows = {}
+        for row in rows:
+            key = (
+                row['srcaddr'],
+                row['dstaddr'],
+                row['srcport'],
+                row['dstport'],
+                row['protocol'],
+            )
+            bytes_, packets = int(row['bytes']), int(row['packets'])
+            start, end = int(row['start']), int(row['end'])
+            if key not in D_flows:
+                D_flows[key] = [bytes_, packets, start, end]
+                continue
+            flow = D_flows[key]
+            flow[0] += bytes_
+            flow[1] += packets
+            flow[2] = min(flow[2], start)
+            flow[3] = max(flow[3], end)
+
+        for key in sorted(D_flows):
+            yield dict(zip(CSV_HEADER.split(','), key + tuple(D_flows[key])))
+
+    def _read_native(self, input_paths):
+        if self.flow_filter is None:
+            self.flow_filter = FlowFilter(self.monitor_nets, self.index_ranges)
+
+        for input_path in input_paths:
+            with open(input_path, 'rt') as infile:
+                reader = DictReader(infile, fieldnames=NATIVE_FIELDS)
+                yield from self.flow_filter.filter(reader)
+
+    def _process_native(self, input_paths, output_path, quirks):
+        # Files from flow_collector.py are text, so the SiLK tools aren't
+        # needed to filter and aggregate them.
+        rows = self._read_native(input_paths)
+        if not quirks.get('no_aggregation'):
+            rows = self._aggregate_native(rows)
+
+        with open(output_path, 'wt') as outfile:
+            writer = DictWriter(
+                outfile,
+                fieldnames=CSV_HEADER.split(','),
+                lineterminator='\n',
+                extrasaction='ignore',
+            )
+            writer.writerows(rows)
+
+    def _cut_silk_native(self, input_paths, output_path):
+        # Calls out to rwcut to convert the binary SiLK format to the
+        # built-in collector's text format, which includes the interface
+        # indexes for filtering. Times are whole seconds, as in those files.
+        command = [
+            RWCUT_PATH,
+            '--no-titles',
+            '--no-columns',
+            '--no-final-delimiter',
+            '--column-sep', ',',
+            '--timestamp-format', 'epoch,no-msec',
+            '--fields',
+            'sIp,dIp,sPort,dPort,protocol,Bytes,Packets,sTime,eTime,in,out',
+            '--output-path', output_path,
+        ]
+        command.extend(input_paths)
         return_code = call(command)
         if return_code:
-            logging.warning('rwcut error processing %s', input_path)
+            logging.warning('rwcut error processing %s', input_paths)
             return False
 
         return True
@@ -234,26 +355,15 @@ class IPFIXPusher(Pusher):
                 if next_bytes < curr_bytes:
                     yield key_flows[i]
 
-    def _get_quirks(self, input_path):
+    def _get_probe_index(self, input_path):
         # The input_path is like '/path/to/20170428150641_Sindex.000000.tmp'
         # Pull out the index
-        probe_index = basename(input_path).split('.', 1)[0].split('_')[1][1:]
+        return basename(input_path).split('.', 1)[0].split('_')[1][1:]
+
+    def _get_quirks(self, input_path):
+        probe_index = self._get_probe_index(input_path)
         key = 'OBSRVBL_IPFIX_PROBE_{}_SOURCE'.format(probe_index)
-        source = environ.get(key)
-
-        # Set per-source quirks
-        ret = {}
-        if source == 'asa':
-            ret['fix_zero_protocol'] = True
-        elif source == 'sonicwall':
-            ret['replace_timestamps'] = True
-        elif source == 'meraki':
-            ret['no_aggregation'] = True
-            ret['fix_meraki_counters'] = True
-            ret['replace_timestamps'] = True
-            ret['reverse_directions'] = True
-
-        return ret
+        return get_source_quirks(environ.get(key))
 
     def _get_received_datetime(self, file_path):
         file_name = basename(file_path)
@@ -268,49 +378,111 @@ class IPFIXPusher(Pusher):
         in_args = input_path, 'rt'
         out_args = output_path, 'wt'
         fieldnames = CSV_HEADER.split(',')
+        out_fieldnames = fieldnames
+        if self.compact_top_k > 0:
+            out_fieldnames = COMPACT_CSV_HEADER.split(',')
         with open(*in_args) as infile, gz_open(*out_args) as outfile:
             csv_reader = DictReader(infile, fieldnames=fieldnames)
             csv_writer = DictWriter(
-                outfile, fieldnames=fieldnames, lineterminator='\n'
+                outfile, fieldnames=out_fieldnames, lineterminator='\n'
             )
             csv_writer.writeheader()
-            rows = csv_reader
-            # Meraki reports cumulative counts that periodically reset;
-            # filter out the intermediate items
-            if quirks.get('fix_meraki_counters'):
-                rows = self._trim_meraki(rows)
-            # If the timestamps from the NetFlow source are not trustworthy,
-            # replace them with the received time.
-            if quirks.get('replace_timestamps'):
-                rows = (self._change_timestamps(r, ts_received) for r in rows)
-            # If the directions from the NetFlow source are backward,
-            # reverse them
-            if quirks.get('reverse_directions'):
-                rows = (self._swap_directions(r) for r in rows)
-            # If the NetFlow source writes 0 for the protocol, try to fix it
-            if quirks.get('fix_zero_protocol'):
-                rows = self._match_zero_protocol(rows)
-
+            rows = self._apply_quirks(csv_reader, quirks, ts_received)
+            # When the sensor is overloaded, keep only the heavy hitters
+            if self.compact_top_k > 0:
+                compactor = FlowCompactor(
+                    self.compact_top_k, self.compact_max_rollups
+                )
+                rows = compactor.compact(rows)
             csv_writer.writerows(rows)
 
-    def _process_files(self, file_list):
-        for file_path in file_list:
-            quirks = self._get_quirks(file_path)
+    def _apply_quirks(self, rows, quirks, ts_received):
+        # Meraki reports cumulative counts that periodically reset;
+        # filter out the intermediate items
+        if quirks.get('fix_meraki_counters'):
+            rows = self._trim_meraki(rows)
+        # If the timestamps from the NetFlow source are not trustworthy,
+        # replace them with the received time.
+        if quirks.get('replace_timestamps'):
+            rows = (self._change_timestamps(r, ts_received) for r in rows)
+        # If the directions from the NetFlow source are backward,
+        # reverse them
+        if quirks.get('reverse_directions'):
+            rows = (self._swap_directions(r) for r in rows)
+        # If the NetFlow source writes 0 for the protocol, try to fix it
+        if quirks.get('fix_zero_protocol'):
+            rows = self._match_zero_protocol(rows)
+
+        return rows
+
+    def _process_silk(self, group_list, temp_path, quirks):
+        # Filters and aggregates with the SiLK tools
+        for input_path in group_list:
+            copy(input_path, temp_path)
+            self._filter_silk(temp_path, input_path)
+
+        if quirks.get('no_aggregation'):
+            self._dump_silk(group_list, temp_path)
+        else:
+            self._aggregate_silk(group_list, temp_path)
+
+    def _process_cut(self, group_list, temp_path, quirks):
+        # Converts the files with rwcut and filters and aggregates them
+        # in-process. Returns False if rwcut fails.
+        native_path = '{}.native'.format(group_list[0])
+        try:
+            if not self._cut_silk_native(group_list, native_path):
+                return False
+            self._process_native([native_path], temp_path, quirks)
+        finally:
+            if exists(native_path):
+                remove(native_path)
+
+        return True
 
-            file_dir, file_name = split(file_path)
-            temp_path = join(file_dir, '{}.tmp'.format(file_name))
-            copy(file_path, temp_path)
+    def _process_group(self, group_list):
+        # Writes the filtered, aggregated flows from all the files in
+        # `group_list` to the first one, as CSV. The others are removed.
+        file_path = group_list[0]
+        quirks = self._get_quirks(file_path)
+
+        file_dir, file_name = split(file_path)
+        temp_path = join(file_dir, '{}.tmp'.format(file_name))
+
+        if file_path.endswith(NATIVE_SUFFIX):
+            self._process_native(group_list, temp_path, quirks)
+        else:
+            # If rwcut fails, rwfilter and rwuniq get a try
+            is_done = self.inprocess_filter and self._process_cut(
+                group_list, temp_path, quirks
+            )
+            if not is_done:
+                self._process_silk(group_list, temp_path, quirks)
 
-            self._filter_silk(temp_path, file_path)
+        self._silk_to_csv(temp_path, file_path, quirks)
 
-            if quirks.get('no_aggregation'):
-                self._dump_silk(file_path, temp_path)
-            else:
-                self._aggregate_silk(file_path, temp_path)
+        remove(temp_path)
+        for input_path in group_list[1:]:
+            self._remove_file(input_path)
 
-            self._silk_to_csv(temp_path, file_path, quirks)
+    def _process_files(self, file_list):
+        if not self.merge_bins:
+            for file_path in file_list:
+                self._process_group([file_path])
+            return
+
+        # Group the bin's files by probe, so each probe gets one output file.
+        # flowcap's files and the built-in collector's can't be mixed.
+        D_groups = defaultdict(list)
+        for file_path in file_list:
+            key = (
+                self._get_probe_index(file_path),
+                file_path.endswith(NATIVE_SUFFIX),
+            )
+            D_groups[key].append(file_path)
 
-            remove(temp_path)
+        for key in sorted(D_groups):
+            self._process_group(D_groups[key])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# python builtins
+import logging
+import re
+
+from fnmatch import fnmatchcase
+
+
+def _combine(patterns):
+    # Compiles the valid patterns into one alternation, or returns None if
+    # there aren't any. Each pattern is checked in the group it will be
+    # combined in, so global flags like (?i) are caught here.
+    valid = []
+    for pattern in patterns:
+        if not isinstance(pattern, str):
+            logging.error('Ignoring invalid pattern %r', pattern)
+            continue
+        group = b'(?:' + pattern.encode('utf-8') + b')'
+        try:
+            re.compile(group)
+        except re.error as e:
+            logging.error('Ignoring invalid pattern %r: %s', pattern, e)
+            continue
+        valid.append(group)
+
+    if not valid:
+        return None
+
+    return re.compile(b'|'.join(valid))
+
+
+class LineFilter:
+    """
+    Include and exclude rules for log lines. A line is kept if it matches one
+    of the `include` patterns (or there aren't any) and none of the `exclude`
+    patterns.
+
+    Each set of patterns is compiled into a single regular expression, so a
+    line is scanned once per set no matter how many rules there are. Patterns
+    are matched against the raw bytes of each line. Patterns with global
+    flags like (?i) are skipped; use scoped flags like (?i:...) instead.
+    """
+    def __init__(self, include=(), exclude=()):
+        self.include = _combine(include)
+        self.exclude = _combine(exclude)
+
+    def __bool__(self):
+        return (self.include is not None) or (self.exclude is not None)
+
+    def filter(self, lines):
+        """
+        Given a list of lines (as bytes), returns a tuple: the list of lines
+        to keep, and the number of lines that matched at least one pattern.
+        """
+        include = self.include.search if self.include else None
+        exclude = self.exclude.search if self.exclude else None
+
+        kept = []
+        matched = 0
+        for line in lines:
+            is_included = (include is not None) and (include(line) is not None)
+            is_excluded = (exclude is not None) and (exclude(line) is not None)
+            if is_included or is_excluded:
+                matched += 1
+            if is_excluded or ((include is not None) and not is_included):
+                continue
+            kept.append(line)
+
+        return kept, matched
+
+
+def get_line_filter(rules, log_type):
+    """
+    Given `rules`, a dictionary that maps log type patterns (like 'ona-*') to
+    dictionaries with 'include' and 'exclude' lists, returns a LineFilter
+    with every rule that applies to `log_type`. Returns None if there are no
+    such rules. Malformed rules and patterns are skipped, but re.error can
+    still be raised if the valid patterns conflict when combined (e.g. two
+    of them name the same group).
+    """
+    include = []
+    exclude = []
+    for pattern, rule in rules.items():
+        if not fnmatchcase(log_type, pattern):
+            continue
+        if not isinstance(rule, dict):
+            logging.error('Ignoring invalid rule for %s: %r', pattern, rule)
+            continue
+        for key, patterns in (('include', include), ('exclude', exclude)):
+            value = rule.get(key, [])
+            if not isinstance(value, list):
+                logging.error('Ignoring invalid %s list: %r', key, value)
+                continue
+            patterns.extend(value)
+
+    ret = LineFilter(include, exclude)
+    return ret if ret else None
@@ -13,18 +13,44 @@
 # limitations under the License.
 # python builtins
 import logging
+import re
 
-from datetime import timedelta
+from datetime import datetime, timedelta
 from glob import glob
-from gzip import compress as gz_compress
-from os import fstat, fsync, stat
-from os.path import basename, exists, join, splitext
-from subprocess import CalledProcessError, check_output
-from tempfile import NamedTemporaryFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from gzip import GzipFile, open as gz_open
+from os import environ, fstat, fsync, remove, stat, SEEK_END
+from os.path import basename, dirname, exists, getsize, join, splitext
+from shutil import copyfileobj
+from struct import Struct
+from subprocess import CalledProcessError, check_output, DEVNULL, PIPE, Popen
+from tarfile import open as tar_open
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import monotonic, perf_counter, time_ns
+
+# third-party
+from requests import exceptions as requests_exceptions
 
 # local
+from ona_service.inotify import (
+    Inotify,
+    IN_CREATE,
+    IN_DELETE_SELF,
+    IN_MODIFY,
+    IN_MOVE_SELF,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+)
+from ona_service.log_filter import get_line_filter
 from ona_service.service import Service
-from ona_service.utils import CommandOutputFollower, utcnow, utcoffset, get_ip
+from ona_service.utils import (
+    create_dirs,
+    get_ip,
+    persistent_dict,
+    utcnow,
+    utcoffset,
+)
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -33,22 +59,173 @@ DATA_TYPE = 'logs'
 POLL_SECONDS = 10
 SEND_DELTA = timedelta(seconds=60)  # want at least a minute between dumps
 
+ENV_LOG_WATCHER_COMPRESS_LEVEL = 'OBSRVBL_LOG_WATCHER_COMPRESS_LEVEL'
+DEFAULT_LOG_WATCHER_COMPRESS_LEVEL = '6'
+ENV_LOG_WATCHER_STATE_FILE = 'OBSRVBL_LOG_WATCHER_STATE_FILE'
+DEFAULT_LOG_WATCHER_STATE_FILE = '.log-watcher.state'
+ENV_LOG_WATCHER_MAX_MEMORY = 'OBSRVBL_LOG_WATCHER_MAX_MEMORY'
+DEFAULT_LOG_WATCHER_MAX_MEMORY = str(16 * 1024 * 1024)
+ENV_LOG_WATCHER_MAX_DISK = 'OBSRVBL_LOG_WATCHER_MAX_DISK'
+DEFAULT_LOG_WATCHER_MAX_DISK = str(256 * 1024 * 1024)
+ENV_LOG_WATCHER_SPILL_DIR = 'OBSRVBL_LOG_WATCHER_SPILL_DIR'
+DEFAULT_LOG_WATCHER_SPILL_DIR = '.log-watcher-spill'
+SPILL_SUFFIX = '.gz'
+ENV_LOG_WATCHER_INOTIFY = 'OBSRVBL_LOG_WATCHER_INOTIFY'
+ENV_LOG_WATCHER_UPLOAD_THREADS = 'OBSRVBL_LOG_WATCHER_UPLOAD_THREADS'
+DEFAULT_LOG_WATCHER_UPLOAD_THREADS = '0'
+ENV_LOG_WATCHER_BUNDLE = 'OBSRVBL_LOG_WATCHER_BUNDLE'
+BUNDLE_SUFFIX = 'bundle'
+ENV_LOG_WATCHER_FLUSH_BYTES = 'OBSRVBL_LOG_WATCHER_FLUSH_BYTES'
+DEFAULT_LOG_WATCHER_FLUSH_BYTES = str(8 * 1024 * 1024)
+ENV_LOG_WATCHER_FLUSH_LINES = 'OBSRVBL_LOG_WATCHER_FLUSH_LINES'
+DEFAULT_LOG_WATCHER_FLUSH_LINES = '100000'
+ENV_LOG_WATCHER_ADAPTIVE = 'OBSRVBL_LOG_WATCHER_ADAPTIVE'
+ENV_LOG_WATCHER_FILTER = 'OBSRVBL_LOG_WATCHER_FILTER'
+FILTER_DATA_TYPE = 'log-filters'
+FILTER_UPDATE_DELTA = timedelta(seconds=600)
+
+# With the adaptive send interval, aim for uploads of about this size
+TARGET_SEND_BYTES = 1024 * 1024
+MIN_SEND_DELTA = timedelta(seconds=10)
+MAX_SEND_DELTA = timedelta(seconds=600)
+FILE_WATCH_MASK = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+EXPORT_SIZE = Struct('<Q')
+READ_SIZE = 1024 * 1024
+# Journal entries are buffered in batches of about this many bytes
+JOURNAL_BATCH_SIZE = 1024 * 1024
+
+
+def write_compressed(lines, fileobj, compresslevel):
+    """
+    Writes the byte strings in `lines` to `fileobj` as a single gzip member.
+    Returns a dictionary with the input and output sizes, the compression
+    ratio, and the time taken.
+    """
+    start_time = perf_counter()
+    start_pos = fileobj.tell()
+    raw_bytes = 0
+    gz_file = GzipFile(
+        fileobj=fileobj, mode='wb', compresslevel=compresslevel
+    )
+    with gz_file:
+        for line in lines:
+            raw_bytes += gz_file.write(line)
+    compressed_bytes = fileobj.tell() - start_pos
+
+    return {
+        'raw_bytes': raw_bytes,
+        'compressed_bytes': compressed_bytes,
+        'ratio': raw_bytes / compressed_bytes,
+        'seconds': perf_counter() - start_time,
+    }
+
+
+def _get_setting(kwargs, key, env_var, default):
+    return int(kwargs.get(key, environ.get(env_var, default)))
+
 
 class WatchNode:
-    def __init__(self, log_type, api, send_delta=SEND_DELTA):
+    """
+    Collects lines and periodically uploads them. At most `max_memory` bytes
+    are held in memory; beyond that, data is spilled to compressed segments in
+    `spill_dir`. Spilled segments are uploaded oldest first, and are deleted
+    (oldest first) if they use more than `max_disk` bytes.
+
+    Data is sent every `send_delta`, or sooner if `flush_bytes` bytes or
+    `flush_lines` lines are waiting. If `adaptive` is set, the send interval
+    is adjusted after each upload so that uploads are about
+    TARGET_SEND_BYTES: longer for quiet logs and shorter for busy ones.
+
+    If `line_filter` is set, lines it rejects are dropped before they're
+    buffered.
+    """
+    def __init__(self, log_type, api, send_delta=SEND_DELTA, **kwargs):
         """
         Arguments:
             log_type: name to give the log
             api: api for interacting with the proxy
+            compresslevel: gzip level to use for compressed uploads
+            max_memory: bytes to buffer before spilling to disk
+            max_disk: bytes of spilled data to keep
+            spill_dir: directory for spilled data
+            flush_bytes: bytes to buffer before sending early
+            flush_lines: lines to buffer before sending early
+            adaptive: whether to adjust the send interval to the log's volume
         """
         self.log_type = log_type
         self.api = api
         self.checkpoint()
         self.send_delta = send_delta
+        self.compresslevel = _get_setting(
+            kwargs,
+            'compresslevel',
+            ENV_LOG_WATCHER_COMPRESS_LEVEL,
+            DEFAULT_LOG_WATCHER_COMPRESS_LEVEL,
+        )
+        # Stats from the most recent compressed upload
+        self.compression_stats = None
+        # If set, flush_data only collects data
+        self.defer_send = False
+        self.compress = False
+
+        self.max_memory = _get_setting(
+            kwargs,
+            'max_memory',
+            ENV_LOG_WATCHER_MAX_MEMORY,
+            DEFAULT_LOG_WATCHER_MAX_MEMORY,
+        )
+        self.max_disk = _get_setting(
+            kwargs,
+            'max_disk',
+            ENV_LOG_WATCHER_MAX_DISK,
+            DEFAULT_LOG_WATCHER_MAX_DISK,
+        )
+        spill_dir = kwargs.get(
+            'spill_dir',
+            environ.get(
+                ENV_LOG_WATCHER_SPILL_DIR, DEFAULT_LOG_WATCHER_SPILL_DIR
+            ),
+        )
+        self.spill_dir = join(spill_dir, log_type)
+        # Pick up anything that was spilled before a restart
+        self.segments = deque(
+            sorted(glob(join(self.spill_dir, '*{}'.format(SPILL_SUFFIX))))
+        )
+
+        self.flush_bytes = _get_setting(
+            kwargs,
+            'flush_bytes',
+            ENV_LOG_WATCHER_FLUSH_BYTES,
+            DEFAULT_LOG_WATCHER_FLUSH_BYTES,
+        )
+        self.flush_lines = _get_setting(
+            kwargs,
+            'flush_lines',
+            ENV_LOG_WATCHER_FLUSH_LINES,
+            DEFAULT_LOG_WATCHER_FLUSH_LINES,
+        )
+        self.adaptive = kwargs.get(
+            'adaptive',
+            environ.get(ENV_LOG_WATCHER_ADAPTIVE, 'false') == 'true',
+        )
+        # Set when an upload fails, so that the size triggers don't cause a
+        # retry on every check
+        self.send_failed = False
+        # LineFilter to apply before lines are buffered
+        self.line_filter = None
 
     def checkpoint(self, now=None):
         self.data = []
+        self.data_size = 0
         self.last_send = now or utcnow()
+        # Line counts from the filter since the last send
+        self.filter_stats = {'matched': 0, 'dropped': 0}
+
+    def save_position(self):
+        """
+        Called when everything that has been read is either sent or spilled
+        to disk.
+        """
 
     def cleanup(self):
         """
@@ -56,24 +233,33 @@ class WatchNode:
         open.
         """
 
-    def flush_data(self, data, now, compress=False):
-        # Collect data until it's time to send it out
-        self.data.extend(data)
-        if (not self.data) or (now - self.last_send < self.send_delta):
-            return
+    def _spill(self):
+        # Moves the in-memory data to a new segment file
+        create_dirs(self.spill_dir)
+        file_name = '{:020}{}'.format(time_ns(), SPILL_SUFFIX)
+        file_path = join(self.spill_dir, file_name)
+        with open(file_path, 'wb') as f:
+            write_compressed(self.data, f, self.compresslevel)
+        logging.info('Spilled %s bytes to %s', self.data_size, file_path)
+        self.segments.append(file_path)
+        self.data = []
+        self.data_size = 0
 
-        logging.info('Sending data for processing at {}'.format(now))
-        with NamedTemporaryFile('w+b') as f:
-            if compress:
-                f.writelines(gz_compress(line) for line in self.data)
-            else:
-                f.writelines(self.data)
-            f.flush()
-            fsync(f.fileno())
-            remote_path = self.api.send_file(
-                DATA_TYPE, f.name, now, suffix=self.log_type
-            )
+        # Stay under the disk budget by dropping the oldest data
+        sizes = {x: getsize(x) for x in self.segments}
+        disk_size = sum(sizes.values())
+        while disk_size > self.max_disk:
+            old_path = self.segments.popleft()
+            logging.error('Disk budget exceeded, dropping %s', old_path)
+            remove(old_path)
+            disk_size -= sizes[old_path]
 
+        self.save_position()
+
+    def _send(self, file_path, now):
+        remote_path = self.api.send_file(
+            DATA_TYPE, file_path, now, suffix=self.log_type
+        )
         if remote_path is not None:
             data = {
                 'path': remote_path,
@@ -81,9 +267,152 @@ class WatchNode:
                 'utcoffset': utcoffset(),
                 'ip': get_ip(),
             }
+            if self.line_filter is not None:
+                data['filter_stats'] = self.filter_stats.copy()
             self.api.send_signal(DATA_TYPE, data)
 
+    def _send_segment(self, segment_path, now, compress):
+        if compress:
+            self._send(segment_path, now)
+            return
+
+        with NamedTemporaryFile('w+b') as f, gz_open(segment_path) as g:
+            copyfileobj(g, f)
+            f.flush()
+            fsync(f.fileno())
+            self._send(f.name, now)
+
+    def _send_data(self, now, compress):
+        with NamedTemporaryFile('w+b') as f:
+            if compress:
+                stats = write_compressed(self.data, f, self.compresslevel)
+                logging.info(
+                    'Compressed %s bytes to %s (%.1fx) in %.3f seconds',
+                    stats['raw_bytes'],
+                    stats['compressed_bytes'],
+                    stats['ratio'],
+                    stats['seconds'],
+                )
+                self.compression_stats = stats
+            else:
+                f.writelines(self.data)
+            f.flush()
+            fsync(f.fileno())
+            self._send(f.name, now)
+
+    def _filter(self, data):
+        kept, matched = self.line_filter.filter(data)
+        self.filter_stats['matched'] += matched
+        self.filter_stats['dropped'] += len(data) - len(kept)
+        return kept
+
+    def flush_data(self, data, now, compress=False):
+        if self.line_filter is not None:
+            data = self._filter(data)
+
+        # Collect data until it's time to send it out
+        self.data.extend(data)
+        self.data_size += sum(len(x) for x in data)
+        self.compress = compress
+        if self.data_size > self.max_memory:
+            self._spill()
+
+        # The caller will use send_data to send it out
+        if self.defer_send:
+            return
+
+        self.send_data(now)
+
+    def is_due(self, now):
+        """
+        Returns True if there's data to send and it's time to send it.
+        """
+        if not (self.data or self.segments):
+            return False
+
+        if (not self.send_failed) and self.is_full():
+            return True
+
+        return now - self.last_send >= self.send_delta
+
+    def is_full(self):
+        """
+        Returns True if enough data is buffered to send it early.
+        """
+        return (
+            (self.data_size >= self.flush_bytes) or
+            (len(self.data) >= self.flush_lines)
+        )
+
+    def write_pending(self, fileobj):
+        """
+        Writes all of the data waiting to be sent to `fileobj` as gzip data,
+        spilled data first.
+        """
+        for segment_path in self.segments:
+            with open(segment_path, 'rb') as infile:
+                copyfileobj(infile, fileobj)
+        if self.data:
+            write_compressed(self.data, fileobj, self.compresslevel)
+
+    def pending_sent(self, now):
+        """
+        Clears the data that was written by `write_pending`, once it's been
+        sent.
+        """
+        while self.segments:
+            remove(self.segments.popleft())
+        self.send_failed = False
         self.checkpoint(now)
+        self.save_position()
+
+    def _adapt(self, sent_bytes, now):
+        # Picks the interval that would have made this upload about
+        # TARGET_SEND_BYTES, within limits
+        seconds = max((now - self.last_send).total_seconds(), 1)
+        target_seconds = TARGET_SEND_BYTES * seconds / max(sent_bytes, 1)
+        self.send_delta = min(
+            max(timedelta(seconds=target_seconds), MIN_SEND_DELTA),
+            MAX_SEND_DELTA,
+        )
+
+    def send_data(self, now):
+        """
+        Sends out the buffered data, if it's time.
+        """
+        if not self.is_due(now):
+            return
+
+        logging.info('Sending data for processing at {}'.format(now))
+        if self.line_filter is not None:
+            logging.info(
+                'Filter for %s matched %s lines and dropped %s',
+                self.log_type,
+                self.filter_stats['matched'],
+                self.filter_stats['dropped'],
+            )
+        sent_bytes = self.data_size
+        try:
+            # Spilled data goes out first, oldest first
+            while self.segments:
+                # Spilled data counts at its compressed size
+                sent_bytes += getsize(self.segments[0])
+                self._send_segment(self.segments[0], now, self.compress)
+                remove(self.segments.popleft())
+            if self.data:
+                self._send_data(now, self.compress)
+        except requests_exceptions.RequestException as e:
+            # Hold on to the data and try again after the next interval
+            logging.error('Could not send %s data: %s', self.log_type, e)
+            self.last_send = now
+            self.send_failed = True
+            return
+
+        if self.adaptive:
+            self._adapt(sent_bytes, now)
+        self.send_failed = False
+        self.checkpoint(now)
+        self.save_position()
 
     def check_data(self, now=None):
         raise NotImplementedError()
@@ -92,6 +421,10 @@ class WatchNode:
 class LogNode(WatchNode):
     """
     Object to handle reading of a log file.
+
+    If a `state` dictionary is given, the (inode, offset) of the data that has
+    been sent is saved there under the log's path. On startup, reading resumes
+    from that point, so nothing is skipped or sent twice across restarts.
     """
     def __init__(self, log_type, api, log_path, **kwargs):
         """
@@ -99,23 +432,26 @@ class LogNode(WatchNode):
             log_path: location of the log file
             log_type: name to give the log
             api: api for interacting with the proxy
+            state: optional dictionary for saving read positions
+            seek_to_end: if there's no saved position, whether to skip what's
+              already in the file (the default) or read it all
         """
         self.encoding = kwargs.pop('encoding', 'utf-8')
         self.errors = kwargs.pop('errors', 'ignore')
+        self.state = kwargs.pop('state', None)
+        seek_to_end = kwargs.pop('seek_to_end', True)
         self.log_path = log_path
         self.log_file = None
         self.log_file_inode = None
-        self._set_fd(seek_to_end=True)
+        self.position = None
+        # (inode, offset) of a rotated file whose end hasn't been read yet
+        self.rotated = None
+        self._resume(seek_to_end)
         super().__init__(log_type, api)
 
     def _set_fd(self, seek_to_end=False):
         try:
-            self.log_file = open(
-                self.log_path,
-                mode='rt',
-                encoding=self.encoding,
-                errors=self.errors,
-            )
+            self.log_file = open(self.log_path, mode='rb')
         except OSError as err:
             logging.error('Could not open %s: %s', self.log_path, err)
             return
@@ -123,11 +459,69 @@ class LogNode(WatchNode):
         # Get the inode for the open file
         self.log_file_inode = fstat(self.log_file.fileno()).st_ino
 
-        # Read the the end of the last line of the file
+        # Skip to the end of the file
         if seek_to_end:
-            line_count = sum(1 for line in self.log_file)
-            msg = 'Scraping from %s - skipped %s lines'
-            logging.info(msg, self.log_path, line_count)
+            offset = self.log_file.seek(0, SEEK_END)
+            msg = 'Scraping from %s - skipped %s bytes'
+            logging.info(msg, self.log_path, offset)
+
+        self.position = (self.log_file_inode, self.log_file.tell())
+
+    def _find_rotated(self, inode):
+        # Look for the file with the given inode among the log's rotated
+        # siblings, e.g. auth.log.1
+        for file_path in glob('{}.*'.format(self.log_path)):
+            try:
+                if stat(file_path).st_ino == inode:
+                    return file_path
+            except OSError:
+                continue
+
+        return None
+
+    def _read_rotated(self, now):
+        inode, offset = self.rotated
+        self.rotated = None
+        file_path = self._find_rotated(inode)
+        if file_path is None:
+            logging.warning('Could not find rotated %s', self.log_path)
+            return
+
+        logging.info('Reading the rest of %s from %s', file_path, offset)
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            self._read_lines(f, inode, now)
+
+    def _resume(self, seek_to_end=True):
+        # The end of a file that was rotated away is read by the first check
+        saved = None if (self.state is None) else self.state.get(self.log_path)
+        if saved is None:
+            self._set_fd(seek_to_end=seek_to_end)
+            return
+
+        self._set_fd()
+        if self.log_file is None:
+            return
+
+        saved_inode, saved_offset = saved
+        # Same file, so pick up where we left off. If it was truncated, start
+        # from the beginning.
+        if saved_inode == self.log_file_inode:
+            if saved_offset <= fstat(self.log_file.fileno()).st_size:
+                self.log_file.seek(saved_offset)
+        # The file was rotated while we were away. Send the end of the old
+        # one along with the new one.
+        else:
+            self.rotated = (saved_inode, saved_offset)
+
+        self.position = (self.log_file_inode, self.log_file.tell())
+        logging.info(
+            'Scraping from %s - resumed at %s', self.log_path, self.position[1]
+        )
+
+    def save_position(self):
+        if (self.state is not None) and (self.position is not None):
+            self.state[self.log_path] = list(self.position)
 
     def cleanup(self):
         try:
@@ -137,7 +531,29 @@ class LogNode(WatchNode):
         self.log_file = None
         self.log_file_inode = None
 
+    def _decode_lines(self, lines):
+        return [
+            x.decode(self.encoding, errors=self.errors).encode(
+                self.encoding, errors=self.errors
+            )
+            for x in lines
+        ]
+
+    def _read_lines(self, f, inode, now):
+        # Hands the lines from `f` over in chunks of about READ_SIZE bytes, so
+        # a large backlog can be spilled rather than held in memory. The
+        # position is updated first so that a spill saves the right one.
+        while True:
+            lines = f.readlines(READ_SIZE)
+            self.position = (inode, f.tell())
+            self.flush_data(self._decode_lines(lines), now, compress=True)
+            if not lines:
+                break
+
     def check_data(self, now=None):
+        if self.rotated is not None:
+            self._read_rotated(now)
+
         # Log was reset - read from the beginning
         if self.log_file is None:
             self._set_fd(seek_to_end=False)
@@ -147,55 +563,147 @@ class LogNode(WatchNode):
             return
 
         # Retrieve line-buffered data from the log
-        data = self.log_file.readlines()
-        data = [x.encode(self.encoding, errors=self.errors) for x in data]
-        self.flush_data(data, now, compress=True)
+        self._read_lines(self.log_file, self.log_file_inode, now)
 
         # Check to see if the inode associated with the log path has changed.
         # If it has, reload.
         try:
-            inode = stat(self.log_path).st_ino
+            st = stat(self.log_path)
         except OSError:
             self.cleanup()
             return
 
-        if inode != self.log_file_inode:
+        if st.st_ino != self.log_file_inode:
             self.cleanup()
+        # The file was truncated in place - start over from the beginning
+        elif st.st_size < self.position[1]:
+            self.log_file.seek(0)
+            self.position = (self.log_file_inode, 0)
+
+
+def parse_export(fileobj):
+    """
+    Yields a dictionary for each entry in the journal export format stream
+    `fileobj`. Keys are field names and values are bytes.
+    """
+    entry = {}
+    for line in iter(fileobj.readline, b''):
+        # A blank line ends the entry
+        if line == b'\n':
+            if entry:
+                yield entry
+            entry = {}
+            continue
+
+        key, sep, value = line.rstrip(b'\n').partition(b'=')
+        # Binary-safe fields: the name, then a 64-bit little-endian length,
+        # the data, and a newline
+        if not sep:
+            size, = EXPORT_SIZE.unpack(fileobj.read(EXPORT_SIZE.size))
+            value = fileobj.read(size)
+            fileobj.read(1)
+        entry[key.decode('ascii', errors='ignore')] = value
+
+    if entry:
+        yield entry
+
+
+def format_entry(entry):
+    """
+    Given a journal entry from `parse_export`, returns a syslog-style line
+    like the one journalctl prints by default.
+    """
+    usec = int(entry.get('__REALTIME_TIMESTAMP', b'0'))
+    dt = datetime.fromtimestamp(usec / 1000000)
+    identifier = entry.get('SYSLOG_IDENTIFIER') or entry.get('_COMM', b'')
+    pid = entry.get('SYSLOG_PID') or entry.get('_PID')
+    if pid:
+        identifier = identifier + b'[' + pid + b']'
+
+    return b' '.join(
+        [
+            dt.strftime('%b %d %H:%M:%S').encode('ascii'),
+            entry.get('_HOSTNAME', b''),
+            identifier + b':',
+            entry.get('MESSAGE', b''),
+        ]
+    ) + b'\n'
 
 
 class SystemdJournalNode(WatchNode):
-    def __init__(self, log_type, api, journalctl_args):
+    """
+    Reads new journal entries on each check, buffering them in batches of
+    about JOURNAL_BATCH_SIZE bytes. The journal cursor of the data that has
+    been sent is saved in the `state` dictionary, so reading resumes from the
+    same place after a restart.
+    """
+    def __init__(self, log_type, api, journalctl_args, state=None):
         """
         Arguments:
             log_type: name to give the log
             api: api for interacting with the proxy
             journalctl_args: a sequence of arguments to pass to journalctl,
               for example: ['--unit=ssh.service', 'SYSLOG_FACILITY=10']
+            state: optional dictionary for saving the journal cursor
         """
         self.unit_name = log_type
+        self.journalctl_args = journalctl_args
+        self.state = state
+        self.state_key = 'journal:{}'.format(log_type)
+        self.cursor = None if (state is None) else state.get(self.state_key)
         super().__init__(log_type, api)
 
-        self.command_args = ['journalctl', '-f', '--lines=1'] + journalctl_args
-        self._start_follower()
+    def _command_args(self):
+        command_args = ['journalctl', '--no-pager', '--output=export']
+        # With no cursor, start from the most recent entry
+        if self.cursor is None:
+            command_args.append('--lines=1')
+        else:
+            command_args.append('--after-cursor={}'.format(self.cursor))
+        return command_args + self.journalctl_args
 
-    def cleanup(self):
-        self.follower.cleanup()
+    def read_entries(self):
+        """
+        Yields the journal entries after the current cursor, advancing it.
+        """
+        command_args = self._command_args()
+        start_cursor = self.cursor
+        with Popen(
+            command_args, stdout=PIPE, stderr=DEVNULL, bufsize=READ_SIZE
+        ) as process:
+            for entry in parse_export(process.stdout):
+                cursor = entry.get('__CURSOR')
+                if cursor is not None:
+                    self.cursor = cursor.decode('ascii')
+                yield entry
+            returncode = process.wait()
 
-    def _start_follower(self):
-        self.follower = CommandOutputFollower(self.command_args)
-        self.follower.start_process()
+        # If the cursor is no good (e.g. the journal was vacuumed), start
+        # over from the most recent entry.
+        if returncode and (self.cursor == start_cursor):
+            logging.warning('journalctl failed with cursor %s', start_cursor)
+            self.cursor = None
 
-    def check_data(self, now):
-        if not self.follower.check_process():
-            self.cleanup()
-            self._start_follower()
+    def save_position(self):
+        if (self.state is not None) and (self.cursor is not None):
+            self.state[self.state_key] = self.cursor
 
+    def check_data(self, now):
+        # Entries are handed over in batches, so a large backlog can be
+        # spilled to disk rather than held in memory
         data = []
-        while True:
-            line = self.follower.read_line(0.1)
-            if line is None:
-                break
-            data.append(line)
+        data_size = 0
+        try:
+            for entry in self.read_entries():
+                line = format_entry(entry)
+                data.append(line)
+                data_size += len(line)
+                if data_size >= JOURNAL_BATCH_SIZE:
+                    self.flush_data(data, now, compress=True)
+                    data = []
+                    data_size = 0
+        except OSError as e:
+            logging.error('Could not read the journal: %s', e)
 
         self.flush_data(data, now, compress=True)
 
@@ -204,36 +712,391 @@ class LogWatcher(Service):
     """
     Watches a set of log files for changes and periodically pushes them to
     S3.
+
+    By default every log is checked every `poll_seconds`. With inotify
+    enabled, log files are read as soon as they change, and new files in the
+    `log_dirs` directories are picked up as they appear.
+
+    With upload threads enabled, logs are uploaded in the background by a
+    bounded pool, so a slow upload doesn't hold up reading the other logs.
+    A log isn't read while its own upload is in progress.
+
+    With bundling enabled, all of the logs' data is sent together in one
+    archive (with one entry per log type) and one signal.
+
+    With filtering enabled, include and exclude rules are retrieved from the
+    service every FILTER_UPDATE_DELTA, and lines are filtered before they're
+    buffered for upload. The rules map log type patterns to lists of
+    regular expressions, e.g.:
+        {"ona-*": {"exclude": [" - INFO - "]}}
     """
 
     def __init__(self, *args, **kwargs):
         self.logs = kwargs.pop('logs', {})
         self.journals = kwargs.pop('journals', {})
+        # Sequence of (logdir, prefix, extension) to watch for new logs
+        self.log_dirs = kwargs.pop('log_dirs', [])
         kwargs.update({
             'poll_seconds': POLL_SECONDS,
         })
         super().__init__(*args, **kwargs)
         self.log_nodes = []
+        self.use_inotify = (
+            environ.get(ENV_LOG_WATCHER_INOTIFY, 'false') == 'true'
+        )
+        upload_threads = int(
+            environ.get(
+                ENV_LOG_WATCHER_UPLOAD_THREADS,
+                DEFAULT_LOG_WATCHER_UPLOAD_THREADS,
+            )
+        )
+        self.executor = None
+        if upload_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=upload_threads)
+        # LogNode -> Future for its upload
+        self.uploads = {}
+        self.bundle = environ.get(ENV_LOG_WATCHER_BUNDLE, 'false') == 'true'
+        self.bundle_last_send = utcnow()
+        self.bundle_failed = False
+        # Nodes with changes that weren't read because they were busy
+        self.skipped = set()
+        self.use_filter = (
+            environ.get(ENV_LOG_WATCHER_FILTER, 'false') == 'true'
+        )
+        self.filter_rules = {}
+        self.filter_last_update = None
 
         # File-based logs
+        state_file = environ.get(
+            ENV_LOG_WATCHER_STATE_FILE, DEFAULT_LOG_WATCHER_STATE_FILE
+        )
+        self.state = persistent_dict(state_file)
         for name, path in self.logs.items():
-            node = LogNode(log_type=name, api=self.api, log_path=path)
-            self.log_nodes.append(node)
+            node = LogNode(
+                log_type=name, api=self.api, log_path=path, state=self.state
+            )
+            self._add_node(node)
 
         # systemd journals
         for name, args in self.journals.items():
             node = SystemdJournalNode(
-                log_type=name, api=self.api, journalctl_args=args
+                log_type=name,
+                api=self.api,
+                journalctl_args=args,
+                state=self.state,
             )
-            self.log_nodes.append(node)
+            self._add_node(node)
+
+        # inotify state: watch descriptor -> LogNode or directory, and
+        # LogNode -> (watch descriptor, inode)
+        self.inotify = None
+        self.file_watches = {}
+        self.dir_watches = {}
+        self.node_watches = {}
+
+    def _add_node(self, node):
+        node.defer_send = self.bundle or (self.executor is not None)
+        if self.use_filter:
+            node.line_filter = get_line_filter(
+                self.filter_rules, node.log_type
+            )
+        self.log_nodes.append(node)
+
+    def update_filters(self, now=None):
+        """
+        Retrieves the filter rules from the service, if it's time. The
+        previous rules stay in place if they can't be retrieved.
+        """
+        now = now or utcnow()
+        if not self.use_filter:
+            return
+        if (
+            (self.filter_last_update is not None) and
+            (now - self.filter_last_update < FILTER_UPDATE_DELTA)
+        ):
+            return
+        self.filter_last_update = now
+
+        try:
+            rules = self.api.get_data(FILTER_DATA_TYPE).json()
+        except (requests_exceptions.RequestException, ValueError) as e:
+            logging.error('Could not retrieve filter rules: %s', e)
+            return
+        if not isinstance(rules, dict) or ('error' in rules):
+            logging.error('Invalid filter rules: %s', rules)
+            return
+
+        # Nothing changes unless every node's filter can be built
+        try:
+            line_filters = [
+                get_line_filter(rules, node.log_type)
+                for node in self.log_nodes
+            ]
+        except (re.error, TypeError, ValueError) as e:
+            logging.error('Could not apply filter rules: %s', e)
+            return
+
+        self.filter_rules = rules
+        for node, line_filter in zip(self.log_nodes, line_filters):
+            node.line_filter = line_filter
 
     def clean_all(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
         for node in self.log_nodes:
             node.cleanup()
 
+    def _is_busy(self, node):
+        # Returns True if the node's upload is still in progress
+        future = self.uploads.get(node)
+        if future is None:
+            return False
+        if not future.done():
+            return True
+
+        del self.uploads[node]
+        if (not future.cancelled()) and (future.exception() is not None):
+            logging.error(
+                'Error sending %s data: %s', node.log_type, future.exception()
+            )
+        return False
+
+    def _send(self, node, now):
+        if self.bundle:
+            return
+        if self.executor is None:
+            node.send_data(now)
+        elif node.is_due(now):
+            self.uploads[node] = self.executor.submit(node.send_data, now)
+
     def execute(self, now=None):
+        self.update_filters(now)
         for node in self.log_nodes:
+            if self._is_busy(node):
+                continue
             node.check_data(now)
+            self._send(node, now)
+
+        if self.bundle:
+            self.send_bundle(now)
+
+    def _bundle_is_due(self, nodes, now):
+        if not nodes:
+            return False
+        if (not self.bundle_failed) and any(x.is_full() for x in nodes):
+            return True
+        return now - self.bundle_last_send >= SEND_DELTA
+
+    def _archive_bundle(self, nodes, archive_path):
+        with TemporaryDirectory() as temp_dir:
+            with tar_open(archive_path, mode='w') as tarball:
+                for node in nodes:
+                    file_name = '{}.gz'.format(node.log_type)
+                    file_path = join(temp_dir, file_name)
+                    with open(file_path, 'wb') as f:
+                        node.write_pending(f)
+                    tarball.add(file_path, arcname=file_name)
+
+    def send_bundle(self, now):
+        """
+        Sends all of the logs' pending data in one archive, if it's time.
+        """
+        nodes = [x for x in self.log_nodes if x.data or x.segments]
+        if not self._bundle_is_due(nodes, now):
+            return
+
+        log_types = [x.log_type for x in nodes]
+        logging.info('Sending bundle of %s at %s', log_types, now)
+        try:
+            with NamedTemporaryFile('w+b') as f:
+                self._archive_bundle(nodes, f.name)
+                remote_path = self.api.send_file(
+                    DATA_TYPE, f.name, now, suffix=BUNDLE_SUFFIX
+                )
+            if remote_path is not None:
+                data = {
+                    'path': remote_path,
+                    'log_type': BUNDLE_SUFFIX,
+                    'log_types': log_types,
+                    'utcoffset': utcoffset(),
+                    'ip': get_ip(),
+                }
+                filter_stats = {
+                    x.log_type: x.filter_stats.copy()
+                    for x in nodes if x.line_filter is not None
+                }
+                if filter_stats:
+                    data['filter_stats'] = filter_stats
+                self.api.send_signal(DATA_TYPE, data)
+        except requests_exceptions.RequestException as e:
+            # Hold on to the data and try again after the next interval
+            logging.error('Could not send bundle: %s', e)
+            self.bundle_last_send = now
+            self.bundle_failed = True
+            return
+
+        for node in nodes:
+            node.pending_sent(now)
+        self.bundle_last_send = now
+        self.bundle_failed = False
+
+    def run(self):
+        if not self.use_inotify:
+            return super().run()
+
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logging.warning('inotify is not available (%s), polling', e)
+            return super().run()
+
+        with self.inotify:
+            self._run_inotify()
+
+    def _run_inotify(self):
+        for node in self.log_nodes:
+            if isinstance(node, LogNode):
+                self._watch_node(node)
+        for logdir, __, __ in self.log_dirs:
+            self._watch_dir(logdir)
+
+        next_tick = monotonic()
+        while not self.stop_event.is_set():
+            timeout = max(0, next_tick - monotonic())
+            events = self.inotify.read_events(timeout)
+            now = utcnow()
+            try:
+                self.handle_events(events, now)
+                if monotonic() >= next_tick:
+                    self.tick(now)
+                    next_tick = monotonic() + self.poll_seconds
+            except requests_exceptions.RequestException as e:
+                logging.exception('persistent communication problem: %s', e)
+
+        logging.info('Service stopped')
+
+    def _watch_dir(self, logdir):
+        try:
+            wd = self.inotify.add_watch(logdir, IN_CREATE | IN_MOVED_TO)
+        except OSError as e:
+            logging.error('Could not watch %s: %s', logdir, e)
+            return
+        self.dir_watches[wd] = logdir
+
+    def _watch_node(self, node):
+        # Watch the directory for the file being (re-)created, and the file
+        # itself for writes and rotation.
+        self._watch_dir(dirname(node.log_path))
+        self._sync_watch(node)
+
+    def _sync_watch(self, node):
+        # Make sure the watch is on the file that the node has open
+        old_wd, old_inode = self.node_watches.get(node, (None, None))
+        if (old_wd is not None) and (old_inode == node.log_file_inode):
+            return
+
+        if old_wd is not None:
+            del self.node_watches[node]
+            self.file_watches.pop(old_wd, None)
+            try:
+                self.inotify.remove_watch(old_wd)
+            except OSError:
+                pass
+
+        if node.log_file is None:
+            return
+
+        try:
+            wd = self.inotify.add_watch(node.log_path, FILE_WATCH_MASK)
+        except OSError:
+            return
+        self.file_watches[wd] = node
+        self.node_watches[node] = (wd, node.log_file_inode)
+
+    def _is_new_log(self, logdir, name):
+        for watch_dir, prefix, extension in self.log_dirs:
+            if watch_dir != logdir:
+                continue
+            if name.startswith(prefix) and name.endswith(extension):
+                return True
+
+        return False
+
+    def _handle_dir_event(self, logdir, name):
+        # Returns the node for a file that appeared in the directory, if any
+        file_path = join(logdir, name)
+        for node in self.log_nodes:
+            if getattr(node, 'log_path', None) == file_path:
+                return node
+
+        if not self._is_new_log(logdir, name):
+            return None
+
+        # A new log - read it from the beginning
+        logging.info('Found new log %s', file_path)
+        log_type, __ = splitext(name)
+        node = LogNode(
+            log_type=log_type,
+            api=self.api,
+            log_path=file_path,
+            state=self.state,
+            seek_to_end=False,
+        )
+        self._add_node(node)
+        return node
+
+    def handle_events(self, events, now):
+        """
+        Reads from the logs affected by the inotify `events`.
+        """
+        touched = {}
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, checking all logs')
+                touched.update(
+                    (x, None) for x in self.log_nodes if isinstance(x, LogNode)
+                )
+            elif event.wd in self.file_watches:
+                touched[self.file_watches[event.wd]] = None
+            elif event.wd in self.dir_watches:
+                logdir = self.dir_watches[event.wd]
+                node = self._handle_dir_event(logdir, event.name)
+                if node is not None:
+                    touched[node] = None
+
+        for node in touched:
+            if self._is_busy(node):
+                self.skipped.add(node)
+                continue
+            self._read_log(node, now)
+
+    def _read_log(self, node, now):
+        node.check_data(now)
+        # If the log was rotated, start on its replacement right away
+        if (node.log_file is None) and exists(node.log_path):
+            node.check_data(now)
+        self._sync_watch(node)
+        self._send(node, now)
+
+    def tick(self, now):
+        """
+        Sends out log data that's due, and checks the journals.
+        """
+        self.update_filters(now)
+        for node in self.log_nodes:
+            if self._is_busy(node):
+                continue
+            if not isinstance(node, LogNode):
+                node.check_data(now)
+                self._send(node, now)
+            elif (node.log_file is None) or (node in self.skipped):
+                self.skipped.discard(node)
+                self._read_log(node, now)
+            else:
+                self._send(node, now)
+
+        if self.bundle:
+            self.send_bundle(now)
 
 
 def directory_logs(logdir, prefix, extension='.log'):
@@ -273,11 +1136,14 @@ if __name__ == '__main__':
         journals.update({'auth.log': ['SYSLOG_FACILITY=10']})
 
     # Monitor the Observable ONA service logs
-    logs.update(directory_logs('/opt/obsrvbl-ona/logs/ona_service', 'ona-'))
+    log_dirs = [('/opt/obsrvbl-ona/logs/ona_service', 'ona-', '.log')]
+    for logdir, prefix, extension in log_dirs:
+        logs.update(directory_logs(logdir, prefix, extension))
 
     watcher = LogWatcher(
         logs=logs,
         journals=journals,
+        log_dirs=log_dirs,
     )
     try:
         watcher.run()
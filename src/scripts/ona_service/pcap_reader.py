@@ -0,0 +1,170 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Memory-mapped reader for the pcap files that tcpdump writes. Packets are
+returned as memoryview slices of the mapped file, so nothing is copied
+until it's needed.
+"""
+# python builtins
+import mmap
+
+from collections import namedtuple
+from struct import error as struct_error, Struct
+
+# Magic numbers for microsecond and nanosecond timestamps
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+FILE_HEADER_SIZE = 24
+
+# Link types from <pcap/dlt.h>
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+VLAN_ETHERTYPES = {0x8100, 0x88a8, 0x9100}
+IPPROTO_UDP = 17
+
+UINT16 = Struct('!H')
+UDP_HEADER = Struct('!HHHH')
+
+UdpPacket = namedtuple(
+    'UdpPacket', ['ts', 'src', 'dst', 'sport', 'dport', 'payload']
+)
+
+
+def iter_packets(file_path):
+    """
+    Yields (timestamp, link type, frame) for each of the packets in the pcap
+    file at `file_path`. Frames are memoryview slices of the mapped file,
+    and are only valid while the generator is running. Empty and truncated
+    files are read as far as they go; other formats raise ValueError.
+    """
+    with open(file_path, 'rb') as infile:
+        try:
+            mm = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return
+
+    view = memoryview(mm)
+    try:
+        yield from _iter_records(view)
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # Frames are still referenced; the map is closed when they're gone
+            pass
+
+
+def _iter_records(view):
+    if len(view) < FILE_HEADER_SIZE:
+        return
+
+    for endian in '<>':
+        magic = Struct(endian + 'I').unpack_from(view)[0]
+        if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            break
+    else:
+        raise ValueError('Not a pcap file')
+    divisor = 1e9 if (magic == PCAP_MAGIC_NS) else 1e6
+    linktype = Struct(endian + 'I').unpack_from(view, 20)[0] & 0x0fffffff
+
+    record_header = Struct(endian + 'IIII')
+    offset = FILE_HEADER_SIZE
+    end = len(view)
+    while offset + record_header.size <= end:
+        ts_sec, ts_frac, incl_len, __ = record_header.unpack_from(view, offset)
+        offset += record_header.size
+        if offset + incl_len > end:
+            break
+        frame = view[offset:offset + incl_len]
+        yield ts_sec + ts_frac / divisor, linktype, frame
+        offset += incl_len
+
+
+def _get_ethertype(linktype, frame):
+    # Returns (ethertype, offset of the network header) for a frame, or
+    # (None, None) if it's of an unknown type
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = UINT16.unpack_from(frame, offset)[0]
+        while ethertype in VLAN_ETHERTYPES:
+            offset += 4
+            ethertype = UINT16.unpack_from(frame, offset)[0]
+        return ethertype, offset + 2
+    if linktype == LINKTYPE_LINUX_SLL:
+        return UINT16.unpack_from(frame, 14)[0], 16
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return UINT16.unpack_from(frame, 0)[0], 20
+    if linktype == LINKTYPE_NULL:
+        return None, 4
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return None, 0
+    return None, None
+
+
+def _get_udp(frame, offset):
+    # Returns (src, dst, offset of the UDP header) for an IP packet carrying
+    # UDP, or None for anything else
+    version = frame[offset] >> 4
+    if version == 4:
+        ihl = (frame[offset] & 0x0f) * 4
+        # Skip non-UDP packets and fragments after the first
+        if frame[offset + 9] != IPPROTO_UDP:
+            return None
+        if UINT16.unpack_from(frame, offset + 6)[0] & 0x1fff:
+            return None
+        src = bytes(frame[offset + 12:offset + 16])
+        dst = bytes(frame[offset + 16:offset + 20])
+        return src, dst, offset + ihl
+    if version == 6:
+        if frame[offset + 6] != IPPROTO_UDP:
+            return None
+        src = bytes(frame[offset + 8:offset + 24])
+        dst = bytes(frame[offset + 24:offset + 40])
+        return src, dst, offset + 40
+    return None
+
+
+def iter_udp(file_path):
+    """
+    Yields a UdpPacket for each of the UDP packets (over IPv4 or IPv6) in the
+    pcap file at `file_path`. Addresses are packed bytes, and payloads are
+    memoryview slices (see iter_packets). Packets that are truncated or of
+    unknown link types are skipped.
+    """
+    for ts, linktype, frame in iter_packets(file_path):
+        try:
+            ethertype, offset = _get_ethertype(linktype, frame)
+            if offset is None:
+                continue
+            if ethertype not in (None, ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+                continue
+            udp = _get_udp(frame, offset)
+            if udp is None:
+                continue
+            src, dst, offset = udp
+            sport, dport, length, __ = UDP_HEADER.unpack_from(frame, offset)
+        except (IndexError, struct_error):
+            continue
+        payload = frame[offset + UDP_HEADER.size:offset + max(length, 8)]
+        yield UdpPacket(ts, src, dst, sport, dport, payload)
@@ -12,13 +12,157 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # python builtins
-from os import getenv
+import json
+import logging
+import socket
+
+from glob import iglob
+from gzip import open as gz_open
+from os import getenv, remove, rename
+from os.path import join
+from sys import intern
 
 # local
-from ona_service.tcpdump_pusher import TcpdumpPusher
+from ona_service.dns_decoder import decode_response
+from ona_service.pcap_reader import iter_udp
+from ona_service.tcpdump_pusher import TcpdumpPusher, TEMP_SUFFIX
+from ona_service.utils import utcnow
 
 ENV_PDNS_PCAP_DIR = 'OBSRVBL_PDNS_PCAP_DIR'
 DEFAULT_PDNS_PCAP_DIR = './logs'
+# Set to "jsonl", "columnar" or "aggregate" to upload DNS records instead of
+# pcaps
+ENV_PDNS_FORMAT = 'OBSRVBL_PDNS_FORMAT'
+DEFAULT_PDNS_FORMAT = 'pcap'
+# Length of the windows that the "aggregate" format summarizes
+ENV_PDNS_WINDOW_SECONDS = 'OBSRVBL_PDNS_WINDOW_SECONDS'
+DEFAULT_PDNS_WINDOW_SECONDS = '600'
+# Set to "true" to upload the pcaps along with the records
+ENV_PDNS_KEEP_PCAP = 'OBSRVBL_PDNS_KEEP_PCAP'
+# In streaming mode, kept pcaps are renamed with this once their records
+# have been extracted
+KEPT_SUFFIX = '.kept'
+
+DNS_PORT = 53
+RECORD_FIELDS = [
+    'ts',
+    'client',
+    'resolver',
+    'qname',
+    'qtype',
+    'rcode',
+    'answers',
+    'ttls',
+]
+AGGREGATE_FIELDS = [
+    'window',
+    'qname',
+    'qtype',
+    'rcode',
+    'rtype',
+    'data',
+    'first_seen',
+    'last_seen',
+    'count',
+    'min_ttl',
+    'max_ttl',
+]
+
+
+def _ntop(packed):
+    if len(packed) == 4:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def extract_records(file_path):
+    """
+    Yields a passive DNS record (a dictionary with the RECORD_FIELDS) for
+    each of the DNS responses in the pcap file at `file_path`. The answers
+    are [type, data] pairs, and the TTLs are in the same order. Packets that
+    aren't valid responses are skipped.
+    """
+    for packet in iter_udp(file_path):
+        if packet.sport != DNS_PORT:
+            continue
+        try:
+            response = decode_response(packet.payload)
+        except ValueError:
+            continue
+        yield {
+            'ts': round(packet.ts, 6),
+            'client': _ntop(packet.dst),
+            'resolver': _ntop(packet.src),
+            'qname': response.qname,
+            'qtype': response.qtype,
+            'rcode': response.rcode,
+            'answers': [[x.rtype, x.data] for x in response.answers],
+            'ttls': [x.ttl for x in response.answers],
+        }
+
+
+def aggregate_records(records, window_seconds):
+    """
+    Summarizes passive DNS `records` into one row (a dictionary with the
+    AGGREGATE_FIELDS) per distinct (qname, qtype, rcode, answer) in each
+    `window_seconds`-long window. Responses without answers are counted with
+    a null rtype and data. Rows are returned in order of first appearance.
+    """
+    # (window, qname, qtype, rcode, rtype, data) ->
+    # [first_seen, last_seen, count, min_ttl, max_ttl]
+    table = {}
+    for record in records:
+        ts = record['ts']
+        window = int(ts // window_seconds) * window_seconds
+        prefix = (
+            window, intern(record['qname']), record['qtype'], record['rcode']
+        )
+        answers = list(zip(record['answers'], record['ttls']))
+        for (rtype, data), ttl in (answers or [((None, None), None)]):
+            key = prefix + (rtype, None if data is None else intern(data))
+            entry = table.get(key)
+            if entry is None:
+                table[key] = [ts, ts, 1, ttl, ttl]
+                continue
+            entry[0] = min(entry[0], ts)
+            entry[1] = max(entry[1], ts)
+            entry[2] += 1
+            if ttl is not None:
+                entry[3] = min(entry[3], ttl)
+                entry[4] = max(entry[4], ttl)
+
+    for key, value in table.items():
+        yield dict(zip(AGGREGATE_FIELDS, key + tuple(value)))
+
+
+def write_jsonl(records, outfile):
+    """
+    Writes `records` to the text file `outfile` as JSON, one per line.
+    """
+    for record in records:
+        outfile.write(json.dumps(record, separators=(',', ':')))
+        outfile.write('\n')
+
+
+def write_columnar(records, outfile):
+    """
+    Writes `records` to the text file `outfile` as a JSON object that maps
+    each field to a list of values. Similar values are next to each other,
+    so this compresses better than JSON lines.
+    """
+    columns = {field: [] for field in RECORD_FIELDS}
+    for record in records:
+        for field in RECORD_FIELDS:
+            columns[field].append(record[field])
+    json.dump(columns, outfile, separators=(',', ':'))
+
+
+# Format name -> (file suffix, writer function)
+FORMATS = {
+    'jsonl': ('.jsonl.gz', write_jsonl),
+    'columnar': ('.columnar.json.gz', write_columnar),
+    'aggregate': ('.aggregate.jsonl.gz', write_jsonl),
+}
 
 
 class PdnsPusher(TcpdumpPusher):
@@ -31,6 +175,108 @@ class PdnsPusher(TcpdumpPusher):
         kwargs.update(init_kwargs)
         super().__init__(*args, **kwargs)
 
+        self.pdns_format = getenv(ENV_PDNS_FORMAT, DEFAULT_PDNS_FORMAT)
+        if (self.pdns_format != 'pcap') and (self.pdns_format not in FORMATS):
+            logging.error('Unknown format %s, using pcap', self.pdns_format)
+            self.pdns_format = DEFAULT_PDNS_FORMAT
+        self.keep_pcap = getenv(ENV_PDNS_KEEP_PCAP, 'false') == 'true'
+        self.window_seconds = int(
+            getenv(ENV_PDNS_WINDOW_SECONDS, DEFAULT_PDNS_WINDOW_SECONDS)
+        )
+
+    def _extract(self, file_path):
+        # Writes the records file for a pcap. Returns True on success.
+        suffix, write = FORMATS[self.pdns_format]
+        out_path = file_path + suffix
+        temp_path = out_path + TEMP_SUFFIX
+        records = extract_records(file_path)
+        if self.pdns_format == 'aggregate':
+            records = aggregate_records(records, self.window_seconds)
+        try:
+            with gz_open(temp_path, 'wt') as outfile:
+                write(records, outfile)
+            rename(temp_path, out_path)
+        except (OSError, ValueError) as e:
+            logging.error('Error extracting %s: %s', file_path, e)
+            try:
+                remove(temp_path)
+            except OSError:
+                pass
+            return False
+
+        return True
+
+    def extract_pcaps(self):
+        """
+        Writes out the DNS records from the finished pcap files in the
+        capture directory. The pcaps are then removed, or kept for upload:
+        compressed, or set aside to be compressed as they're sent. Pcaps that
+        can't be read are removed, since they'd fail again next time.
+        """
+        self._remove_partial()
+        for file_path in self._get_finished_pcaps():
+            logging.info('Extracting DNS records from %s', file_path)
+            if not self._extract(file_path):
+                remove(file_path)
+            elif not self.keep_pcap:
+                remove(file_path)
+            elif self.stream_upload:
+                rename(file_path, file_path + KEPT_SUFFIX)
+            else:
+                self._compress(file_path)
+
+    def _get_stream_pcaps(self):
+        # Only pcaps whose records have been extracted are sent
+        if self.pdns_format == 'pcap':
+            return super()._get_stream_pcaps()
+
+        glob_pattern = join(
+            self.pcap_dir, '{}_*.pcap{}'.format(self.data_type, KEPT_SUFFIX)
+        )
+        return sorted(iglob(glob_pattern))
+
+    def push_records(self, now):
+        """
+        Sends out the DNS record files in the capture directory, then
+        removes them.
+        """
+        ret = []
+        ts = now.replace(
+            minute=(now.minute // 10) * 10,
+            second=0,
+            microsecond=0
+        )
+
+        suffix = FORMATS[self.pdns_format][0]
+        glob_pattern = join(
+            self.pcap_dir, '{}_*.pcap{}'.format(self.data_type, suffix)
+        )
+        for i, file_path in enumerate(sorted(iglob(glob_pattern))):
+            remote_path = self.api.send_file(
+                'logs', file_path, ts, suffix='{:04}'.format(i)
+            )
+            if remote_path is not None:
+                data = {
+                    'path': remote_path,
+                    'log_type': 'pdns-{}'.format(self.pdns_format),
+                }
+                self.api.send_signal('logs', data=data)
+            ret.append(remote_path)
+            remove(file_path)
+
+        return ret
+
+    def execute(self, now=None):
+        if self.pdns_format == 'pcap':
+            return super().execute(now=now)
+
+        now = now or utcnow()
+        self.extract_pcaps()
+        ret = self.push_records(now)
+        if self.keep_pcap:
+            ret.extend(self.push_files(now))
+        return ret
+
 
 if __name__ == '__main__':
     PdnsPusher().run()
@@ -18,7 +18,7 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 from glob import iglob
 from os import makedirs, remove
-from os.path import basename, getsize, join
+from os.path import basename, exists, getsize, join
 from tarfile import open as tar_open
 from tempfile import gettempdir
 
@@ -121,8 +121,10 @@ class Pusher(Service):
         for key in file_bins:
             file_list = D_archive[key]
 
-            # Process the files before archiving
+            # Process the files before archiving. Processing may combine
+            # files, so only archive the ones that remain.
             self._process_files(file_list)
+            file_list = [x for x in file_list if exists(x)]
 
             # Create the file archive
             prefix = format(key, self.file_fmt)
@@ -139,7 +141,8 @@ class Pusher(Service):
     def _process_files(self, file_list):
         """
         Child classes may override this method to make some transformation to
-        input files before archiving.
+        input files before archiving. Files that are removed here are left
+        out of the archive.
         """
         pass
 
@@ -14,15 +14,29 @@
 # python builtins
 import csv
 import logging
+import re
 
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from gzip import open as gz_open
-from os import getenv
+from hashlib import blake2b
+from itertools import chain
+from os import getenv, remove
 from tempfile import NamedTemporaryFile
 
+# third-party
+from requests import exceptions as requests_exceptions
+
 # local
+from ona_service.dedup_cache import DedupCache
 from ona_service.service import Service
 from ona_service.log_watcher import LogNode
+from ona_service.syslog_receiver import (
+    parse_listen_spec,
+    strip_header,
+    SyslogReceiver,
+)
 from ona_service.utils import utcoffset, utcnow, timestamp
 
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -38,96 +52,481 @@ OUTPUT_FIELDNAMES = [
     'ComputerAddress',
 ]
 POLL_SECONDS = 60
+LOGON_EVENT_CODE = '4624'
 SKIP_SIDS = {'S-1-5-7', 'S-1-5-18'}
-
-
-def _process_multiline(entry):
-    # Given a multi-line Active Directory log entry, returns a dictionary with
-    # the associated data.
-    D = {}
-    __, date_str, summary = entry[0].split('|', 2)
-    summary_fields = summary.split('\t')
-    D['Received time'] = date_str
-    D['Event Code'] = summary_fields[1]
-
-    lines = (x for x in entry[1:] if x)
-    for line in lines:
-        fields = [x for x in line.split('\t')]
-        collapsed_fields = [x for x in fields if x]
-        if fields[0].endswith(':') and len(collapsed_fields) == 1:
-            section = collapsed_fields[0].rstrip(':')
-            D[section] = {}
-        elif fields[0] and len(collapsed_fields) == 2:
-            key = collapsed_fields[0].rstrip(':')
-            value = collapsed_fields[1]
-            D[key] = value
-        elif not fields[0] and len(collapsed_fields) == 2:
-            key = collapsed_fields[0].rstrip(':')
-            value = collapsed_fields[1]
-            D[section][key] = value
-        else:
+DEFAULT_ENCODING = 'cp1252'
+ENV_SYSLOG_AD_DEDUP_SECONDS = 'OBSRVBL_SYSLOG_AD_DEDUP_SECONDS'
+DEFAULT_SYSLOG_AD_DEDUP_SECONDS = '0'
+ENV_SYSLOG_AD_DEDUP_MAX_ENTRIES = 'OBSRVBL_SYSLOG_AD_DEDUP_MAX_ENTRIES'
+DEFAULT_SYSLOG_AD_DEDUP_MAX_ENTRIES = '100000'
+ENV_SYSLOG_AD_DEDUP_FILE = 'OBSRVBL_SYSLOG_AD_DEDUP_FILE'
+DEFAULT_SYSLOG_AD_DEDUP_FILE = '.syslog-ad-dedup'
+# Listen for syslog messages directly instead of reading rsyslog's log
+ENV_SYSLOG_AD_LISTEN = 'OBSRVBL_SYSLOG_AD_LISTEN'
+ENV_SYSLOG_AD_QUEUE_SIZE = 'OBSRVBL_SYSLOG_AD_QUEUE_SIZE'
+DEFAULT_SYSLOG_AD_QUEUE_SIZE = '100000'
+# Received messages are uploaded once this many are queued, or when the
+# oldest has waited this long
+ENV_SYSLOG_AD_FLUSH_MESSAGES = 'OBSRVBL_SYSLOG_AD_FLUSH_MESSAGES'
+DEFAULT_SYSLOG_AD_FLUSH_MESSAGES = '10000'
+ENV_SYSLOG_AD_FLUSH_SECONDS = 'OBSRVBL_SYSLOG_AD_FLUSH_SECONDS'
+DEFAULT_SYSLOG_AD_FLUSH_SECONDS = '10'
+# Uploads are named by the second, so they can't be closer together
+MIN_FLUSH_SECONDS = 1
+# The format of the time that rsyslog adds to each line
+RECEIVED_TIME_FORMAT = '%Y-%m-%d %H:%M'
+# Parse the log with this many processes (0 to parse in the service's)
+ENV_SYSLOG_AD_WORKERS = 'OBSRVBL_SYSLOG_AD_WORKERS'
+DEFAULT_SYSLOG_AD_WORKERS = '0'
+# Batches are split into chunks of about this many lines for the workers.
+# Smaller batches are parsed in-process.
+CHUNK_LINES = 10000
+
+ONELINE_PREFIX = b'obsrvbl_remote-ad_oneline|'
+MULTILINE_PREFIX = b'obsrvbl_remote-ad|'
+# The bytes that str.strip() removes from decoded cp1252 text
+WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f\xa0'
+# The fields that get_interesting_events and format_events use
+LOGON_KEYS = (b'Security ID', b'Account Name')
+NETWORK_KEYS = (b'Workstation Name', b'Source Network Address')
+HEADER_KEYS = (b'Event Code', b'Received time')
+MULTILINE_KEYS = frozenset(LOGON_KEYS + NETWORK_KEYS + HEADER_KEYS)
+# Bytes that aren't defined in cp1252
+CP1252_UNDEFINED = b'\x81\x8d\x8f\x90\x9d'
+
+# One-line entries have items separated by three spaces. This matches the
+# part of an item after its key: a colon, and then the value (which has its
+# whitespace stripped later).
+ONELINE_SEPARATOR = b'   '
+ONELINE_VALUE = re.compile(
+    b'(?:(?!   )[' + re.escape(WHITESPACE) + b'])*:([^ ]*(?: {1,2}[^ ]+)*)'
+)
+
+
+def _last_value(data, key):
+    # Returns the value of the last item in `data` with `key` and a
+    # non-empty value, or None if there isn't one
+    end = len(data)
+    while True:
+        i = data.rfind(key, 0, end)
+        if i == -1:
+            return None
+        end = i
+
+        # The key must start its item
+        j = data.rfind(ONELINE_SEPARATOR, 0, i)
+        item_start = 0 if (j == -1) else (j + len(ONELINE_SEPARATOR))
+        if (item_start != i) and data[item_start:i].strip(WHITESPACE):
             continue
-    return D
 
+        match = ONELINE_VALUE.match(data, i + len(key))
+        if match is None:
+            continue
+        value = match.group(1).strip(WHITESPACE)
+        if value:
+            return value
+
+
+def parse_oneline(line, encoding=DEFAULT_ENCODING, event_codes=None):
+    """
+    Parses a raw one-line entry. Rather than splitting the message into all
+    of its items, only the keys that are needed for uploads are searched
+    for. Returns None if the line is malformed, or if
+    `event_codes` is given and the event's code isn't in it.
+    """
+    parts = line.split(b'|', 2)
+    if len(parts) != 3:
+        return None
+    fields = parts[2].split(b',', 2)
+    if len(fields) < 2:
+        return None
+
+    # The message is in the second-to-last field. Later items win, so each
+    # key is searched for from the end.
+    data = parts[2].rsplit(b',', 2)[-2]
+    event_code = _last_value(data, b'Event Code')
+    if event_code is None:
+        event_code = fields[1].strip(WHITESPACE)
+    event_code = event_code.decode(encoding)
+    if (event_codes is not None) and (event_code not in event_codes):
+        return None
 
-def _process_oneline(entry):
-    # Given a single-line Active Directory log entry, returns a dictionary
-    # with the assocated data.
-    __, date_str, rest = entry.split('|', 2)
-    fields = rest.split(',')
-    event_code = fields[1].strip()
     D = {
         'Security ID': None,
         'Account Name': None,
         'Workstation Name': None,
         'Source Network Address': None,
         'Event Code': event_code,
-        'Received time': date_str,
+        'Received time': parts[1].decode(encoding),
     }
-    data = fields[-2]
-    for item in data.split('   '):
-        item = item.strip().split(':', 1)
-        if len(item) != 2:
-            continue
-        key, value = [x.strip() for x in item]
-        if (key not in D) or (not value):
+    for key in LOGON_KEYS + NETWORK_KEYS + HEADER_KEYS[1:]:
+        value = _last_value(data, key)
+        if value is not None:
+            D[key.decode('ascii')] = value.decode(encoding)
+
+    return D
+
+
+def _split_multiline(line):
+    # Returns (section, key, value) for a line of a multi-line entry, where
+    # either `section` or `key` is None. Returns None for a line with neither.
+    if not line.startswith(b'\t'):
+        key, sep, value = line.partition(b'\t')
+        if not sep:
+            if key.endswith(b':'):
+                return key.rstrip(b':'), None, None
+            return None
+    else:
+        key, sep, value = line.lstrip(b'\t').partition(b'\t')
+
+    key = key.rstrip(b':')
+    value = value.lstrip(b'\t')
+    if (key not in MULTILINE_KEYS) or (not value) or (b'\t' in value):
+        return None
+    return None, key, value
+
+
+def _skip_multiline(entry, event_code, event_codes):
+    # Returns True if the entry's code can't be in `event_codes`, without
+    # parsing the whole thing. The header's code can only be replaced by a
+    # top-level line.
+    if (event_codes is None) or (event_code in event_codes):
+        return False
+    return not any(x.startswith(b'Event Code') for x in entry)
+
+
+def parse_multiline(entry, encoding=DEFAULT_ENCODING, event_codes=None):
+    """
+    Parses the raw lines of a multi-line entry. Rather than keeping every
+    section, the values that are needed for
+    uploads are resolved (from the 'New Logon' and 'Network Information'
+    sections, when they're present) into a flat dictionary. Returns None if
+    the entry is malformed, or if `event_codes` is given and the event's
+    code isn't in it.
+    """
+    parts = entry[0].rstrip(WHITESPACE).split(b'|', 2)
+    if len(parts) != 3:
+        return None
+    summary_fields = parts[2].split(b'\t', 2)
+    if len(summary_fields) < 2:
+        return None
+
+    event_code = summary_fields[1].decode(encoding)
+    if _skip_multiline(entry, event_code, event_codes):
+        return None
+
+    top = {b'Received time': parts[1], b'Event Code': summary_fields[1]}
+    sections = {}
+    section = None
+    for line in entry[1:]:
+        line = line.rstrip(WHITESPACE)
+        item = _split_multiline(line) if line else None
+        if item is None:
             continue
-        D[key] = value
+        new_section, key, value = item
+        if new_section is not None:
+            section = new_section
+            sections[section] = {}
+        elif not line.startswith(b'\t'):
+            top[key] = value
+        elif section is not None:
+            sections[section][key] = value
+
+    D = _resolve_multiline(top, sections, encoding)
+    if (event_codes is not None) and (D['Event Code'] not in event_codes):
+        return None
+    return D
+
+
+def _resolve_multiline(top, sections, encoding):
+    # Fall back to the top level if the sections aren't there
+    logon = sections.get(b'New Logon', top)
+    network = sections.get(b'Network Information', top)
+    D = {
+        'Received time': top[b'Received time'].decode(encoding),
+        'Event Code': top[b'Event Code'].decode(encoding),
+    }
+    for keys, values in ((LOGON_KEYS, logon), (NETWORK_KEYS, network)):
+        for key in keys:
+            if key in values:
+                D[key.decode('ascii')] = values[key].decode(encoding)
 
     return D
 
 
-class RemoteADLogNode(LogNode):
-    def __init__(self, *args, **kwargs):
-        self.parsed_data = []
+class ADEventParser:
+    """
+    Turns the raw lines of the remote AD log into event dictionaries.
+    Multi-line entries can span batches: an entry isn't parsed until the
+    start of the next one is seen. If `event_codes` is given, other events
+    are skipped.
+    """
+    def __init__(self, encoding=DEFAULT_ENCODING, event_codes=None):
+        self.encoding = encoding
+        self.event_codes = event_codes
         self.entry = []
         self.is_complete = False
-        kwargs.setdefault('encoding', 'cp1252')
-        super().__init__(*args, **kwargs)
 
-    def flush_data(self, data, now, compress=True):
-        for line in data:
-            line = line.decode(self.encoding, errors=self.errors)
+    def parse(self, lines):
+        """
+        Yields an event dictionary for each of the complete entries among
+        `lines`.
+        """
+        encoding = self.encoding
+        event_codes = self.event_codes
+        for line in lines:
             # One-line format
-            if line.startswith('obsrvbl_remote-ad_oneline|'):
-                D_entry = _process_oneline(line)
-                self.parsed_data.append(D_entry)
+            if line.startswith(ONELINE_PREFIX):
+                D_entry = parse_oneline(line, encoding, event_codes)
+                if D_entry is not None:
+                    yield D_entry
                 continue
 
             # Multi-line format:
             # As long as this isn't a new line, add to the current entry
-            if not line.startswith('obsrvbl_remote-ad|'):
-                self.entry.append(line.rstrip())
+            if not line.startswith(MULTILINE_PREFIX):
+                self.entry.append(line)
+                continue
+
             # When we see a new line start, process the current entry (if
             # we saw the whole thing)
-            else:
-                if self.is_complete:
-                    D_entry = _process_multiline(self.entry)
-                    if D_entry is not None:
-                        self.parsed_data.append(D_entry)
-                # Start a new entry
-                self.entry = [line.rstrip()]
-                self.is_complete = True
+            if self.is_complete:
+                D_entry = parse_multiline(self.entry, encoding, event_codes)
+                if D_entry is not None:
+                    yield D_entry
+            # Start a new entry
+            self.entry = [line]
+            self.is_complete = True
+
+    def flush(self):
+        """
+        Yields the event dictionary for the current multi-line entry, if
+        it's known to be complete. Use this when the next line is known to
+        start a new entry.
+        """
+        if self.is_complete:
+            D_entry = parse_multiline(
+                self.entry, self.encoding, self.event_codes
+            )
+            if D_entry is not None:
+                yield D_entry
+        self.entry = []
+        self.is_complete = False
+
+
+def parse_message(received, message, encoding=DEFAULT_ENCODING,
+                  event_codes=None):
+    """
+    Parses a syslog message's content (without its header), received at
+    the time `received` (formatted like rsyslog's prefix), the same way as
+    the lines that rsyslog would write for it. Returns None if the message
+    is malformed or its code isn't in `event_codes`.
+    """
+    # One-line events have commas where multi-line events have tabs
+    i = message.find(b',')
+    j = message.find(b'\t')
+    if (i != -1) and ((j == -1) or (i < j)):
+        line = ONELINE_PREFIX + received + b'|' + message.split(b'\n', 1)[0]
+        return parse_oneline(line, encoding, event_codes)
+
+    entry = (MULTILINE_PREFIX + received + b'|' + message).split(b'\n')
+    return parse_multiline(entry, encoding, event_codes)
+
+
+def event_key(row):
+    """
+    Returns a 64-bit integer that stands in for the formatted event `row`
+    when checking for duplicates. It's stable across processes.
+    """
+    digest = blake2b(repr(row).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def get_interesting_events(events):
+    """
+    Yields the logon events among `events`, skipping internal ones.
+    """
+    for D_event in events:
+        # Look for new session events
+        event_id = D_event.get('Event Code')
+        if event_id != LOGON_EVENT_CODE:
+            continue
+
+        # Skip internal events
+        new_logon = D_event.get('New Logon', D_event)
+        security_id = new_logon.get('Security ID')
+        if security_id in SKIP_SIDS:
+            continue
+
+        yield D_event
+
+
+def format_events(events, utcoffset, domain_suffix):
+    """
+    Yields an output row for each of `events`, skipping local service
+    accounts.
+    """
+    for D_event in events:
+        # Fall back to parent dict if sub-dicts are not available
+        network_info = D_event.get('Network Information', D_event)
+        account_info = D_event.get('New Logon', D_event)
+
+        # The time format is set in rsyslog
+        received_time = datetime.strptime(
+            D_event['Received time'], RECEIVED_TIME_FORMAT
+        )
+        _time = timestamp(received_time) - utcoffset
+
+        computer = network_info.get('Workstation Name')
+        if computer is not None:
+            computer = (computer + domain_suffix).lower()
+
+        # Skip local service accounts ending with $
+        user_name = account_info.get('Account Name', '')
+        if user_name.endswith('$'):
+            continue
+
+        event_code = D_event['Event Code']
+        ip_address = network_info.get('Source Network Address', '')
+
+        yield (_time, computer, user_name, event_code, ip_address)
+
+
+def _parse_chunk(args):
+    # Parses a chunk of lines in a worker process. The chunk's last entry
+    # is complete. Returns a list of output rows.
+    (
+        lines, entry, is_complete, encoding, event_codes, utcoffset,
+        domain_suffix,
+    ) = args
+    parser = ADEventParser(encoding, event_codes)
+    parser.entry = entry
+    parser.is_complete = is_complete
+    events = chain(parser.parse(lines), parser.flush())
+    return list(
+        format_events(get_interesting_events(events), utcoffset, domain_suffix)
+    )
+
+
+class ShardedADEventParser:
+    """
+    Turns the raw lines of the remote AD log into output rows, spreading
+    large batches over `workers` processes. Rows come out in the same order
+    as with ADEventParser.
+
+    Batches are only split at the starts of multi-line entries. The lines
+    from the last one on are handled by `parser`, an ADEventParser, which
+    holds the unfinished entry until the next batch.
+    """
+    def __init__(self, parser, workers, chunk_lines=CHUNK_LINES):
+        self.parser = parser
+        self.workers = workers
+        self.chunk_lines = chunk_lines
+        self.executor = None
+
+    def _split(self, lines, starts):
+        # Returns the chunk boundaries: about `chunk_lines` apart, at
+        # entry starts
+        chunk_count = min(
+            max(1, len(lines) // self.chunk_lines), 4 * self.workers
+        )
+        size = len(lines) / chunk_count
+        ret = [0]
+        for k in range(1, chunk_count):
+            i = bisect_left(starts, int(k * size))
+            if (i < len(starts)) and (ret[-1] < starts[i] < len(lines)):
+                ret.append(starts[i])
+        ret.append(len(lines))
+        return ret
+
+    def _map(self, chunk_args):
+        if len(chunk_args) == 1:
+            return map(_parse_chunk, chunk_args)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor.map(_parse_chunk, chunk_args)
+
+    def parse(self, lines, utcoffset, domain_suffix):
+        """
+        Yields an output row (see format_events) for each of the complete
+        entries among `lines`.
+        """
+        parser = self.parser
+        starts = [
+            i for i, x in enumerate(lines) if x.startswith(MULTILINE_PREFIX)
+        ]
+        last = starts[-1] if starts else 0
+        if last:
+            head, lines = lines[:last], lines[last:]
+            bounds = self._split(head, starts)
+            chunk_args = []
+            for start, end in zip(bounds, bounds[1:]):
+                entry, is_complete = [], False
+                if start == 0:
+                    entry, is_complete = parser.entry, parser.is_complete
+                chunk_args.append(
+                    (
+                        head[start:end], entry, is_complete, parser.encoding,
+                        parser.event_codes, utcoffset, domain_suffix,
+                    )
+                )
+            parser.entry, parser.is_complete = [], False
+            for rows in self._map(chunk_args):
+                yield from rows
+
+        events = get_interesting_events(parser.parse(lines))
+        yield from format_events(events, utcoffset, domain_suffix)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class RemoteADLogNode(LogNode):
+    """
+    Reads the remote AD log. Each batch of parsed events is passed to the
+    `handle_events` callable as it's read.
+    """
+    def __init__(self, *args, **kwargs):
+        self.handle_events = kwargs.pop('handle_events', None)
+        event_codes = kwargs.pop('event_codes', None)
+        kwargs.setdefault('encoding', DEFAULT_ENCODING)
+        super().__init__(*args, **kwargs)
+        self.parser = ADEventParser(self.encoding, event_codes)
+
+    def _decode_lines(self, lines):
+        # The parser decodes just the fields it needs. For cp1252, dropping
+        # the undefined bytes is the same as the round trip.
+        if (self.encoding, self.errors) != (DEFAULT_ENCODING, 'ignore'):
+            return super()._decode_lines(lines)
+        return [x.translate(None, CP1252_UNDEFINED) for x in lines]
+
+    def flush_data(self, data, now, compress=True):
+        self.handle_events(self.parser.parse(data))
+
+
+class ShardedADLogNode(RemoteADLogNode):
+    """
+    Reads the remote AD log, parsing with `workers` processes. Each batch of
+    output rows is passed to the `handle_rows` callable as it's read.
+    `get_format_args` should return the (utcoffset, domain_suffix) to format
+    rows with.
+    """
+    def __init__(self, *args, **kwargs):
+        self.handle_rows = kwargs.pop('handle_rows')
+        self.get_format_args = kwargs.pop('get_format_args')
+        workers = kwargs.pop('workers')
+        super().__init__(*args, **kwargs)
+        self.sharded_parser = ShardedADEventParser(self.parser, workers)
+
+    def flush_data(self, data, now, compress=True):
+        self.handle_rows(
+            self.sharded_parser.parse(data, *self.get_format_args())
+        )
+
+    def close(self):
+        self.sharded_parser.close()
 
 
 class SyslogADWatcher(Service):
@@ -138,83 +537,249 @@ class SyslogADWatcher(Service):
         self.utcoffset = utcoffset()
         self.domain_suffix = getenv('OBSRVBL_DOMAIN_SUFFIX', '')
         self.data_type = DATA_TYPE
-        self.log_node = RemoteADLogNode(
-            log_type=self.data_type,
-            api=self.api,
-            log_path=getenv('OBSRVBL_SYSLOG_AD_PATH', DEFAULT_AD_PATH)
+        node_kwargs = {
+            'log_type': self.data_type,
+            'api': self.api,
+            'log_path': getenv('OBSRVBL_SYSLOG_AD_PATH', DEFAULT_AD_PATH),
+            'event_codes': {LOGON_EVENT_CODE},
+        }
+        workers = int(
+            getenv(ENV_SYSLOG_AD_WORKERS, DEFAULT_SYSLOG_AD_WORKERS)
         )
+        if workers > 0:
+            self.log_node = ShardedADLogNode(
+                handle_rows=self.write_rows,
+                get_format_args=lambda: (self.utcoffset, self.domain_suffix),
+                workers=workers,
+                **node_kwargs
+            )
+        else:
+            self.log_node = RemoteADLogNode(
+                handle_events=self.write_events, **node_kwargs
+            )
+        # Where events are written during each execute
+        self.writer = None
+        self.row_count = 0
+        self.seen = set()
+        # (output path, time, dedup keys) for a file that still needs to be
+        # sent. The keys are only added to the dedup cache once it has been.
+        self.pending = None
+        self.dedup_keys = {}
+
+        # Events that repeat within the window (across ticks) are skipped
+        self.dedup_cache = None
+        dedup_seconds = int(
+            getenv(
+                ENV_SYSLOG_AD_DEDUP_SECONDS, DEFAULT_SYSLOG_AD_DEDUP_SECONDS
+            )
+        )
+        if dedup_seconds > 0:
+            self.dedup_cache = DedupCache(
+                dedup_seconds,
+                max_entries=int(
+                    getenv(
+                        ENV_SYSLOG_AD_DEDUP_MAX_ENTRIES,
+                        DEFAULT_SYSLOG_AD_DEDUP_MAX_ENTRIES,
+                    )
+                ),
+                snapshot_path=getenv(
+                    ENV_SYSLOG_AD_DEDUP_FILE, DEFAULT_SYSLOG_AD_DEDUP_FILE
+                ),
+            )
 
-    def _get_interesting_events(self, events):
-        for D_event in events:
-            # Look for new session events
-            event_id = D_event.get('Event Code')
-            if event_id != '4624':
-                continue
-
-            # Skip internal events
-            new_logon = D_event.get('New Logon', D_event)
-            security_id = new_logon.get('Security ID')
-            if security_id in SKIP_SIDS:
-                continue
-
-            yield D_event
-
-    def _get_formatted_events(self, events):
-        for D_event in events:
-            # Fall back to parent dict if sub-dicts are not available
-            network_info = D_event.get('Network Information', D_event)
-            account_info = D_event.get('New Logon', D_event)
-
-            # The time format is set in rsyslog
-            received_time = datetime.strptime(
-                D_event['Received time'], '%Y-%m-%d %H:%M'
+        # Messages can come straight from a listener instead of the log
+        self.receiver = None
+        listen = getenv(ENV_SYSLOG_AD_LISTEN, '')
+        if listen:
+            self.receiver = SyslogReceiver(
+                parse_listen_spec(listen),
+                int(
+                    getenv(
+                        ENV_SYSLOG_AD_QUEUE_SIZE, DEFAULT_SYSLOG_AD_QUEUE_SIZE
+                    )
+                ),
+            )
+        self.flush_messages = int(
+            getenv(
+                ENV_SYSLOG_AD_FLUSH_MESSAGES, DEFAULT_SYSLOG_AD_FLUSH_MESSAGES
             )
-            _time = timestamp(received_time) - self.utcoffset
+        )
+        self.flush_seconds = float(
+            getenv(
+                ENV_SYSLOG_AD_FLUSH_SECONDS, DEFAULT_SYSLOG_AD_FLUSH_SECONDS
+            )
+        )
 
-            computer = network_info.get('Workstation Name')
-            if computer is not None:
-                computer = (computer + self.domain_suffix).lower()
+    def write_events(self, events):
+        """
+        Formats `events` and writes the ones that haven't been seen already.
+        """
+        self.write_rows(
+            format_events(
+                get_interesting_events(events),
+                self.utcoffset,
+                self.domain_suffix,
+            )
+        )
 
-            # Skip local service accounts ending with $
-            user_name = account_info.get('Account Name', '')
-            if user_name.endswith('$'):
+    def write_rows(self, rows):
+        """
+        Writes the output `rows` that haven't been seen already.
+        """
+        for row in rows:
+            key = event_key(row)
+            if key in self.seen:
                 continue
+            self.seen.add(key)
+            if (self.dedup_cache is not None) and self._is_duplicate(row):
+                continue
+            self.writer.writerow(row)
+            self.row_count += 1
+
+    def _is_duplicate(self, row):
+        # Across ticks, the time doesn't matter. Keys that are let through
+        # are held back from the cache until their upload succeeds.
+        key = event_key(row[1:])
+        pending_ts = self.dedup_keys.get(key)
+        if (pending_ts is not None) and (
+            abs(row[0] - pending_ts) < self.dedup_cache.window
+        ):
+            return True
+        if self.dedup_cache.check(key, row[0]):
+            return True
+
+        self.dedup_keys[key] = row[0]
+        return False
+
+    def _parse_received(self, batches):
+        encoding = self.log_node.encoding
+        event_codes = self.log_node.parser.event_codes
+        for received, messages in batches:
+            received = datetime.fromtimestamp(received).strftime(
+                RECEIVED_TIME_FORMAT
+            ).encode('ascii')
+            for message in messages:
+                message = strip_header(message)
+                if encoding == DEFAULT_ENCODING:
+                    message = message.translate(None, CP1252_UNDEFINED)
+                D_entry = parse_message(
+                    received, message, encoding, event_codes
+                )
+                if D_entry is not None:
+                    yield D_entry
+
+    def _check_received(self):
+        queue = self.receiver.queue
+        self.write_events(self._parse_received(queue.get_all()))
+        dropped = queue.pop_dropped()
+        if dropped:
+            logging.warning('Dropped %s syslog messages', dropped)
+
+    def _update_dedup_cache(self, now, dedup_keys):
+        if self.dedup_cache is None:
+            return
 
-            event_code = D_event['Event Code']
-            ip_address = network_info.get('Source Network Address', '')
-
-            yield (_time, computer, user_name, event_code, ip_address)
+        cache = self.dedup_cache
+        for key, ts in dedup_keys.items():
+            cache.add(key, ts)
+        cache.expire(timestamp(now))
+        cache.save()
+        logging.info(
+            'Dedup cache: %s hits, %s misses, %s evictions, %s entries',
+            cache.hits,
+            cache.misses,
+            cache.evictions,
+            len(cache),
+        )
 
-    def execute(self, now=None):
-        now = now or utcnow()
+    def _write_output(self, now):
+        # Events go straight from the log to a compressed output file.
+        # Returns its path, or None if there was nothing new.
+        with NamedTemporaryFile(suffix='.csv.gz', delete=False) as f:
+            with gz_open(f, mode='wt') as gz_f:
+                self.writer = csv.writer(gz_f)
+                self.writer.writerow(OUTPUT_FIELDNAMES)
+                self.row_count = 0
+                self.seen = set()
+                self.dedup_keys = {}
+                if self.receiver is None:
+                    self.log_node.check_data(now)
+                else:
+                    self._check_received()
+        if not self.row_count:
+            remove(f.name)
+            self._update_dedup_cache(now, {})
+            return None
+
+        return f.name
+
+    def _send_pending(self):
+        # Sends the pending output file. If that fails, it's kept for the
+        # next try.
+        file_path, now, dedup_keys = self.pending
         ts = now.replace(
             minute=(now.minute // 10) * 10, second=0, microsecond=0
         )
+        remote_path = self.api.send_file(
+            self.data_type,
+            file_path,
+            ts,
+            suffix='{:04}'.format(now.minute * 60 + now.second)
+        )
+        remove(file_path)
+        self.pending = None
+        self._update_dedup_cache(now, dedup_keys)
 
-        self.log_node.check_data(now)
-        all_events = self.log_node.parsed_data
-        if not all_events:
-            return
-        interesting_events = self._get_interesting_events(all_events)
-        formatted_events = set(self._get_formatted_events(interesting_events))
-        with NamedTemporaryFile() as f:
-            with gz_open(f, mode='wt') as gz_f:
-                writer = csv.writer(gz_f)
-                writer.writerow(OUTPUT_FIELDNAMES)
-                writer.writerows(formatted_events)
-            f.flush()
-
-            remote_path = self.api.send_file(
-                self.data_type,
-                f.name,
-                ts,
-                suffix='{:04}'.format(now.minute * 60 + now.second)
-            )
-            if remote_path is not None:
-                data = {'path': remote_path, 'log_type': self.data_type}
-                self.api.send_signal('logs', data=data)
+        if remote_path is not None:
+            data = {'path': remote_path, 'log_type': self.data_type}
+            self.api.send_signal('logs', data=data)
 
-        self.log_node.parsed_data = []
+    def execute(self, now=None):
+        now = now or utcnow()
+
+        # Nothing more is read until the last output has been sent
+        if self.pending is not None:
+            self._send_pending()
+
+        file_path = self._write_output(now)
+        if file_path is None:
+            return
+        self.pending = (file_path, now, self.dedup_keys)
+        self._send_pending()
+
+    def _run_received(self):
+        # Rather than waiting for the next poll, received messages are sent
+        # as soon as enough have queued up or the oldest has waited long
+        # enough. Failed uploads are tried again after the poll interval.
+        queue = self.receiver.queue
+        while not self.stop_event.wait(MIN_FLUSH_SECONDS):
+            # The clock starts with the first message
+            if (self.pending is None) and not queue.wait(
+                1, MIN_FLUSH_SECONDS
+            ):
+                continue
+            queue.wait(self.flush_messages, self.flush_seconds)
+            try:
+                self.execute(now=utcnow())
+            except requests_exceptions.RequestException as e:
+                logging.exception('persistent communication problem: %s', e)
+                self.stop_event.wait(self.poll_seconds)
+
+        logging.info('Service stopped')
+
+    def run(self):
+        if self.receiver is not None:
+            self.receiver.start()
+        try:
+            if self.receiver is None:
+                super().run()
+            else:
+                self._run_received()
+        finally:
+            if self.receiver is not None:
+                self.receiver.stop()
+            if isinstance(self.log_node, ShardedADLogNode):
+                self.log_node.close()
 
 
 if __name__ == '__main__':
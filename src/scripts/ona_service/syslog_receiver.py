@@ -0,0 +1,374 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A small syslog listener, for services that would otherwise read what
+rsyslog writes to disk. Messages are received over UDP or TCP (with either
+octet-counting or newline framing, per RFC 6587) and queued for a consumer
+thread.
+"""
+# python builtins
+import asyncio
+import logging
+import re
+import socket
+
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+from time import time
+
+DEFAULT_HOST = '0.0.0.0'
+# Maximum number of datagrams to read per socket wake-up
+RECV_BATCH = 256
+RECV_BUFSIZE = 65535
+SOCKET_RCVBUF = 8 * 1024 * 1024
+# Longest TCP frame that will be accepted
+MAX_FRAME_SIZE = 64 * 1024
+# Newline-framed messages can span lines. A message is finished when the
+# next one starts, or when its sender has been quiet for this long.
+IDLE_SECONDS = 1.0
+# How long TCP readers wait for the queue to drain when it's full
+BACKOFF_SECONDS = 0.1
+
+PRI = re.compile(br'<\d{1,3}>')
+RFC3164_TIMESTAMP = re.compile(
+    br'(?:[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d|\d{4}-\d\d-\d\dT\S+) '
+)
+MAX_TAG_LENGTH = 32
+UTF8_BOM = b'\xef\xbb\xbf'
+
+
+def parse_listen_spec(spec):
+    """
+    Given a comma-separated list of protocol:port or protocol:host:port
+    items (like 'udp:514,tcp:127.0.0.1:514'), returns a list of
+    (protocol, host, port) tuples. Raises ValueError if the list is invalid.
+    """
+    ret = []
+    for item in spec.split(','):
+        parts = item.strip().split(':')
+        if len(parts) == 2:
+            parts.insert(1, DEFAULT_HOST)
+        if len(parts) != 3:
+            raise ValueError('Invalid listen address: {}'.format(item))
+        protocol, host, port = parts
+        protocol = protocol.lower()
+        if protocol not in ('udp', 'tcp'):
+            raise ValueError('Invalid protocol: {}'.format(protocol))
+        ret.append((protocol, host, int(port)))
+
+    return ret
+
+
+def _skip_structured_data(message, i):
+    # Returns the index just past the RFC 5424 structured data at `i`
+    if message[i:i + 1] != b'[':
+        return message.find(b' ', i)
+    while message[i:i + 1] == b'[':
+        i += 1
+        while i < len(message):
+            c = message[i:i + 1]
+            if c == b'\\':
+                i += 2
+                continue
+            i += 1
+            if c == b']':
+                break
+    return i
+
+
+def _strip_rfc5424(message, i):
+    # Skip the timestamp, hostname, app name, process ID and message ID
+    for __ in range(5):
+        i = message.find(b' ', i)
+        if i == -1:
+            return b''
+        i += 1
+    i = _skip_structured_data(message, i)
+    if i == -1:
+        return b''
+    ret = message[i:]
+    if ret.startswith(b' '):
+        ret = ret[1:]
+    if ret.startswith(UTF8_BOM):
+        ret = ret[len(UTF8_BOM):]
+    return ret
+
+
+def _strip_rfc3164(message, i):
+    match = RFC3164_TIMESTAMP.match(message, i)
+    if match is None:
+        return message[i:]
+
+    # Skip the hostname, then the tag. Like rsyslog, the message keeps
+    # whatever follows the tag, including its leading space.
+    i = message.find(b' ', match.end())
+    if i == -1:
+        return b''
+    i += 1
+    for j in range(i, min(i + MAX_TAG_LENGTH, len(message))):
+        c = message[j:j + 1]
+        if c == b':':
+            return message[j + 1:]
+        if c == b' ':
+            return message[j:]
+    return message[min(i + MAX_TAG_LENGTH, len(message)):]
+
+
+def strip_header(message):
+    """
+    Returns the content of the syslog `message` (bytes), without its
+    priority, timestamp, hostname and tag. This is what rsyslog's %msg%
+    property would be. Both RFC 3164 and RFC 5424 headers are recognized.
+    """
+    match = PRI.match(message)
+    if match is None:
+        return message
+
+    i = match.end()
+    if message.startswith(b'1 ', i):
+        return _strip_rfc5424(message, i + 2)
+    return _strip_rfc3164(message, i)
+
+
+class MessageQueue:
+    """
+    Thread-safe queue of (received time, [messages]) batches that holds at
+    most `max_size` messages.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.batches = deque()
+        self.size = 0
+        self.dropped = 0
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+
+    def __len__(self):
+        return self.size
+
+    def has_room(self, count=1):
+        return self.size + count <= self.max_size
+
+    def put(self, received, messages):
+        """
+        Adds as many of `messages` as there's room for, and returns the
+        number that were dropped.
+        """
+        with self.lock:
+            room = max(0, self.max_size - self.size)
+            dropped = max(0, len(messages) - room)
+            if dropped:
+                messages = messages[:room]
+                self.dropped += dropped
+            if messages:
+                self.batches.append((received, messages))
+                self.size += len(messages)
+                self.changed.notify_all()
+        return dropped
+
+    def wait(self, count, timeout):
+        """
+        Waits up to `timeout` seconds for at least `count` messages to be
+        queued. Returns True if they were.
+        """
+        with self.lock:
+            return self.changed.wait_for(lambda: self.size >= count, timeout)
+
+    def get_all(self):
+        """
+        Removes and returns all of the queued batches.
+        """
+        with self.lock:
+            ret = list(self.batches)
+            self.batches.clear()
+            self.size = 0
+        return ret
+
+    def pop_dropped(self):
+        """
+        Returns the number of messages dropped since the last call.
+        """
+        with self.lock:
+            ret = self.dropped
+            self.dropped = 0
+        return ret
+
+
+class SyslogReceiver:
+    """
+    Listens on each of the (protocol, host, port) addresses in `listen` and
+    puts the messages it receives on `queue`, a MessageQueue with room for
+    `queue_size` messages. Use `start` to begin listening in a background
+    thread and `stop` to finish.
+
+    UDP messages that arrive while the queue is full are dropped. TCP
+    senders are made to wait instead.
+    """
+    def __init__(self, listen, queue_size):
+        self.listen = listen
+        self.queue = MessageQueue(queue_size)
+        # (protocol, (host, port)) for each bound address
+        self.addresses = []
+        self.sockets = []
+        self.servers = []
+        self.thread = None
+        self.loop = None
+        self.stop_event = None
+        self.ready = Event()
+        self.error = None
+
+    def _read_datagrams(self, sock):
+        # Drain up to RECV_BATCH datagrams each time the socket is readable
+        messages = []
+        for __ in range(RECV_BATCH):
+            try:
+                data, __ = sock.recvfrom(RECV_BUFSIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            messages.append(data.rstrip(b'\r\n\0'))
+        if messages:
+            self.queue.put(time(), messages)
+
+    async def _put_stream(self, message):
+        while not self.queue.has_room():
+            await asyncio.sleep(BACKOFF_SECONDS)
+        self.queue.put(time(), [message])
+
+    async def _read_frame(self, reader, is_pending):
+        # Returns (frame, is_counted) for the next TCP frame, or (None, False)
+        # if a pending newline-framed message has gone idle
+        timeout = IDLE_SECONDS if is_pending else None
+        try:
+            head = await asyncio.wait_for(reader.readexactly(1), timeout)
+        except asyncio.TimeoutError:
+            return None, False
+
+        # Octet-counted frames start with their length
+        if head.isdigit():
+            length = int(head + (await reader.readuntil(b' '))[:-1])
+            if length > MAX_FRAME_SIZE:
+                raise ValueError('Frame is too long: {}'.format(length))
+            return await reader.readexactly(length), True
+
+        frame = head + await reader.readuntil(b'\n')
+        return frame.rstrip(b'\r\n'), False
+
+    async def _handle_stream(self, reader, writer):
+        pending = None
+        try:
+            while True:
+                frame, is_counted = await self._read_frame(
+                    reader, pending is not None
+                )
+                if frame is None:
+                    await self._put_stream(pending)
+                    pending = None
+                    continue
+
+                # Newline-framed lines without a priority continue the
+                # message before them
+                if (pending is not None) and not (
+                    is_counted or frame.startswith(b'<')
+                ):
+                    pending += b'\n' + frame
+                    continue
+
+                if pending is not None:
+                    await self._put_stream(pending)
+                    pending = None
+                if is_counted:
+                    await self._put_stream(frame)
+                elif frame:
+                    pending = frame
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+            ValueError,
+        ):
+            pass
+        finally:
+            if pending is not None:
+                self.queue.put(time(), [pending])
+            writer.close()
+
+    def _bind_udp(self, loop, host, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+        sock.bind((host, port))
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._read_datagrams, sock)
+        self.sockets.append(sock)
+        self.addresses.append(('udp', sock.getsockname()))
+
+    async def _bind_tcp(self, host, port):
+        server = await asyncio.start_server(
+            self._handle_stream, host, port, limit=MAX_FRAME_SIZE
+        )
+        self.servers.append(server)
+        self.addresses.append(('tcp', server.sockets[0].getsockname()))
+
+    async def _bind(self):
+        try:
+            for protocol, host, port in self.listen:
+                logging.info('Listening for syslog on %s/%s', port, protocol)
+                if protocol == 'udp':
+                    self._bind_udp(self.loop, host, port)
+                else:
+                    await self._bind_tcp(host, port)
+        except OSError as e:
+            self.error = e
+        finally:
+            self.ready.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        try:
+            await self._bind()
+            if self.error is None:
+                await self.stop_event.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        for sock in self.sockets:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        for server in self.servers:
+            server.close()
+        self.sockets = []
+        self.servers = []
+
+    def start(self):
+        """
+        Starts listening in a background thread. Raises OSError if one of
+        the addresses can't be bound.
+        """
+        self.thread = Thread(
+            target=asyncio.run, args=(self.serve(),), daemon=True
+        )
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            self.thread.join()
+            raise self.error
+
+    def stop(self):
+        if self.thread is None:
+            return
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        self.thread.join()
+        self.thread = None
@@ -13,15 +13,108 @@
 # limitations under the License.
 
 # python builtins
-from glob import iglob
+import bz2
+import gzip
 import logging
-from os import makedirs, remove
-from os.path import join
-from subprocess import call
+import lzma
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from glob import iglob
+from io import BytesIO
+from os import fsync, getenv, makedirs, remove, rename, stat
+from os.path import basename, join
+from shutil import copyfileobj
 
 # local
 from ona_service.service import Service
 
+ENV_PCAP_COMPRESS_CODEC = 'OBSRVBL_PCAP_COMPRESS_CODEC'
+DEFAULT_PCAP_COMPRESS_CODEC = 'gzip'
+ENV_PCAP_COMPRESS_LEVEL = 'OBSRVBL_PCAP_COMPRESS_LEVEL'
+DEFAULT_PCAP_COMPRESS_LEVEL = '6'
+ENV_PCAP_COMPRESS_THREADS = 'OBSRVBL_PCAP_COMPRESS_THREADS'
+DEFAULT_PCAP_COMPRESS_THREADS = '2'
+# Set to "true" to compress finished pcaps as they're uploaded
+ENV_PCAP_STREAM_UPLOAD = 'OBSRVBL_PCAP_STREAM_UPLOAD'
+COPY_BUFSIZE = 1024 * 1024
+TEMP_SUFFIX = '.tmp'
+
+
+def _open_gzip(fileobj, level, file_path):
+    # Record the original name and time, like the gzip command does
+    return gzip.GzipFile(
+        filename=basename(file_path),
+        mode='wb',
+        compresslevel=level,
+        fileobj=fileobj,
+        mtime=int(stat(file_path).st_mtime),
+    )
+
+
+def _open_bz2(fileobj, level, file_path):
+    return bz2.BZ2File(fileobj, mode='wb', compresslevel=max(level, 1))
+
+
+def _open_lzma(fileobj, level, file_path):
+    return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+
+
+# Codec name -> (file suffix, function that opens a compressed writer)
+CODECS = {
+    'gzip': ('.gz', _open_gzip),
+    'bz2': ('.bz2', _open_bz2),
+    'xz': ('.xz', _open_lzma),
+}
+
+
+def compress_file(file_path, codec=DEFAULT_PCAP_COMPRESS_CODEC, level=6):
+    """
+    Compresses `file_path` with `codec` (see CODECS) at `level`, and removes
+    the original. The compressed file is written under a temporary name and
+    renamed into place once it's complete. Returns the compressed file's
+    path.
+    """
+    suffix, open_codec = CODECS[codec]
+    out_path = file_path + suffix
+    temp_path = out_path + TEMP_SUFFIX
+    try:
+        with open(file_path, 'rb') as infile, open(temp_path, 'wb') as raw:
+            with open_codec(raw, level, file_path) as outfile:
+                copyfileobj(infile, outfile, COPY_BUFSIZE)
+            raw.flush()
+            fsync(raw.fileno())
+        rename(temp_path, out_path)
+    except BaseException:
+        try:
+            remove(temp_path)
+        except OSError:
+            pass
+        raise
+    remove(file_path)
+
+    return out_path
+
+
+def iter_compressed(file_path, codec=DEFAULT_PCAP_COMPRESS_CODEC, level=6):
+    """
+    Yields the contents of `file_path`, compressed with `codec` (see CODECS)
+    at `level`, in chunks. Nothing is written to disk, and the output is the
+    same each time.
+    """
+    __, open_codec = CODECS[codec]
+    buffer = BytesIO()
+    with open(file_path, 'rb') as infile:
+        with open_codec(buffer, level, file_path) as outfile:
+            for chunk in iter(partial(infile.read, COPY_BUFSIZE), b''):
+                outfile.write(chunk)
+                if buffer.tell():
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
 
 class TcpdumpPusher(Service):
     """
@@ -33,24 +126,85 @@ class TcpdumpPusher(Service):
         makedirs(self.pcap_dir, exist_ok=True)
         super().__init__(*args, **kwargs)
 
+        self.codec = getenv(
+            ENV_PCAP_COMPRESS_CODEC, DEFAULT_PCAP_COMPRESS_CODEC
+        )
+        if self.codec not in CODECS:
+            logging.error('Unknown codec %s, using gzip', self.codec)
+            self.codec = DEFAULT_PCAP_COMPRESS_CODEC
+        self.compress_suffix = CODECS[self.codec][0]
+        # Uploads have always been gzipped; others are named for their codec
+        self.upload_suffix = (
+            '' if (self.codec == DEFAULT_PCAP_COMPRESS_CODEC)
+            else self.compress_suffix
+        )
+        self.compress_level = int(
+            getenv(ENV_PCAP_COMPRESS_LEVEL, DEFAULT_PCAP_COMPRESS_LEVEL)
+        )
+        # The compressors release the GIL, so files can be done in parallel
+        compress_threads = int(
+            getenv(ENV_PCAP_COMPRESS_THREADS, DEFAULT_PCAP_COMPRESS_THREADS)
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(compress_threads, 1)
+        )
+        self.stream_upload = (
+            getenv(ENV_PCAP_STREAM_UPLOAD, 'false') == 'true'
+        )
+
+    def _get_finished_pcaps(self):
+        # Skip the file with the most recent timestamp; it's not finished yet.
+        glob_pattern = join(self.pcap_dir, '{}_*.pcap'.format(self.data_type))
+        return sorted(iglob(glob_pattern))[:-1]
+
+    def _compress(self, file_path):
+        logging.info('Compressing %s', file_path)
+        try:
+            compress_file(file_path, self.codec, self.compress_level)
+        except OSError as e:
+            logging.error('Error compressing %s: %s', file_path, e)
+
+    def _remove_partial(self):
+        # Clean up after compressions that were interrupted
+        glob_pattern = join(
+            self.pcap_dir,
+            '{}_*.pcap*{}'.format(self.data_type, TEMP_SUFFIX),
+        )
+        for file_path in iglob(glob_pattern):
+            remove(file_path)
+
     def compress_pcaps(self):
         """
         Compresses the finished pcap files in the capture directory.
         """
-        # Skip the file with the most recent timestamp; it's not finished yet.
-        glob_pattern = join(self.pcap_dir, '{}_*.pcap'.format(self.data_type))
-        for file_path in sorted(iglob(glob_pattern))[:-1]:
-            logging.info('Compressing %s', file_path)
-            rc = call(['gzip', '-f', file_path])
-            if rc:
-                logging.error('Error compressing %s: %s', file_path, rc)
+        self._remove_partial()
+        file_paths = self._get_finished_pcaps()
+        list(self.executor.map(self._compress, file_paths))
+
+    def _get_stream_pcaps(self):
+        # The pcaps that push_files compresses as it sends them
+        return self._get_finished_pcaps()
+
+    def _send(self, file_path, ts, suffix):
+        if file_path.endswith(self.compress_suffix):
+            return self.api.send_file(
+                self.data_type, file_path, ts, suffix=suffix
+            )
+
+        get_data = partial(
+            iter_compressed, file_path, self.codec, self.compress_level
+        )
+        return self.api.send_stream(
+            self.data_type, get_data, ts, suffix=suffix
+        )
 
     def push_files(self, now):
         """
         Sends out the compressed pcap files in the capture directory, then
-        removes them.
+        removes them. In streaming mode, the finished pcap files are
+        compressed as they're sent, and then removed.
         """
-        logging.info('Pushing .pcap.gz files')
+        logging.info('Pushing .pcap%s files', self.compress_suffix)
         ret = []
         ts = now.replace(
             minute=(now.minute // 10) * 10,
@@ -59,17 +213,28 @@ class TcpdumpPusher(Service):
         )
 
         glob_pattern = join(
-            self.pcap_dir, '{}_*.pcap.gz'.format(self.data_type)
+            self.pcap_dir,
+            '{}_*.pcap{}'.format(self.data_type, self.compress_suffix),
         )
-        for i, file_path in enumerate(sorted(iglob(glob_pattern))):
-            remote_path = self.api.send_file(
-                self.data_type, file_path, ts, suffix='{:04}'.format(i)
-            )
+        # Compressed files can be left over from before streaming was on
+        file_paths = sorted(iglob(glob_pattern))
+        if self.stream_upload:
+            file_paths.extend(self._get_stream_pcaps())
+        for i, file_path in enumerate(file_paths):
+            suffix = '{:04}{}'.format(i, self.upload_suffix)
+            remote_path = self._send(file_path, ts, suffix)
             ret.append(remote_path)
             remove(file_path)
 
         return ret
 
     def execute(self, now=None):
-        self.compress_pcaps()
+        if not self.stream_upload:
+            self.compress_pcaps()
         return self.push_files(now)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.executor.shutdown()
@@ -22,7 +22,7 @@ from ipaddress import ip_address, IPv4Interface as ip_interface
 from os import devnull, makedirs
 from queue import Queue, Empty
 from subprocess import PIPE, Popen
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 from time import mktime, sleep
 
 
@@ -220,6 +220,7 @@ class persistent_dict(dict):
     def __init__(self, filename):
         super().__init__()
         self.filename = filename
+        self.lock = Lock()
         self._load()
 
     def _load(self):
@@ -235,8 +236,10 @@ class persistent_dict(dict):
             return json.dump(self, f)
 
     def __setitem__(self, key, value):
-        res = super().__setitem__(key, value)
-        self._save()
+        # Items may be set from multiple threads
+        with self.lock:
+            res = super().__setitem__(key, value)
+            self._save()
         return res
 
 
@@ -26,6 +26,7 @@ from ona_service.api import (
     requests,
     requests_exceptions,
     retry_connection,
+    SizedStream,
 )
 
 
@@ -106,6 +107,58 @@ class ApiTestCase(TestCase):
         self.assertEquals(mock_requests.request.call_count, 1)
         mock_upload_response.raise_for_status.assert_called_once_with()
 
+    @patch('ona_service.api.requests', autospec=True)
+    def test_send_stream(self, mock_requests):
+        mock_requests.get.return_value.json.return_value = {
+            'headers': 'headers!',
+            'url': 'url!',
+            'method': 'SUPERGET',
+            'path': 'remote_path!',
+        }
+        mock_upload = Mock()
+        mock_upload_response = Mock()
+
+        def request(*args, **kwargs):
+            # The body's length is known up front, and only part of it is
+            # read
+            data = kwargs['data']
+            self.assertEqual(len(data), 22)
+            kwargs['data'] = next(iter(data))
+            mock_upload(*args, **kwargs)
+            return mock_upload_response
+
+        mock_requests.request.side_effect = request
+
+        # The data is generated once to measure it and once to send it. The
+        # generator is closed once the request is done.
+        closed = []
+
+        def get_data():
+            try:
+                yield b'hee hee hee'
+                yield b'haw haw haw'
+            finally:
+                closed.append(True)
+
+        time = datetime.utcnow()
+        remote_path = self.api.send_stream('mytype', get_data, time)
+        self.assertEqual(remote_path, 'remote_path!')
+        mock_upload.assert_called_once_with(
+            'SUPERGET', 'url!',
+            headers='headers!', data=b'hee hee hee', verify=True,
+            timeout=HTTP_TIMEOUT)
+        self.assertEqual(closed, [True, True])
+        mock_upload_response.raise_for_status.assert_called_once_with()
+
+    def test_sized_stream(self):
+        # requests sends the stream with its length, not chunked
+        data = SizedStream(lambda: iter([b'hee', b'haw']), 6)
+        request = requests.Request('PUT', 'http://example.com', data=data)
+        prepared = request.prepare()
+        self.assertEqual(prepared.headers['Content-Length'], '6')
+        self.assertNotIn('Transfer-Encoding', prepared.headers)
+        self.assertEqual(b''.join(prepared.body), b'heehaw')
+
     @patch('ona_service.api.requests', autospec=True)
     def test_send_file_prefix_suffix(self, mock_requests):
         prefix = '20210219'
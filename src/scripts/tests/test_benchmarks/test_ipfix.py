@@ -0,0 +1,74 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os import listdir
+from os.path import exists
+from unittest import TestCase
+
+from ona_service.benchmarks.ipfix import (
+    _run_create_archives,
+    _setup_create_archives,
+    _teardown,
+    BIN_START,
+    generate_flows,
+    run_benchmarks,
+    STAGES,
+)
+from ona_service.flow_collector import NATIVE_FIELDS
+
+
+class IPFIXBenchmarkTestCase(TestCase):
+    def test_generate_flows(self):
+        # Same seed, same flows
+        flows = generate_flows(1000, seed=1)
+        self.assertEqual(len(flows), 1000)
+        self.assertEqual(flows, generate_flows(1000, seed=1))
+        self.assertNotEqual(flows, generate_flows(1000, seed=2))
+        self.assertEqual(list(flows[0]), NATIVE_FIELDS)
+
+        # 5-tuples repeat
+        tuples = {tuple(x[k] for k in NATIVE_FIELDS[:5]) for x in flows}
+        self.assertLess(len(tuples), len(flows))
+
+    def test_generate_flows_quirks(self):
+        flows = generate_flows(1000, seed=1, source='asa')
+        self.assertTrue(any(x['protocol'] == '0' for x in flows))
+
+        flows = generate_flows(1000, seed=1, source='meraki')
+        tuples = {tuple(x[k] for k in NATIVE_FIELDS[:5]) for x in flows}
+        self.assertLess(len(tuples), len(flows) // 2)
+
+    def test_run_benchmarks(self):
+        # The quirks stage only runs when there's a source to be quirky
+        for source, expected in [
+            (None, [x for x in STAGES if x != 'quirks']),
+            ('meraki', list(STAGES)),
+        ]:
+            results = run_benchmarks(100, source=source, isolate=False)
+            self.assertEqual(list(results['stages']), expected)
+            for values in results['stages'].values():
+                self.assertEqual(values['rows'], 100)
+
+        with self.assertRaises(ValueError):
+            run_benchmarks(100, stages=['quirks'], isolate=False)
+
+    def test_create_archives(self):
+        # The whole pass over a bin leaves one archive and no input files
+        state = _setup_create_archives(100, 0, None)
+        try:
+            file_list = state['D_archive'][BIN_START]
+            self.assertEqual(_run_create_archives(state), 100)
+            self.assertFalse(any(exists(x) for x in file_list))
+            self.assertEqual(len(listdir(state['pusher'].output_dir)), 1)
+        finally:
+            _teardown(state)
@@ -0,0 +1,52 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.benchmarks.logs import (
+    generate_auth_lines,
+    read_lines,
+    run_benchmarks,
+    STAGES,
+)
+
+
+class LogsBenchmarkTestCase(TestCase):
+    def test_generate_auth_lines(self):
+        lines = generate_auth_lines(100, seed=1)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(lines, generate_auth_lines(100, seed=1))
+        self.assertTrue(all(x.endswith(b'\n') for x in lines))
+
+    def test_read_lines(self):
+        with TemporaryDirectory() as temp_dir:
+            file_path = join(temp_dir, 'auth.log')
+            with open(file_path, 'wb') as outfile:
+                outfile.write(b'one\ntwo\n')
+            actual = read_lines(file_path, 5)
+        expected = [b'one\n', b'two\n', b'one\n', b'two\n', b'one\n']
+        self.assertEqual(actual, expected)
+
+    def test_run_benchmarks(self):
+        lines = generate_auth_lines(1000)
+        results = run_benchmarks(lines, isolate=False)
+        self.assertEqual(list(results['stages']), list(STAGES))
+
+        per_line = results['stages']['per_line']
+        streaming = results['stages']['streaming']
+        self.assertEqual(streaming['rows'], 1000)
+        self.assertLess(
+            streaming['compressed_bytes'], per_line['compressed_bytes']
+        )
@@ -0,0 +1,115 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from io import StringIO
+from os import _exit
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from ona_service.benchmarks.runner import (
+    compare_results,
+    main,
+    measure,
+    save_results,
+)
+
+
+def _results(rate, rss):
+    return {
+        'stages': {
+            'one': {'rows_per_sec': rate, 'peak_rss_kb': rss},
+        }
+    }
+
+
+class RunnerTestCase(TestCase):
+    def test_measure(self):
+        calls = []
+
+        for isolate in (False, True):
+            actual = measure(
+                lambda x: [x] * 10,
+                lambda state: len(state),
+                args=(1,),
+                teardown=calls.append,
+                isolate=isolate,
+            )
+            self.assertEqual(actual['rows'], 10)
+            self.assertGreater(actual['peak_rss_kb'], 0)
+
+        # The teardown for the isolated run happened in the child
+        self.assertEqual(calls, [[1] * 10])
+
+    def test_measure_crash(self):
+        # A child that dies without a result doesn't hang the run
+        with self.assertRaises(RuntimeError):
+            measure(lambda: None, lambda state: _exit(9))
+
+    def test_measure_timeout(self):
+        with self.assertRaises(RuntimeError):
+            measure(lambda: None, lambda state: sleep(60), timeout=1)
+
+    def test_compare_results(self):
+        old = _results(1000.0, 1000)
+
+        # Within the threshold
+        self.assertEqual(compare_results(old, _results(950.0, 1050)), [])
+
+        # Slower and bigger
+        actual = compare_results(old, _results(800.0, 1200))
+        expected = [
+            ('one', 'rows_per_sec', 1000.0, 800.0),
+            ('one', 'peak_rss_kb', 1000, 1200),
+        ]
+        self.assertEqual(actual, expected)
+
+        # Custom threshold
+        self.assertEqual(
+            compare_results(old, _results(800.0, 1200), threshold=0.5), []
+        )
+
+    def test_compare_results_mismatch(self):
+        # Runs with different settings aren't compared
+        old = dict(_results(1000.0, 1000), rows=100, seed=0, source=None)
+        for key, value in [('rows', 200), ('seed', 1), ('source', 'asa')]:
+            new = dict(old, **{key: value})
+            with self.assertRaises(ValueError):
+                compare_results(old, new)
+
+        # A setting missing from one run
+        new = dict(_results(1000.0, 1000), rows=100, source=None)
+        with self.assertRaises(ValueError):
+            compare_results(old, new)
+
+    def test_main(self):
+        with TemporaryDirectory() as temp_dir:
+            old_path = join(temp_dir, 'old.json')
+            new_path = join(temp_dir, 'new.json')
+            save_results(_results(1000.0, 1000), old_path)
+            save_results(_results(500.0, 1000), new_path)
+
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                self.assertEqual(main([old_path, old_path]), 0)
+                self.assertEqual(main([old_path, new_path]), 1)
+            self.assertIn(
+                'REGRESSION one rows_per_sec', mock_stdout.getvalue()
+            )
+
+            # Runs with different settings can't be compared
+            save_results(dict(_results(1000.0, 1000), seed=1), new_path)
+            with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+                self.assertEqual(main([old_path, new_path]), 2)
+            self.assertIn('Cannot compare', mock_stdout.getvalue())
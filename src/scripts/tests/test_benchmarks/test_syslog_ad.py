@@ -0,0 +1,51 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest import TestCase
+
+from ona_service.benchmarks.syslog_ad import (
+    generate_ad_lines,
+    run_benchmarks,
+    STAGES,
+)
+
+
+class SyslogADBenchmarkTestCase(TestCase):
+    def test_generate_ad_lines(self):
+        lines = generate_ad_lines(100, seed=1)
+        self.assertEqual(lines, generate_ad_lines(100, seed=1))
+        self.assertTrue(all(x.endswith(b'\n') for x in lines))
+
+        # All one-line events
+        lines = generate_ad_lines(100, oneline_share=1.0)
+        self.assertEqual(len(lines), 100)
+
+    def test_run_benchmarks(self):
+        lines = generate_ad_lines(200, oneline_share=0.0)
+        results = run_benchmarks(lines, isolate=False)
+        self.assertEqual(list(results['stages']), list(STAGES))
+
+        # The last multi-line event isn't complete
+        self.assertEqual(results['stages']['legacy']['rows'], 199)
+        self.assertEqual(results['stages']['compiled']['rows'], 199)
+        self.assertLess(results['stages']['logons']['rows'], 199)
+
+    def test_run_benchmarks_sharded(self):
+        lines = generate_ad_lines(200, oneline_share=0.3)
+        results = run_benchmarks(
+            lines, ['formatted', 'sharded-2'], isolate=False
+        )
+        self.assertEqual(
+            results['stages']['sharded-2']['rows'],
+            results['stages']['formatted']['rows'],
+        )
@@ -0,0 +1,104 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.dedup_cache import DedupCache
+
+
+class DedupCacheTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.snapshot_path = join(self.temp_dir.name, 'snapshot')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_is_duplicate(self):
+        cache = DedupCache(60)
+        self.assertFalse(cache.is_duplicate(1, 1000))
+        self.assertTrue(cache.is_duplicate(1, 1059))
+        self.assertTrue(cache.is_duplicate(1, 941))
+        self.assertFalse(cache.is_duplicate(2, 1000))
+
+        # Hits don't extend the window
+        self.assertFalse(cache.is_duplicate(1, 1060))
+        self.assertTrue(cache.is_duplicate(1, 1119))
+
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 3)
+
+    def test_check_add(self):
+        # Checking doesn't remember anything
+        cache = DedupCache(60)
+        self.assertFalse(cache.check(1, 1000))
+        self.assertFalse(cache.check(1, 1000))
+        self.assertEqual(len(cache), 0)
+        self.assertFalse(cache.is_dirty)
+
+        cache.add(1, 1000)
+        self.assertTrue(cache.check(1, 1030))
+        self.assertFalse(cache.check(1, 1060))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_max_entries(self):
+        cache = DedupCache(60, max_entries=2)
+        for key in (1, 2, 3):
+            cache.is_duplicate(key, 1000)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertNotIn(1, cache)
+
+        # Keys that are let through again count as new
+        cache.is_duplicate(2, 1100)
+        cache.is_duplicate(4, 1100)
+        self.assertEqual(list(cache.entries), [2, 4])
+
+    def test_expire(self):
+        cache = DedupCache(60)
+        cache.is_duplicate(1, 1000)
+        cache.is_duplicate(2, 1030)
+        cache.expire(1060)
+        self.assertEqual(list(cache.entries), [2])
+        cache.expire(1090)
+        self.assertEqual(len(cache), 0)
+
+    def test_snapshot(self):
+        cache = DedupCache(60, snapshot_path=self.snapshot_path)
+        self.assertEqual(len(cache), 0)
+        cache.is_duplicate(2 ** 64 - 1, 1000)
+        cache.is_duplicate(1, 1001)
+        cache.save()
+        self.assertFalse(cache.is_dirty)
+
+        # The keys survive a restart, in order
+        cache = DedupCache(60, snapshot_path=self.snapshot_path)
+        self.assertEqual(
+            list(cache.entries.items()), [(2 ** 64 - 1, 1000), (1, 1001)]
+        )
+        self.assertTrue(cache.is_duplicate(1, 1002))
+
+        # A smaller budget is applied
+        cache = DedupCache(
+            60, max_entries=1, snapshot_path=self.snapshot_path
+        )
+        self.assertEqual(list(cache.entries), [1])
+
+    def test_snapshot_invalid(self):
+        for data in (b'', b'bogus', b'ODC1\x01\x00\x00\x00\x01'):
+            with open(self.snapshot_path, 'wb') as f:
+                f.write(data)
+            cache = DedupCache(60, snapshot_path=self.snapshot_path)
+            self.assertEqual(len(cache), 0)
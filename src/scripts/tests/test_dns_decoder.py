@@ -0,0 +1,113 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+
+from struct import pack
+from unittest import TestCase
+
+from ona_service.dns_decoder import (
+    decode_name,
+    decode_response,
+    DNSAnswer,
+    DNSResponse,
+)
+
+
+def encode_name(name):
+    ret = b''
+    for label in name.split('.'):
+        if label:
+            ret += bytes([len(label)]) + label.encode('ascii')
+    return ret + b'\x00'
+
+
+def make_dns_response(qname, qtype, answers, rcode=0, flags=0x8180):
+    """
+    Returns a DNS response to a `qtype` query for `qname`. `answers` is a
+    list of (type, TTL, rdata) tuples. Each answer's name is a pointer to
+    the question's name.
+    """
+    ret = pack('!HHHHHH', 0x1234, flags | rcode, 1, len(answers), 0, 0)
+    ret += encode_name(qname) + pack('!HH', qtype, 1)
+    for rtype, ttl, rdata in answers:
+        ret += pack('!HHHIH', 0xc00c, rtype, 1, ttl, len(rdata)) + rdata
+    return ret
+
+
+class DNSDecoderTestCase(TestCase):
+    def test_decode_name(self):
+        message = b'\x00\x00' + encode_name('Example.COM') + b'\x03www\xc0\x02'
+        self.assertEqual(decode_name(message, 2), ('example.com', 15))
+        self.assertEqual(decode_name(message, 15), ('www.example.com', 21))
+        self.assertEqual(decode_name(b'\x00', 0), ('', 1))
+
+        for message in [
+            # Pointer loop
+            b'\xc0\x00',
+            # Truncated
+            b'\x03ww',
+            b'\x03www',
+            # Invalid label length
+            b'\x40' + b'a' * 64 + b'\x00',
+        ]:
+            with self.assertRaises(ValueError):
+                decode_name(message, 0)
+
+    def test_decode_response(self):
+        answers = [
+            (5, 300, encode_name('cdn.example.net')),
+            (1, 60, socket.inet_aton('192.0.2.1')),
+            (28, 60, socket.inet_pton(socket.AF_INET6, '2001:db8::1')),
+            (15, 3600, b'\x00\x0a' + b'\x04mail\xc0\x0c'),
+            (16, 5, b'\x02hi'),
+        ]
+        message = make_dns_response('www.example.com', 1, answers)
+        self.assertEqual(
+            decode_response(memoryview(message)),
+            DNSResponse(
+                'www.example.com',
+                1,
+                0,
+                [
+                    DNSAnswer(5, 300, 'cdn.example.net'),
+                    DNSAnswer(1, 60, '192.0.2.1'),
+                    DNSAnswer(28, 60, '2001:db8::1'),
+                    DNSAnswer(15, 3600, 'mail.www.example.com'),
+                    DNSAnswer(16, 5, '026869'),
+                ],
+            ),
+        )
+
+        # Errors have no answers
+        message = make_dns_response('nope.example.com', 28, [], rcode=3)
+        self.assertEqual(
+            decode_response(message),
+            DNSResponse('nope.example.com', 28, 3, []),
+        )
+
+    def test_decode_response_invalid(self):
+        response = make_dns_response(
+            'www.example.com', 1, [(1, 60, socket.inet_aton('192.0.2.1'))]
+        )
+        for message in [
+            # Queries
+            make_dns_response('www.example.com', 1, [], flags=0x0100),
+            # No question
+            pack('!HHHHHH', 0, 0x8180, 0, 0, 0, 0),
+            # Truncated
+            response[:-1],
+            response[:5],
+        ]:
+            with self.assertRaises(ValueError):
+                decode_response(message)
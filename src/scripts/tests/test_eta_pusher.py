@@ -11,14 +11,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bz2
+import gzip
+
 from datetime import datetime
-from os import listdir
+from os import environ, listdir
 from os.path import join
 from shutil import rmtree
 from unittest import TestCase
-from unittest.mock import call as MockCall, MagicMock
+from unittest.mock import ANY, call as MockCall, MagicMock, patch
 
 from ona_service.eta_pusher import EtaPusher
+from ona_service.flow_collector import decode_v9, TemplateCache
+from ona_service.flow_export import read_messages
+
+from tests.test_flow_collector import make_v9
+from tests.test_flow_export import EXPORTER, make_export_pcap
 
 
 class EtaPusherTestCase(TestCase):
@@ -63,3 +71,76 @@ class EtaPusherTestCase(TestCase):
         for args, kwargs in self.inst.api.send_signal.call_args_list:
             self.assertEqual(args, ('logs',))
             self.assertEqual(kwargs['data']['log_type'], 'eta-pcap')
+
+    def test_eta_pusher_messages(self):
+        with patch.dict(environ, {'OBSRVBL_ETA_FORMAT': 'messages'}):
+            self.inst = EtaPusher()
+        self.inst.api = MagicMock()
+
+        # The template is only in the first capture
+        for n, messages in [
+            (1, [make_v9()]),
+            (2, [make_v9(template=False), make_v9(template=False)]),
+            (3, [make_v9(template=False)]),
+        ]:
+            file_path = join(self.inst.pcap_dir, 'logs_{}.pcap'.format(n))
+            with open(file_path, 'wb') as outfile:
+                outfile.write(make_export_pcap(messages))
+
+        sent = []
+
+        def send_file(data_type, path, now, suffix=None):
+            with gzip.open(path, 'rb') as infile:
+                sent.append(list(read_messages(infile)))
+            return 'file:///tmp/{}/{}'.format(data_type, suffix)
+
+        self.inst.api.send_file.side_effect = send_file
+        now = datetime(2018, 4, 16, 14, 9, 33)
+        self.inst.execute(now=now)
+
+        # The pcaps are replaced by their messages
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sorted(listdir(self.inst.pcap_dir)), ['logs_3.pcap'])
+
+        # Each upload can be decoded by itself, since the templates from
+        # earlier captures come first
+        self.assertEqual(len(sent[1]), 3)
+        cache = TemplateCache()
+        flows = []
+        for ts, exporter, message in sent[1]:
+            self.assertEqual(exporter, EXPORTER)
+            flows.extend(decode_v9(message, cache, exporter))
+        self.assertEqual(len(flows), 2)
+
+        for args, kwargs in self.inst.api.send_signal.call_args_list:
+            self.assertEqual(args, ('logs',))
+            self.assertEqual(kwargs['data']['log_type'], 'eta-messages')
+        self.assertEqual(self.inst.api.send_signal.call_count, 2)
+
+    def test_execute_messages_codec(self):
+        env = {
+            'OBSRVBL_ETA_FORMAT': 'messages',
+            'OBSRVBL_PCAP_COMPRESS_CODEC': 'bz2',
+        }
+        with patch.dict(environ, env):
+            self.inst = EtaPusher()
+        self.inst.api = MagicMock()
+        for n in (1, 2):
+            file_path = join(self.inst.pcap_dir, 'logs_{}.pcap'.format(n))
+            with open(file_path, 'wb') as outfile:
+                outfile.write(make_export_pcap([make_v9()]))
+
+        sent = []
+
+        def send_file(data_type, path, now, suffix=None):
+            with bz2.open(path, 'rb') as infile:
+                sent.append(list(read_messages(infile)))
+            return 'file:///tmp/{}/{}'.format(data_type, suffix)
+
+        # The upload's name says which codec was used
+        self.inst.api.send_file.side_effect = send_file
+        self.inst.execute(now=datetime(2018, 4, 16, 14, 9, 33))
+        self.assertEqual(len(sent), 1)
+        self.inst.api.send_file.assert_called_once_with(
+            'logs', ANY, ANY, suffix='0000.bz2'
+        )
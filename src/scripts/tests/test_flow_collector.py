@@ -0,0 +1,352 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+
+from os import listdir
+from os.path import join
+from struct import pack
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.flow_collector import (
+    decode_ipfix,
+    decode_sflow,
+    decode_v5,
+    decode_v9,
+    FlowCollector,
+    iter_pcap_payloads,
+    ProbeWriter,
+    TemplateCache,
+)
+from ona_service.flowcap_config import ProbeItem
+
+
+def _aton(x):
+    return socket.inet_aton(x)
+
+
+def make_v5(flows, sys_uptime=10000, unix_secs=1500000000):
+    header = pack(
+        '!HHIIIIBBH', 5, len(flows), sys_uptime, unix_secs, 0, 1, 0, 0, 0
+    )
+    records = []
+    for src, dst, sport, dport, proto, bytes_, packets in flows:
+        records.append(
+            pack(
+                '!4s4s4sHHIIIIHHBBBBHHBBH',
+                _aton(src), _aton(dst), _aton('0.0.0.0'), 1, 2,
+                packets, bytes_, 4000, 9000, sport, dport,
+                0, 0, proto, 0, 0, 0, 0, 0, 0
+            )
+        )
+    return header + b''.join(records)
+
+
+# sourceIPv4Address, destinationIPv4Address, sourceTransportPort,
+# destinationTransportPort, protocolIdentifier, octetDeltaCount,
+# packetDeltaCount, flowStartSeconds, flowEndSeconds, and one unknown field
+TEMPLATE_FIELDS = [
+    (8, 4), (12, 4), (7, 2), (11, 2), (4, 1), (1, 8), (2, 4), (150, 4),
+    (151, 4), (5, 1),
+]
+
+
+def _make_template(template_id):
+    parts = [pack('!HH', template_id, len(TEMPLATE_FIELDS))]
+    parts.extend(pack('!HH', *x) for x in TEMPLATE_FIELDS)
+    return b''.join(parts)
+
+
+def _make_record(src, dst, sport, dport, proto, bytes_, packets):
+    return pack(
+        '!4s4sHHBQIIIB',
+        _aton(src), _aton(dst), sport, dport, proto, bytes_, packets,
+        1500000000, 1500000005, 0
+    )
+
+
+def _make_set(set_id, body):
+    return pack('!HH', set_id, len(body) + 4) + body
+
+
+def make_v9(template=True, data=True):
+    sets = []
+    if template:
+        sets.append(_make_set(0, _make_template(256)))
+    if data:
+        sets.append(
+            _make_set(
+                256,
+                _make_record('10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2)
+            )
+        )
+    header = pack('!HHIIII', 9, len(sets), 10000, 1500000000, 1, 7)
+    return header + b''.join(sets)
+
+
+def make_ipfix(template=True, data=True):
+    sets = []
+    if template:
+        sets.append(_make_set(2, _make_template(300)))
+    if data:
+        body = (
+            _make_record('10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2) +
+            _make_record('10.0.0.2', '192.0.2.2', 1025, 443, 17, 200, 3)
+        )
+        sets.append(_make_set(300, body))
+    body = b''.join(sets)
+    header = pack('!HHIII', 10, len(body) + 16, 1500000000, 1, 0)
+    return header + body
+
+
+def make_sflow():
+    ip_header = pack(
+        '!BBHHHBBH4s4s',
+        0x45, 0, 40, 0, 0, 64, 6, 0, _aton('10.0.0.1'), _aton('192.0.2.1')
+    )
+    frame = b'\x00' * 12 + pack('!H', 0x0800) + ip_header + pack(
+        '!HH', 1024, 80
+    )
+    raw_record = pack('!4I', 1, 1500, 4, len(frame)) + frame
+    record = pack('!II', 1, len(raw_record)) + raw_record
+    sample = pack('!8I', 1, 1, 100, 0, 0, 3, 4, 1) + record
+    return pack(
+        '!II4sIIII', 5, 1, _aton('192.0.2.100'), 0, 1, 0, 1
+    ) + pack('!II', 1, len(sample)) + sample
+
+
+class DecoderTestCase(TestCase):
+    def test_decode_v5(self):
+        data = make_v5(
+            [
+                ('10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2),
+                ('10.0.0.2', '192.0.2.2', 1025, 53, 17, 60, 1),
+            ]
+        )
+        actual = decode_v5(data)
+        expected = [
+            (
+                '10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2,
+                1499999994, 1499999999, 1, 2
+            ),
+            (
+                '10.0.0.2', '192.0.2.2', 1025, 53, 17, 60, 1,
+                1499999994, 1499999999, 1, 2
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_decode_v9(self):
+        cache = TemplateCache()
+
+        # Data before the template is dropped
+        self.assertEqual(decode_v9(make_v9(template=False), cache, 'a'), [])
+
+        # Template and data together
+        actual = decode_v9(make_v9(), cache, 'a')
+        expected = [
+            (
+                '10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2,
+                1500000000, 1500000005, 0, 0
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+        # The template is remembered for the exporter, but not for others
+        actual = decode_v9(make_v9(template=False), cache, 'a')
+        self.assertEqual(actual, expected)
+        self.assertEqual(decode_v9(make_v9(template=False), cache, 'b'), [])
+
+    def test_decode_ipfix(self):
+        cache = TemplateCache()
+        decode_ipfix(make_ipfix(data=False), cache, 'a')
+
+        actual = decode_ipfix(make_ipfix(template=False), cache, 'a')
+        expected = [
+            (
+                '10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2,
+                1500000000, 1500000005, 0, 0
+            ),
+            (
+                '10.0.0.2', '192.0.2.2', 1025, 443, 17, 200, 3,
+                1500000000, 1500000005, 0, 0
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_decode_empty_template(self):
+        # Templates with no length are ignored, rather than decoding forever
+        cache = TemplateCache()
+        for fields in ([(210, 0)], [(210, 0), (8, 0)]):
+            template = pack('!HH', 400, len(fields)) + b''.join(
+                pack('!HH', *x) for x in fields
+            )
+            body = _make_set(2, template) + _make_set(400, b'\x00' * 8)
+            data = pack('!HHIII', 10, len(body) + 16, 1500000000, 1, 0) + body
+            self.assertEqual(decode_ipfix(data, cache, 'a'), [])
+            self.assertIsNone(cache.get('a', 0, 400))
+
+    def test_decode_ipfix_variable(self):
+        cache = TemplateCache()
+        fields = [(8, 4), (12, 4), (96, 65535), (1, 4)]
+        template = pack('!HH', 400, len(fields)) + b''.join(
+            pack('!HH', *x) for x in fields
+        )
+        record = (
+            _aton('10.0.0.1') + _aton('192.0.2.1') + b'\x03abc' +
+            pack('!I', 1000)
+        )
+        body = _make_set(2, template) + _make_set(400, record)
+        data = pack('!HHIII', 10, len(body) + 16, 1500000000, 1, 0) + body
+
+        actual = decode_ipfix(data, cache, 'a')
+        expected = [
+            (
+                '10.0.0.1', '192.0.2.1', 0, 0, 0, 1000, 0,
+                1500000000, 1500000000, 0, 0
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+        # Padding at the end of a set isn't decoded, and a record that runs
+        # past the end of its set is skipped. Neither reads into the next set.
+        body = (
+            _make_set(400, record + b'\x00\x00\x00') +
+            _make_set(400, record[:-1]) +
+            _make_set(400, record)
+        )
+        data = pack('!HHIII', 10, len(body) + 16, 1500000000, 1, 0) + body
+        actual = decode_ipfix(data, cache, 'a')
+        self.assertEqual(actual, expected * 2)
+
+    def test_decode_sflow(self):
+        actual = decode_sflow(make_sflow(), now=1500000000)
+        expected = [
+            (
+                '10.0.0.1', '192.0.2.1', 1024, 80, 6, 150000, 100,
+                1500000000, 1500000000, 3, 4
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+
+class FlowCollectorTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.probes = [
+            ProbeItem('1', 'netflow-v5', 2055, 'udp', None, False),
+            ProbeItem('2', 'ipfix', 4739, 'udp', None, False),
+        ]
+        self.inst = FlowCollector(
+            output_dir=self.temp_dir.name, probes=self.probes
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_handle_packet(self):
+        flows = [('10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2)]
+        self.inst.handle_packet(
+            self.probes[0], make_v5(flows), '192.0.2.100', now=1500000000
+        )
+        self.inst.handle_packet(
+            self.probes[1], make_ipfix(), '192.0.2.100', now=1500000000
+        )
+
+        # Garbage is ignored
+        self.inst.handle_packet(
+            self.probes[1], b'\x00\x0a', '192.0.2.100', now=1500000000
+        )
+
+        # Files are hidden until they're closed
+        self.assertEqual(
+            sorted(listdir(self.temp_dir.name)),
+            ['.20170714024000_S1.000000.csv', '.20170714024000_S2.000000.csv'],
+        )
+        self.inst.close()
+        self.assertEqual(
+            sorted(listdir(self.temp_dir.name)),
+            ['20170714024000_S1.000000.csv', '20170714024000_S2.000000.csv'],
+        )
+
+        file_path = join(self.temp_dir.name, '20170714024000_S1.000000.csv')
+        with open(file_path) as f:
+            actual = f.read()
+        expected = (
+            '10.0.0.1,192.0.2.1,1024,80,6,100,2,1499999994,1499999999,1,2\n'
+        )
+        self.assertEqual(actual, expected)
+
+        file_path = join(self.temp_dir.name, '20170714024000_S2.000000.csv')
+        with open(file_path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_rotation(self):
+        writer = ProbeWriter('S1', self.temp_dir.name, 1024)
+        flow = ('10.0.0.1', '192.0.2.1', 1, 2, 6, 1, 1, 0, 0, 0, 0)
+
+        writer.write([flow], 1500000000)
+        writer.write([flow], 1500000059)
+        writer.write([flow], 1500000060)
+        writer.close()
+
+        actual = sorted(listdir(self.temp_dir.name))
+        expected = [
+            '20170714024000_S1.000000.csv',
+            '20170714024100_S1.000001.csv',
+        ]
+        self.assertEqual(actual, expected)
+        self.assertEqual(writer.flow_count, 3)
+
+    def test_rotation_size(self):
+        # Files rotated within the same second get their own names
+        writer = ProbeWriter('S1', self.temp_dir.name, 10)
+        flow = ('10.0.0.1', '192.0.2.1', 1, 2, 6, 1, 1, 0, 0, 0, 0)
+        for __ in range(3):
+            writer.write([flow], 1500000000)
+        writer.close()
+
+        actual = sorted(listdir(self.temp_dir.name))
+        expected = [
+            '20170714024000_S1.000000.csv',
+            '20170714024000_S1.000001.csv',
+            '20170714024000_S1.000002.csv',
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_duplicate_probes(self):
+        probes = self.probes + [
+            ProbeItem('3', 'netflow-v9', 2055, 'udp', None, False),
+            ProbeItem('4', 'ipfix', 2055, 'tcp', None, False),
+        ]
+        inst = FlowCollector(output_dir=self.temp_dir.name, probes=probes)
+        self.assertEqual(inst.probes, self.probes + probes[-1:])
+
+    def test_iter_pcap_payloads(self):
+        payload = make_v5([('10.0.0.1', '192.0.2.1', 1024, 80, 6, 100, 2)])
+        udp = pack('!HHHH', 12345, 2055, len(payload) + 8, 0) + payload
+        ip = pack(
+            '!BBHHHBBH4s4s',
+            0x45, 0, len(udp) + 20, 0, 0, 64, 17, 0,
+            _aton('192.0.2.100'), _aton('192.0.2.200')
+        )
+        frame = b'\x00' * 12 + pack('!H', 0x0800) + ip + udp
+        pcap = pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+        pcap += pack('<IIII', 0, 0, len(frame), len(frame)) + frame
+
+        file_path = join(self.temp_dir.name, 'replay.pcap')
+        with open(file_path, 'wb') as outfile:
+            outfile.write(pcap)
+
+        self.assertEqual(list(iter_pcap_payloads(file_path)), [payload])
@@ -0,0 +1,159 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from random import Random
+from unittest import TestCase
+
+from ona_service.flow_compactor import FlowCompactor
+
+
+def _row(src, dst, sport, dport, bytes_, start=100, end=200):
+    return {
+        'srcaddr': src,
+        'dstaddr': dst,
+        'srcport': str(sport),
+        'dstport': str(dport),
+        'protocol': '6',
+        'bytes': str(bytes_),
+        'packets': '1',
+        'start': str(start),
+        'end': str(end),
+    }
+
+
+class FlowCompactorTestCase(TestCase):
+    def test_compact(self):
+        rows = [
+            # Heavy hitters, one reported twice
+            _row('10.0.0.1', '192.0.2.1', 1024, 443, 50000, start=90),
+            _row('10.0.0.2', '192.0.2.1', 1025, 443, 40000),
+            _row('10.0.0.1', '192.0.2.1', 1024, 443, 50000, end=210),
+            # Scan traffic
+            _row('192.0.2.9', '10.0.0.1', 40000, 1, 60, start=50),
+            _row('192.0.2.9', '10.0.0.1', 40000, 2, 60),
+            _row('192.0.2.9', '10.0.0.1', 40000, 3, 60, end=300),
+            _row('192.0.2.9', '10.0.0.2', 40000, 1, 60),
+        ]
+        inst = FlowCompactor(top_k=3)
+        actual = list(inst.compact(rows))
+        expected = [
+            {
+                'srcaddr': '10.0.0.1',
+                'dstaddr': '192.0.2.1',
+                'srcport': '1024',
+                'dstport': '443',
+                'protocol': '6',
+                'bytes': 100000,
+                'packets': 2,
+                'start': 90,
+                'end': 210,
+                'rollup': '0',
+            },
+            {
+                'srcaddr': '10.0.0.2',
+                'dstaddr': '192.0.2.1',
+                'srcport': '1025',
+                'dstport': '443',
+                'protocol': '6',
+                'bytes': 40000,
+                'packets': 1,
+                'start': 100,
+                'end': 200,
+                'rollup': '0',
+            },
+            # The table filled up with the first scan flow
+            {
+                'srcaddr': '192.0.2.9',
+                'dstaddr': '10.0.0.1',
+                'srcport': '40000',
+                'dstport': '1',
+                'protocol': '6',
+                'bytes': 60,
+                'packets': 1,
+                'start': 50,
+                'end': 200,
+                'rollup': '0',
+            },
+            # The others were rolled up
+            {
+                'srcaddr': '192.0.2.9',
+                'dstaddr': '10.0.0.1',
+                'srcport': 0,
+                'dstport': 0,
+                'protocol': '6',
+                'bytes': 120,
+                'packets': 2,
+                'start': 100,
+                'end': 300,
+                'rollup': '1',
+            },
+            {
+                'srcaddr': '192.0.2.9',
+                'dstaddr': '10.0.0.2',
+                'srcport': 0,
+                'dstport': 0,
+                'protocol': '6',
+                'bytes': 60,
+                'packets': 1,
+                'start': 100,
+                'end': 200,
+                'rollup': '1',
+            },
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_totals(self):
+        # Lots of flows: bytes are conserved and memory is bounded
+        rng = Random(1)
+        rows = [
+            _row(
+                '10.0.0.{}'.format(rng.randint(1, 20)),
+                '192.0.2.{}'.format(rng.randint(1, 20)),
+                rng.randint(1024, 2048),
+                443,
+                rng.randint(40, 100000),
+            )
+            for __ in range(5000)
+        ]
+        inst = FlowCompactor(top_k=50, max_rollups=100)
+        actual = list(inst.compact(rows))
+
+        self.assertEqual(
+            sum(x['bytes'] for x in actual),
+            sum(int(x['bytes']) for x in rows),
+        )
+        self.assertEqual(len(inst.monitored), 50)
+        self.assertLessEqual(len(inst.heap), 4 * 50 + 17)
+        self.assertLessEqual(len(inst.rollups), 101)
+        self.assertIn(
+            ('0.0.0.0', '0.0.0.0', '6'), set(inst.rollups)
+        )
+
+    def test_heavy_hitters_found(self):
+        rng = Random(2)
+        rows = [
+            _row('10.0.1.1', '192.0.2.{}'.format(i), 1, 1, 10 ** 6)
+            for i in range(5)
+        ]
+        rows += [
+            _row('10.0.0.1', '192.0.2.1', rng.randint(1, 65535), 80, 100)
+            for __ in range(2000)
+        ]
+        rng.shuffle(rows)
+
+        inst = FlowCompactor(top_k=10)
+        exact = [x for x in inst.compact(rows) if x['rollup'] == '0']
+        self.assertEqual(
+            {x['dstaddr'] for x in exact[:5]},
+            {'192.0.2.{}'.format(i) for i in range(5)},
+        )
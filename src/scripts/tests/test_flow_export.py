@@ -0,0 +1,149 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+
+from io import BytesIO
+from os.path import join
+from struct import pack
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.flow_collector import decode_ipfix, decode_v9, TemplateCache
+from ona_service.flow_export import (
+    ExportMessage,
+    iter_export_messages,
+    read_messages,
+    TemplateStore,
+    write_messages,
+)
+
+from tests.test_flow_collector import (
+    _make_set,
+    make_ipfix,
+    make_v5,
+    make_v9,
+)
+from tests.test_pcap_reader import make_ethernet, make_ip_udp, make_pcap
+
+EXPORTER = socket.inet_aton('192.0.2.100')
+
+
+def make_export_pcap(messages):
+    """
+    Returns a pcap file with `messages` sent from EXPORTER to port 2055.
+    """
+    frames = []
+    for i, message in enumerate(messages, 1):
+        packet = make_ip_udp('192.0.2.100', '192.0.2.1', 1024, 2055, message)
+        frames.append((float(i), make_ethernet(packet)))
+    return make_pcap(frames)
+
+
+class FlowExportTestCase(TestCase):
+    def test_iter_export_messages(self):
+        v9 = make_v9()
+        ipfix = make_ipfix()
+        with TemporaryDirectory() as temp_dir:
+            file_path = join(temp_dir, 'logs_1.pcap')
+            with open(file_path, 'wb') as outfile:
+                outfile.write(
+                    make_export_pcap(
+                        [
+                            v9,
+                            # Trailing bytes aren't part of the message
+                            ipfix + b'\x00\x00',
+                            # Truncated
+                            ipfix[:-1],
+                            # Other versions
+                            make_v5([]),
+                            b'\x00',
+                        ]
+                    )
+                )
+            actual = [
+                x._replace(message=bytes(x.message))
+                for x in iter_export_messages(file_path)
+            ]
+
+        expected = [
+            ExportMessage(1.0, EXPORTER, v9),
+            ExportMessage(2.0, EXPORTER, ipfix),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_template_store(self):
+        store = TemplateStore()
+        self.assertEqual(list(store.get_messages(0)), [])
+
+        # Data messages don't add anything
+        store.update(EXPORTER, make_v9(template=False))
+        store.update(EXPORTER, make_ipfix(template=False))
+        self.assertEqual(list(store.get_messages(0)), [])
+
+        # The saved templates are enough to decode later data records
+        store.update(EXPORTER, make_v9())
+        store.update(EXPORTER, make_ipfix())
+        messages = list(store.get_messages(1500000000))
+        self.assertEqual(len(messages), 2)
+
+        cache = TemplateCache()
+        for exporter, message in messages:
+            self.assertEqual(exporter, EXPORTER)
+            decode = decode_v9 if (message[1] == 9) else decode_ipfix
+            self.assertEqual(decode(message, cache, exporter), [])
+        actual = decode_v9(make_v9(template=False), cache, EXPORTER)
+        self.assertEqual(len(actual), 1)
+        actual = decode_ipfix(make_ipfix(template=False), cache, EXPORTER)
+        self.assertEqual(len(actual), 2)
+
+        # Withdrawn templates are forgotten
+        withdrawal = _make_set(2, pack('!HH', 300, 0))
+        store.update(
+            EXPORTER,
+            pack('!HHIII', 10, len(withdrawal) + 16, 0, 1, 0) + withdrawal
+        )
+        messages = list(store.get_messages(0))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][1][1], 9)
+
+    def test_template_store_options(self):
+        # NetFlow v9 options template: one scope field and one option field
+        options = pack('!HHHHHHH', 257, 4, 4, 1, 4, 34, 4)
+        options_set = _make_set(1, options + b'\x00\x00')
+        message = pack('!HHIIII', 9, 2, 0, 0, 1, 7) + options_set
+        store = TemplateStore()
+        store.update(EXPORTER, message + make_v9()[20:])
+
+        (exporter, actual), = store.get_messages(1500000000)
+        template_set = make_v9(data=False)[20:]
+        expected = (
+            pack('!HHIIII', 9, 2, 0, 1500000000, 0, 7) +
+            template_set +
+            _make_set(1, options)
+        )
+        self.assertEqual(actual, expected)
+
+    def test_write_read(self):
+        messages = [
+            (1.5, EXPORTER, make_v9()),
+            (2.5, socket.inet_pton(socket.AF_INET6, '2001:db8::1'), b'ipfix'),
+        ]
+        outfile = BytesIO()
+        write_messages(messages, outfile)
+        outfile.seek(0)
+        actual = list(read_messages(outfile))
+        self.assertEqual(actual, [ExportMessage(*x) for x in messages])
+
+        with self.assertRaises(ValueError):
+            list(read_messages(BytesIO(b'\xd4\xc3\xb2\xa1\x02\x00')))
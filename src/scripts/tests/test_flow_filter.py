@@ -0,0 +1,99 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from ipaddress import ip_address, ip_network
+from random import Random
+from unittest import TestCase
+
+from ona_service.flow_filter import (
+    FlowFilter,
+    IntervalSet,
+    parse_index_ranges,
+)
+
+
+class IntervalSetTestCase(TestCase):
+    def test_merge(self):
+        inst = IntervalSet([(10, 20), (0, 5), (6, 8), (15, 30), (40, 50)])
+        self.assertEqual(inst.starts, [0, 10, 40])
+        self.assertEqual(inst.ends, [8, 30, 50])
+
+        for value, expected in [
+            (-1, False), (0, True), (8, True), (9, False), (30, True),
+            (31, False), (45, True), (51, False),
+        ]:
+            self.assertEqual(value in inst, expected)
+
+
+class FlowFilterTestCase(TestCase):
+    def test_parse_index_ranges(self):
+        actual = list(parse_index_ranges('0-5,-7-10, 12-13,7-65536,a-b,9'))
+        expected = [(0, 5), (12, 13)]
+        self.assertEqual(actual, expected)
+
+    def test_match_address(self):
+        inst = FlowFilter(['10.0.0.0/8', '192.168.1.7/24', '2001:db8::/32'])
+        for addr, expected in [
+            ('10.0.0.0', True),
+            ('10.255.255.255', True),
+            ('11.0.0.0', False),
+            ('192.168.1.255', True),
+            ('192.168.2.0', False),
+            ('2001:db8::1', True),
+            ('2001:db9::1', False),
+            ('bogus', False),
+        ]:
+            self.assertEqual(inst.match_address(addr), expected, addr)
+
+    def test_invalid_network(self):
+        # Invalid networks are skipped rather than failing
+        inst = FlowFilter(['10.0.0.0/8,11.0.0.0/8', 'bogus', '12.0.0.0/8'])
+        self.assertFalse(inst.match_address('10.0.0.1'))
+        self.assertTrue(inst.match_address('12.0.0.1'))
+        self.assertEqual(len(inst.v4), 1)
+
+    def test_filter(self):
+        inst = FlowFilter(['10.0.0.0/8'], '1-2,100-200')
+        rows = [
+            {'srcaddr': '10.0.0.1', 'dstaddr': '8.8.8.8', 'input': '1',
+             'output': '0'},
+            {'srcaddr': '8.8.8.8', 'dstaddr': '10.0.0.1', 'input': '0',
+             'output': '150'},
+            # Index doesn't match
+            {'srcaddr': '10.0.0.1', 'dstaddr': '8.8.8.8', 'input': '3',
+             'output': '4'},
+            # Address doesn't match
+            {'srcaddr': '8.8.4.4', 'dstaddr': '8.8.8.8', 'input': '1',
+             'output': '2'},
+            # Indexes beyond 16 bits never match
+            {'srcaddr': '10.0.0.1', 'dstaddr': '8.8.8.8', 'input': '65537',
+             'output': '0'},
+        ]
+        actual = list(inst.filter(rows))
+        self.assertEqual(actual, rows[:2])
+
+    def test_exact(self):
+        # Compare against the ipaddress module with random networks
+        rng = Random(1)
+        networks = [
+            ip_network((rng.getrandbits(32), rng.randint(8, 32)), strict=False)
+            for __ in range(1000)
+        ]
+        inst = FlowFilter([str(x) for x in networks])
+        for __ in range(1000):
+            addr = ip_address(rng.getrandbits(32))
+            if rng.random() < 0.5:
+                net = rng.choice(networks)
+                addr = net[rng.randrange(net.num_addresses)]
+            expected = any(addr in net for net in networks)
+            self.assertEqual(inst.match_address(str(addr)), expected)
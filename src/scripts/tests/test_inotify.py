@@ -0,0 +1,78 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from os import rename
+from os.path import join
+from struct import pack
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.inotify import (
+    Inotify,
+    InotifyEvent,
+    IN_CREATE,
+    IN_MODIFY,
+    IN_MOVE_SELF,
+    parse_events,
+)
+
+
+class InotifyTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.inotify = Inotify()
+
+    def tearDown(self):
+        self.inotify.close()
+        self.temp_dir.cleanup()
+
+    def test_parse_events(self):
+        data = (
+            pack('iIII', 1, IN_MODIFY, 0, 0) +
+            pack('iIII', 2, IN_CREATE, 0, 16) + b'ona-one.log\0\0\0\0\0'
+        )
+        actual = list(parse_events(data))
+        expected = [
+            InotifyEvent(1, IN_MODIFY, 0, ''),
+            InotifyEvent(2, IN_CREATE, 0, 'ona-one.log'),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_read_events(self):
+        file_path = join(self.temp_dir.name, 'one.log')
+        with open(file_path, 'wt'):
+            pass
+        dir_wd = self.inotify.add_watch(self.temp_dir.name, IN_CREATE)
+        file_wd = self.inotify.add_watch(file_path, IN_MODIFY | IN_MOVE_SELF)
+
+        # Nothing has happened yet
+        self.assertEqual(self.inotify.read_events(0), [])
+
+        with open(file_path, 'at') as f:
+            print('hello', file=f)
+        rename(file_path, file_path + '.1')
+        with open(join(self.temp_dir.name, 'two.log'), 'wt'):
+            pass
+
+        actual = [(x.wd, x.mask, x.name) for x in self.inotify.read_events(1)]
+        expected = [
+            (file_wd, IN_MODIFY, ''),
+            (file_wd, IN_MOVE_SELF, ''),
+            (dir_wd, IN_CREATE, 'two.log'),
+        ]
+        self.assertEqual(actual, expected)
+
+        # The watch can be removed
+        self.inotify.remove_watch(file_wd)
+        with self.assertRaises(OSError):
+            self.inotify.remove_watch(file_wd)
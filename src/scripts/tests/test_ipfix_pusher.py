@@ -18,10 +18,16 @@ from unittest import TestCase
 from unittest.mock import call as MockCall, MagicMock, patch
 
 from ona_service.ipfix_pusher import (
+    COMPACT_CSV_HEADER,
     CSV_HEADER,
+    ENV_IPFIX_COMPACT_TOP_K,
     ENV_IPFIX_INDEX_RANGES,
+    ENV_IPFIX_INPROCESS_FILTER,
+    ENV_IPFIX_MERGE_BINS,
+    ENV_MONITOR_NETS,
     get_index_filter,
     IPFIXPusher,
+    RWCUT_PATH,
     RWFILTER_PATH,
     RWUNIQ_PATH,
 )
@@ -317,6 +323,206 @@ class IPFIXPusherTestCase(PusherTestBase, TestCase):
             self.assertEqual(lines[2], fixed_line)
             self.assertEqual(lines[3], unfixable_line)
 
+    @patch('ona_service.ipfix_pusher.call', autospec=True)
+    def test_process_native(self, mock_call):
+        # Files from the built-in collector skip the SiLK tools
+        file_path = join(self.input_dir, '20140324135011_S1.csv')
+        with open(file_path, 'wt') as f:
+            # Two flows for the same 5-tuple get aggregated
+            f.write(
+                '10.0.0.1,198.22.253.72,61391,80,6,'
+                '58,1,1459535021,1459535022,1,2\n'
+            )
+            f.write(
+                '10.0.0.1,198.22.253.72,61391,80,6,'
+                '42,2,1459535020,1459535021,1,2\n'
+            )
+            # Doesn't match a monitored network
+            f.write(
+                '192.0.2.1,198.22.253.72,61391,80,6,'
+                '42,2,1459535020,1459535021,1,2\n'
+            )
+            # Doesn't match the index filter
+            f.write(
+                '10.0.0.2,198.22.253.72,61391,80,6,'
+                '42,2,1459535020,1459535021,3,4\n'
+            )
+
+        # Networks can be separated by commas, and invalid ones are skipped
+        env_override = {
+            ENV_IPFIX_INDEX_RANGES: '0-2',
+            ENV_MONITOR_NETS: '10.0.0.0/8,bogus 172.16.0.0/12',
+        }
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+        self.assertIsNone(inst.flow_filter)
+        inst._process_files([file_path])
+        self.assertEqual(mock_call.call_count, 0)
+
+        with gz_open(file_path, 'rt') as infile:
+            actual = infile.readlines()
+        expected = [
+            CSV_HEADER + '\n',
+            '10.0.0.1,198.22.253.72,61391,80,6,100,3,1459535020,1459535022\n',
+        ]
+        self.assertEqual(actual, expected)
+        self.assertEqual(listdir(self.input_dir), ['20140324135011_S1.csv'])
+
+    @patch('ona_service.ipfix_pusher.call', autospec=True)
+    def test_process_files_merge_bins(self, mock_call):
+        self._touch_files()
+        extra_file = join(self.input_dir, '20140324135100_S2.abcdef')
+        open(extra_file, 'w').close()
+
+        env_override = {ENV_IPFIX_MERGE_BINS: 'true'}
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+
+        input_paths = [join(self.input_dir, x) for x in self.ready[0:2]]
+        inst._process_files(input_paths + [extra_file])
+
+        # One rwuniq call per probe, with all of the probe's files
+        rwuniq_inputs = [
+            c[0][0][15:] for c in mock_call.call_args_list
+            if c[0][0][0] == RWUNIQ_PATH
+        ]
+        self.assertEqual(rwuniq_inputs, [input_paths, [extra_file]])
+
+        # Only the first file of each probe is left
+        actual = listdir(self.input_dir)
+        expected = self.ready[:1] + self.ready[2:] + self.waiting
+        expected.append('20140324135100_S2.abcdef')
+        self.assertCountEqual(actual, expected)
+
+    def test_process_native_merge_bins(self):
+        file_paths = [
+            join(self.input_dir, '20140324135011_S1.csv'),
+            join(self.input_dir, '20140324135211_S1.csv'),
+        ]
+        for i, file_path in enumerate(file_paths):
+            with open(file_path, 'wt') as f:
+                f.write(
+                    '10.0.0.1,198.22.253.72,61391,80,6,'
+                    '50,1,{},{},1,2\n'.format(1459535020 + i, 1459535021 + i)
+                )
+
+        env_override = {ENV_IPFIX_MERGE_BINS: 'true'}
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+        inst._process_files(file_paths)
+
+        self.assertEqual(listdir(self.input_dir), ['20140324135011_S1.csv'])
+        with gz_open(file_paths[0], 'rt') as infile:
+            actual = infile.readlines()
+        expected = [
+            CSV_HEADER + '\n',
+            '10.0.0.1,198.22.253.72,61391,80,6,100,2,1459535020,1459535022\n',
+        ]
+        self.assertEqual(actual, expected)
+
+    @patch('ona_service.ipfix_pusher.call', autospec=True)
+    def test_process_files_inprocess_filter(self, mock_call):
+        self._touch_files()
+
+        # This is what rwcut writes with the options below
+        def side_effect(*args, **kwargs):
+            with open(args[0][11], 'wt') as f:
+                f.write(
+                    '10.0.0.1,198.22.253.72,61391,80,6,'
+                    '58,1,1459535021,1459535021,34048,0\n'
+                )
+                f.write(
+                    '10.0.0.1,198.22.253.72,61391,80,6,'
+                    '58,1,1459535021,1459535021,1,0\n'
+                )
+            return 0
+
+        mock_call.side_effect = side_effect
+
+        env_override = {
+            ENV_IPFIX_INDEX_RANGES: '34048-34050',
+            ENV_IPFIX_INPROCESS_FILTER: 'true',
+        }
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+
+        input_paths = [join(self.input_dir, x) for x in self.ready[0:1]]
+        inst._process_files(input_paths)
+
+        # Only rwcut gets called, and it writes whole-second times
+        self.assertEqual(mock_call.call_count, 1)
+        native_path = '{}.native'.format(input_paths[0])
+        expected_args = [
+            RWCUT_PATH,
+            '--no-titles',
+            '--no-columns',
+            '--no-final-delimiter',
+            '--column-sep', ',',
+            '--timestamp-format', 'epoch,no-msec',
+            '--fields',
+            'sIp,dIp,sPort,dPort,protocol,Bytes,Packets,sTime,eTime,in,out',
+            '--output-path', native_path,
+        ] + input_paths
+        self.assertEqual(mock_call.call_args[0][0], expected_args)
+
+        with gz_open(input_paths[0], 'rt') as infile:
+            actual = infile.readlines()
+        expected = [
+            CSV_HEADER + '\n',
+            '10.0.0.1,198.22.253.72,61391,80,6,58,1,1459535021,1459535021\n',
+        ]
+        self.assertEqual(actual, expected)
+
+        actual = listdir(self.input_dir)
+        expected = self.ready + self.waiting
+        self.assertCountEqual(actual, expected)
+
+    @patch('ona_service.ipfix_pusher.call', autospec=True)
+    def test_process_files_inprocess_filter_error(self, mock_call):
+        self._touch_files()
+
+        # rwcut fails without writing anything; the other tools succeed
+        mock_call.side_effect = lambda args: 1 if args[0] == RWCUT_PATH else 0
+
+        env_override = {ENV_IPFIX_INPROCESS_FILTER: 'true'}
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+
+        input_paths = [join(self.input_dir, x) for x in self.ready[0:1]]
+        inst._process_files(input_paths)
+
+        # The SiLK tools are used instead
+        actual = [x[0][0][0] for x in mock_call.call_args_list]
+        self.assertEqual(actual, [RWCUT_PATH, RWFILTER_PATH, RWUNIQ_PATH])
+
+        actual = listdir(self.input_dir)
+        expected = self.ready + self.waiting
+        self.assertCountEqual(actual, expected)
+
+    def test_compaction(self):
+        file_path = join(self.input_dir, '20140324135011_S1.csv')
+        with open(file_path, 'wt') as f:
+            for dport, bytes_ in [(80, 1000), (81, 10), (82, 20)]:
+                f.write(
+                    '10.0.0.1,198.22.253.72,61391,{},6,'
+                    '{},1,1459535021,1459535022,1,2\n'.format(dport, bytes_)
+                )
+
+        env_override = {ENV_IPFIX_COMPACT_TOP_K: '1'}
+        with patch.dict('ona_service.ipfix_pusher.environ', env_override):
+            inst = self._get_instance(IPFIXPusher)
+        inst._process_files([file_path])
+
+        with gz_open(file_path, 'rt') as infile:
+            actual = infile.readlines()
+        expected = [
+            COMPACT_CSV_HEADER + '\n',
+            '10.0.0.1,198.22.253.72,61391,80,6,'
+            '1000,1,1459535021,1459535022,0\n',
+            '10.0.0.1,198.22.253.72,0,0,6,30,2,1459535021,1459535022,1\n',
+        ]
+        self.assertEqual(actual, expected)
+
     def test_get_index_filter(self):
         for range_str, expected in [
             ('0-5', '0,1,2,3,4,5'),
@@ -0,0 +1,89 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+
+from unittest import TestCase
+
+from ona_service.log_filter import get_line_filter, LineFilter
+
+LINES = [
+    b'2017-07-14 02:40:00 - ona-pna-pusher - INFO - Pushing 1 file\n',
+    b'2017-07-14 02:40:01 - ona-pna-pusher - ERROR - Upload failed\n',
+    b'Jul 14 02:40:02 ona sshd[100]: Accepted publickey for ona\n',
+    b'Jul 14 02:40:03 ona sshd[101]: Failed password for root\n',
+]
+
+
+class LineFilterTestCase(TestCase):
+    def test_exclude(self):
+        line_filter = LineFilter(exclude=[' - INFO - ', 'publickey'])
+        actual = line_filter.filter(LINES)
+        expected = ([LINES[1], LINES[3]], 2)
+        self.assertEqual(actual, expected)
+
+    def test_include(self):
+        line_filter = LineFilter(include=['ERROR', r'sshd\[\d+\]'])
+        actual = line_filter.filter(LINES)
+        expected = (LINES[1:], 3)
+        self.assertEqual(actual, expected)
+
+    def test_include_exclude(self):
+        # Exclusions win
+        line_filter = LineFilter(include=['sshd'], exclude=['(?i:ROOT)'])
+        actual = line_filter.filter(LINES)
+        expected = ([LINES[2]], 2)
+        self.assertEqual(actual, expected)
+
+    def test_invalid(self):
+        # Invalid patterns are skipped
+        line_filter = LineFilter(exclude=['[', 'ERROR'])
+        self.assertEqual(line_filter.filter(LINES)[0], [LINES[0]] + LINES[2:])
+
+        self.assertFalse(LineFilter(exclude=['(']))
+        self.assertFalse(LineFilter())
+
+        # Global flags can't be combined, and patterns must be strings
+        line_filter = LineFilter(exclude=['(?i)SSHD', 1, None, 'ERROR'])
+        self.assertEqual(line_filter.filter(LINES)[0], [LINES[0]] + LINES[2:])
+
+    def test_get_line_filter(self):
+        rules = {
+            'ona-*': {'exclude': [' - INFO - ']},
+            'auth.log': {'include': ['sshd']},
+            '*': {'exclude': ['publickey']},
+        }
+
+        line_filter = get_line_filter(rules, 'ona-pna-pusher')
+        self.assertEqual(line_filter.filter(LINES)[0], [LINES[1], LINES[3]])
+
+        line_filter = get_line_filter(rules, 'auth.log')
+        self.assertEqual(line_filter.filter(LINES)[0], [LINES[3]])
+
+        self.assertIsNone(get_line_filter({}, 'auth.log'))
+        self.assertIsNone(get_line_filter({'ona-*': {}}, 'ona-one'))
+
+    def test_get_line_filter_invalid(self):
+        # Malformed rules are skipped
+        rules = {
+            'ona-*': ['ERROR'],
+            'ona-pna-*': {'include': 'ERROR', 'exclude': ['publickey']},
+        }
+        line_filter = get_line_filter(rules, 'ona-pna-pusher')
+        expected = [LINES[0], LINES[1], LINES[3]]
+        self.assertEqual(line_filter.filter(LINES)[0], expected)
+
+        # Patterns that are only invalid together raise an error
+        rules = {'*': {'exclude': ['(?P<x>a)', '(?P<x>b)']}}
+        with self.assertRaises(re.error):
+            get_line_filter(rules, 'auth.log')
@@ -12,22 +12,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import gzip
+import tarfile
 
 from datetime import datetime, timedelta
 from glob import iglob
-from os import rename
+from io import BytesIO
+from os import listdir, rename, stat
 from os.path import join
+from struct import pack
 from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Event
+from time import tzset
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
+from requests import exceptions as requests_exceptions
+
+from ona_service.inotify import Inotify
+from ona_service.log_filter import LineFilter
 from ona_service.log_watcher import (
     check_auth_journal,
     directory_logs,
     LogWatcher,
+    format_entry,
     LogNode,
+    parse_export,
     SystemdJournalNode,
     WatchNode,
+    write_compressed,
 )
 from ona_service.utils import utcnow
 
@@ -124,18 +136,134 @@ class LogNodeTestCase(TestCase):
 
         self.node._set_fd()
         inode1 = self.node.log_file_inode
-        with open(self.dummy_file) as f:
+        with open(self.dummy_file, 'rb') as f:
             contents = f.read()
         self.assertEqual(self.node.log_file.read(), contents)
 
         self.node._set_fd(seek_to_end=True)
         inode2 = self.node.log_file_inode
-        self.assertEqual(self.node.log_file.read(), '')
+        self.assertEqual(self.node.log_file.read(), b'')
         self.assertEqual(inode1, inode2)
+        self.assertEqual(self.node.position, (inode2, 36))
 
         log_args = mock_logging.info.call_args[0]
         log_message = log_args[0] % log_args[1:]
-        self.assertIn('skipped 2 lines', log_message)
+        self.assertIn('skipped 36 bytes', log_message)
+
+    def test_resume(self):
+        state = {}
+        with open(self.dummy_file, 'wt') as f:
+            print('before', file=f)
+
+        # No saved position - start from the end
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.send_delta = timedelta(0)
+        with open(self.dummy_file, 'at') as f:
+            print('first', file=f)
+        node.check_data(self.now)
+        inode = node.log_file_inode
+        self.assertEqual(state, {self.dummy_file: [inode, 13]})
+        node.cleanup()
+
+        # Written while the watcher was down
+        with open(self.dummy_file, 'at') as f:
+            print('second', file=f)
+
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.check_data(self.now)
+        self.assertEqual(node.data, [b'second\n'])
+        node.cleanup()
+
+        # Nothing was sent, so the same line is read again
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.check_data(self.now)
+        self.assertEqual(node.data, [b'second\n'])
+        node.cleanup()
+
+    def test_resume_rotated(self):
+        state = {}
+        with open(self.dummy_file, 'wt') as f:
+            print('before', file=f)
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.send_delta = timedelta(0)
+        with open(self.dummy_file, 'at') as f:
+            print('first', file=f)
+        node.check_data(self.now)
+        node.cleanup()
+
+        # Rotated while the watcher was down
+        with open(self.dummy_file, 'at') as f:
+            print('second', file=f)
+        rename(self.dummy_file, '{}.1'.format(self.dummy_file))
+        with open(self.dummy_file, 'wt') as f:
+            print('third', file=f)
+
+        # The rest of the old file is read with the first check, and goes
+        # through the filter like everything else
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        self.assertEqual(node.data, [])
+        node.line_filter = LineFilter(exclude=['second'])
+        node.check_data(self.now)
+        self.assertEqual(node.data, [b'third\n'])
+        self.assertEqual(node.data_size, 6)
+        self.assertEqual(node.filter_stats['dropped'], 1)
+        node.cleanup()
+
+    def test_resume_rotated_spill(self):
+        with open(self.dummy_file, 'wt') as f:
+            print('first', file=f)
+            print('second', file=f)
+        state = {self.dummy_file: [stat(self.dummy_file).st_ino, 0]}
+
+        # Rotated while the watcher was down
+        rename(self.dummy_file, '{}.1'.format(self.dummy_file))
+        open(self.dummy_file, 'wt').close()
+
+        # The old file's end is handed over in chunks too. Spilling it saves
+        # its position, so it's picked up again after another restart.
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.spill_dir = self.temp_dir.name
+        node.max_memory = 1
+        with patch('ona_service.log_watcher.READ_SIZE', 1):
+            node.check_data(self.now)
+        self.assertEqual(len(node.segments), 2)
+        self.assertEqual(
+            state[self.dummy_file],
+            [stat('{}.1'.format(self.dummy_file)).st_ino, 13],
+        )
+        node.cleanup()
+
+    def test_check_data_backlog(self):
+        # A backlog is handed over in chunks, so each one can be spilled.
+        # The position is saved with each spill.
+        state = {}
+        node = LogNode('one', MagicMock(), self.dummy_file, state=state)
+        node.spill_dir = self.temp_dir.name
+        node.max_memory = 1
+        with open(self.dummy_file, 'wt') as f:
+            for i in range(3):
+                print('line {}'.format(i), file=f)
+
+        with patch('ona_service.log_watcher.READ_SIZE', 1):
+            node.check_data(self.now)
+        self.assertEqual(len(node.segments), 3)
+        self.assertEqual(node.data, [])
+        self.assertEqual(state, {self.dummy_file: [node.log_file_inode, 21]})
+        node.cleanup()
+
+    def test_truncated(self):
+        with open(self.dummy_file, 'wt') as f:
+            print('hello', file=f)
+        self.node.check_data(self.now)
+
+        # Truncated in place
+        with open(self.dummy_file, 'wt') as f:
+            pass
+        self.node.check_data(self.now)
+        with open(self.dummy_file, 'at') as f:
+            print('bye', file=f)
+        self.node.check_data(self.now)
+        self.assertEqual(self.node.data, [b'hello\n', b'bye\n'])
 
     def test_encoding(self):
         node = LogNode('one', None, self.dummy_file, encoding='cp1252')
@@ -162,31 +290,131 @@ class LogNodeTestCase(TestCase):
         self.assertEqual(actual, expected)
 
 
+def _export_entry(cursor, message, usec=1500000000000000):
+    return (
+        b'__CURSOR=' + cursor + b'\n'
+        b'__REALTIME_TIMESTAMP=' + str(usec).encode('ascii') + b'\n'
+        b'_HOSTNAME=ona-host\n'
+        b'SYSLOG_IDENTIFIER=sshd\n'
+        b'_PID=123\n'
+        b'MESSAGE=' + message + b'\n'
+        b'\n'
+    )
+
+
 class SystemdJournalNodeTestCase(TestCase):
-    @patch('ona_service.log_watcher.CommandOutputFollower', autospec=True)
-    def test_check_data(self, mock_CommandOutputFollower):
-        mock_follower = MagicMock()
-        mock_CommandOutputFollower.return_value = mock_follower
+    def setUp(self):
+        self.now = utcnow()
+        self.state = {}
+        self.outputs = []
+        self.command_args = []
+
+        def popen(command_args, **kwargs):
+            self.command_args.append(command_args)
+            process = MagicMock()
+            process.__enter__.return_value = process
+            process.stdout = BytesIO(self.outputs.pop(0))
+            process.wait.return_value = 0
+            return process
+
+        patcher = patch('ona_service.log_watcher.Popen', popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_export(self):
+        data = (
+            _export_entry(b's=1', b'one') +
+            b'__CURSOR=s=2\nMESSAGE\n' + pack('<Q', 7) + b'two\nbin\n\n'
+        )
+        actual = list(parse_export(BytesIO(data)))
+        self.assertEqual(len(actual), 2)
+        self.assertEqual(actual[0]['MESSAGE'], b'one')
+        self.assertEqual(
+            actual[1], {'__CURSOR': b's=2', 'MESSAGE': b'two\nbin'}
+        )
 
+    @patch.dict('os.environ', {'TZ': 'UTC'})
+    def test_format_entry(self):
+        tzset()
+        self.addCleanup(tzset)
+        entry = next(parse_export(BytesIO(_export_entry(b's=1', b'hello'))))
+        actual = format_entry(entry)
+        expected = b'Jul 14 02:40:00 ona-host sshd[123]: hello\n'
+        self.assertEqual(actual, expected)
+
+    def test_check_data(self):
         node = SystemdJournalNode(
             log_type='auth.log',
-            api=None,
-            journalctl_args=['SYSLOG_FACILITY=10']
+            api=MagicMock(),
+            journalctl_args=['SYSLOG_FACILITY=10'],
+            state=self.state,
         )
-        self.now = datetime.utcnow()
+        node.send_delta = timedelta(0)
 
-        return_values = ['0\n', '1\n', '2\n', None]
-
-        def side_effect(*args, **kwargs):
-            return return_values.pop(0)
+        # No cursor - start from the latest entry
+        self.outputs.append(_export_entry(b's=1', b'one'))
+        node.check_data(self.now)
+        self.assertEqual(
+            self.command_args[-1],
+            [
+                'journalctl',
+                '--no-pager',
+                '--output=export',
+                '--lines=1',
+                'SYSLOG_FACILITY=10',
+            ]
+        )
+        self.assertEqual(self.state, {'journal:auth.log': 's=1'})
 
-        mock_follower.check_process.return_value = False
-        mock_follower.read_line.side_effect = side_effect
+        # Batches pick up after the cursor
+        self.outputs.append(
+            _export_entry(b's=2', b'two') + _export_entry(b's=3', b'three')
+        )
+        node.check_data(self.now)
+        self.assertIn('--after-cursor=s=1', self.command_args[-1])
+        self.assertEqual(node.api.send_file.call_count, 2)
+        self.assertEqual(self.state, {'journal:auth.log': 's=3'})
 
+        # A new node resumes from the saved cursor
+        node = SystemdJournalNode(
+            log_type='auth.log',
+            api=MagicMock(),
+            journalctl_args=[],
+            state=self.state,
+        )
+        self.outputs.append(_export_entry(b's=4', b'four'))
         node.check_data(self.now)
-        self.assertEqual(mock_follower.start_process.call_count, 2)
+        self.assertIn('--after-cursor=s=3', self.command_args[-1])
+        self.assertEqual(len(node.data), 1)
+        self.assertTrue(node.data[0].endswith(b' sshd[123]: four\n'))
 
-        self.assertEqual(node.data, ['0\n', '1\n', '2\n'])
+        # Not sent yet, so the cursor isn't saved
+        self.assertEqual(self.state, {'journal:auth.log': 's=3'})
+
+    @patch('ona_service.log_watcher.JOURNAL_BATCH_SIZE', 1)
+    def test_check_data_backlog(self):
+        node = SystemdJournalNode(
+            log_type='auth.log',
+            api=MagicMock(),
+            journalctl_args=[],
+            state=self.state,
+        )
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        node.spill_dir = temp_dir.name
+        node.max_memory = 1
+
+        # Each batch is spilled as it's read, and the cursor is saved with it
+        self.outputs.append(
+            b''.join(
+                _export_entry('s={}'.format(i).encode(), b'entry')
+                for i in range(1, 4)
+            )
+        )
+        node.check_data(self.now)
+        self.assertEqual(len(node.segments), 3)
+        self.assertEqual(node.data, [])
+        self.assertEqual(self.state, {'journal:auth.log': 's=3'})
 
 
 class LogWatcherMainTestCase(TestCase):
@@ -206,12 +434,14 @@ class LogWatcherMainTestCase(TestCase):
         mock_LogNode.assert_called_once_with(
             log_type='log_name',
             api=watcher.api,
-            log_path='log_path'
+            log_path='log_path',
+            state=watcher.state,
         )
         mock_SystemdJournalNode.assert_called_once_with(
             log_type='journal_name',
             api=watcher.api,
             journalctl_args=['SOME_FIELD=SOME_VALUE'],
+            state=watcher.state,
         )
 
     @patch('ona_service.log_watcher.LogNode', autospec=True)
@@ -253,6 +483,376 @@ class LogWatcherMainTestCase(TestCase):
         self.assertFalse(check_auth_journal())
 
 
+class LogWatcherInotifyTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.log_path = join(self.temp_dir.name, 'ona-one.log')
+        with open(self.log_path, 'wt') as f:
+            print('before', file=f)
+
+        env = {
+            'OBSRVBL_LOG_WATCHER_STATE_FILE': join(
+                self.temp_dir.name, 'state'
+            ),
+        }
+        with patch.dict('ona_service.log_watcher.environ', env):
+            self.watcher = LogWatcher(
+                logs={'ona-one': self.log_path},
+                log_dirs=[(self.temp_dir.name, 'ona-', '.log')],
+            )
+        self.watcher.inotify = Inotify()
+        for node in self.watcher.log_nodes:
+            self.watcher._watch_node(node)
+        self.now = utcnow()
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        self.watcher.clean_all()
+        self.temp_dir.cleanup()
+
+    def _handle(self):
+        events = self.watcher.inotify.read_events(1)
+        self.watcher.handle_events(events, self.now)
+
+    def test_modify(self):
+        node = self.watcher.log_nodes[0]
+        with open(self.log_path, 'at') as f:
+            print('after', file=f)
+        self._handle()
+        self.assertEqual(node.data, [b'after\n'])
+
+    def test_rotate(self):
+        node = self.watcher.log_nodes[0]
+        with open(self.log_path, 'at') as f:
+            print('after', file=f)
+        rename(self.log_path, self.log_path + '.1')
+        with open(self.log_path, 'wt') as f:
+            print('new', file=f)
+        self._handle()
+        self.assertEqual(node.data, [b'after\n', b'new\n'])
+
+        # The new file is being watched
+        with open(self.log_path, 'at') as f:
+            print('newer', file=f)
+        self._handle()
+        self.assertEqual(node.data, [b'after\n', b'new\n', b'newer\n'])
+
+    def test_new_log(self):
+        new_path = join(self.temp_dir.name, 'ona-two.log')
+        with open(new_path, 'wt') as f:
+            print('hello', file=f)
+        with open(join(self.temp_dir.name, 'other.log'), 'wt') as f:
+            print('ignored', file=f)
+        self._handle()
+
+        # Only the matching file is added, and it's read from the start
+        self.assertEqual(len(self.watcher.log_nodes), 2)
+        node = self.watcher.log_nodes[1]
+        self.assertEqual(node.log_type, 'ona-two')
+        self.assertEqual(node.data, [b'hello\n'])
+
+        with open(new_path, 'at') as f:
+            print('again', file=f)
+        self._handle()
+        self.assertEqual(node.data, [b'hello\n', b'again\n'])
+
+    def test_tick(self):
+        node = self.watcher.log_nodes[0]
+        node.send_delta = timedelta(0)
+        self.watcher.api = node.api = MagicMock()
+        with open(self.log_path, 'at') as f:
+            print('after', file=f)
+        self._handle()
+
+        self.watcher.tick(self.now)
+        self.assertEqual(node.api.send_file.call_count, 1)
+        self.assertEqual(node.data, [])
+
+    @patch.dict(
+        'ona_service.log_watcher.environ',
+        {'OBSRVBL_LOG_WATCHER_INOTIFY': 'true'},
+    )
+    @patch('ona_service.log_watcher.Inotify', autospec=True)
+    def test_run_fallback(self, mock_Inotify):
+        watcher = LogWatcher(logs={})
+        mock_Inotify.side_effect = OSError
+        with patch('ona_service.log_watcher.Service.run') as mock_run:
+            watcher.run()
+        mock_run.assert_called_once_with()
+
+
+class LogWatcherUploadThreadsTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.paths = {}
+        for name in ('slow', 'fast'):
+            self.paths[name] = join(self.temp_dir.name, name)
+            with open(self.paths[name], 'wt'):
+                pass
+
+        env = {
+            'OBSRVBL_LOG_WATCHER_UPLOAD_THREADS': '2',
+            'OBSRVBL_LOG_WATCHER_STATE_FILE': join(
+                self.temp_dir.name, 'state'
+            ),
+        }
+        with patch.dict('ona_service.log_watcher.environ', env):
+            self.watcher = LogWatcher(logs=self.paths)
+        self.nodes = {x.log_type: x for x in self.watcher.log_nodes}
+        for node in self.nodes.values():
+            node.api = MagicMock()
+            node.send_delta = timedelta(0)
+        self.now = utcnow()
+
+    def tearDown(self):
+        self.watcher.clean_all()
+        self.temp_dir.cleanup()
+
+    def _write(self, name, line):
+        with open(self.paths[name], 'at') as f:
+            print(line, file=f)
+
+    def test_execute(self):
+        # The slow log's upload gets stuck
+        release = Event()
+        self.nodes['slow'].api.send_file.side_effect = (
+            lambda *args, **kwargs: release.wait(5)
+        )
+
+        self._write('slow', 'slow_1')
+        self._write('fast', 'fast_1')
+        self.watcher.execute(self.now)
+        self.assertTrue(self.nodes['fast'].defer_send)
+
+        # The fast log keeps going
+        self._write('slow', 'slow_2')
+        self._write('fast', 'fast_2')
+        self.watcher.uploads[self.nodes['fast']].result(5)
+        self.watcher.execute(self.now)
+        self.watcher.uploads[self.nodes['fast']].result(5)
+        self.assertEqual(self.nodes['fast'].api.send_file.call_count, 2)
+
+        # The slow log wasn't read while it was busy
+        self.assertEqual(self.nodes['slow'].data, [b'slow_1\n'])
+
+        # Once it's done, it catches up
+        release.set()
+        self.watcher.uploads[self.nodes['slow']].result(5)
+        self.watcher.execute(self.now)
+        self.watcher.uploads[self.nodes['slow']].result(5)
+        self.assertEqual(self.nodes['slow'].api.send_file.call_count, 2)
+        self.assertEqual(self.nodes['slow'].data, [])
+
+
+class LogWatcherBundleTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.paths = {}
+        for name in ('auth.log', 'ona-one'):
+            self.paths[name] = join(self.temp_dir.name, name)
+            with open(self.paths[name], 'wt'):
+                pass
+
+        env = {
+            'OBSRVBL_LOG_WATCHER_BUNDLE': 'true',
+            'OBSRVBL_LOG_WATCHER_STATE_FILE': join(
+                self.temp_dir.name, 'state'
+            ),
+            'OBSRVBL_LOG_WATCHER_SPILL_DIR': join(
+                self.temp_dir.name, 'spill'
+            ),
+        }
+        with patch.dict('ona_service.log_watcher.environ', env):
+            self.watcher = LogWatcher(logs=self.paths)
+        self.watcher.api = MagicMock()
+        self.nodes = {x.log_type: x for x in self.watcher.log_nodes}
+        for node in self.nodes.values():
+            node.api = MagicMock()
+        self.now = utcnow()
+        self.later = self.now + timedelta(seconds=60)
+
+    def tearDown(self):
+        self.watcher.clean_all()
+        self.temp_dir.cleanup()
+
+    def _write(self, name, line):
+        with open(self.paths[name], 'at') as f:
+            print(line, file=f)
+
+    def test_send_bundle(self):
+        archives = []
+
+        def send_file(data_type, path, now, suffix=None):
+            with tarfile.open(path) as tarball:
+                archives.append(
+                    {
+                        x.name: gzip.decompress(tarball.extractfile(x).read())
+                        for x in tarball.getmembers()
+                    }
+                )
+            return 'remote_path'
+
+        self.watcher.api.send_file.side_effect = send_file
+
+        self._write('auth.log', 'auth_1')
+        self._write('ona-one', 'one_1')
+        self.watcher.execute(self.now)
+        self.assertEqual(self.watcher.api.send_file.call_count, 0)
+
+        # Some of the data was spilled
+        self.nodes['auth.log']._spill()
+        self._write('auth.log', 'auth_2')
+        self.watcher.bundle_last_send = self.now
+        self.watcher.execute(self.later)
+
+        # One upload and one signal for both logs
+        self.assertEqual(
+            archives,
+            [{'auth.log.gz': b'auth_1\nauth_2\n', 'ona-one.gz': b'one_1\n'}],
+        )
+        self.assertEqual(self.watcher.api.send_signal.call_count, 1)
+        signal_data = self.watcher.api.send_signal.call_args[0][1]
+        self.assertEqual(signal_data['path'], 'remote_path')
+        self.assertEqual(signal_data['log_types'], ['auth.log', 'ona-one'])
+
+        # Everything was cleared
+        for node in self.nodes.values():
+            self.assertEqual(node.data, [])
+            self.assertEqual(len(node.segments), 0)
+            self.assertEqual(node.api.send_file.call_count, 0)
+
+        # Only logs with data are included
+        self._write('ona-one', 'one_2')
+        self.watcher.execute(self.later + timedelta(seconds=60))
+        self.assertEqual(archives[-1], {'ona-one.gz': b'one_2\n'})
+
+    def test_send_bundle_failure(self):
+        self.watcher.api.send_file.side_effect = (
+            requests_exceptions.ConnectionError
+        )
+        self._write('auth.log', 'auth_1')
+        self.watcher.execute(self.later)
+        self.assertTrue(self.watcher.bundle_failed)
+        self.assertEqual(self.nodes['auth.log'].data, [b'auth_1\n'])
+
+
+class LogWatcherFilterTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.paths = {}
+        for name in ('auth.log', 'ona-one'):
+            self.paths[name] = join(self.temp_dir.name, name)
+            with open(self.paths[name], 'wt'):
+                pass
+
+        env = {
+            'OBSRVBL_LOG_WATCHER_FILTER': 'true',
+            'OBSRVBL_LOG_WATCHER_STATE_FILE': join(
+                self.temp_dir.name, 'state'
+            ),
+        }
+        with patch.dict('ona_service.log_watcher.environ', env):
+            self.watcher = LogWatcher(logs=self.paths)
+        self.watcher.api = MagicMock()
+        self.watcher.api.get_data.return_value.json.return_value = {
+            'ona-*': {'exclude': [' - INFO - ']},
+        }
+        self.nodes = {x.log_type: x for x in self.watcher.log_nodes}
+        self.sent = {}
+        for node in self.nodes.values():
+            node.api = MagicMock()
+            node.api.send_file.side_effect = self._send_file
+            node.send_delta = timedelta(0)
+        self.now = utcnow()
+
+    def tearDown(self):
+        self.watcher.clean_all()
+        self.temp_dir.cleanup()
+
+    def _send_file(self, data_type, path, now, suffix=None):
+        with gzip.open(path) as f:
+            self.sent[suffix] = f.read()
+        return 'remote_path'
+
+    def _write(self, name, *lines):
+        with open(self.paths[name], 'at') as f:
+            for line in lines:
+                print(line, file=f)
+
+    def test_execute(self):
+        self._write('ona-one', 'ona-one - INFO - tick', 'ona-one - ERROR - x')
+        self._write('auth.log', 'sshd: Accepted publickey for ona')
+        self.watcher.execute(self.now)
+
+        # Only matching logs are filtered
+        self.assertEqual(self.sent['ona-one'], b'ona-one - ERROR - x\n')
+        self.assertEqual(
+            self.sent['auth.log'], b'sshd: Accepted publickey for ona\n'
+        )
+        signal_data = self.nodes['ona-one'].api.send_signal.call_args[0][1]
+        self.assertEqual(
+            signal_data['filter_stats'], {'matched': 1, 'dropped': 1}
+        )
+        signal_data = self.nodes['auth.log'].api.send_signal.call_args[0][1]
+        self.assertNotIn('filter_stats', signal_data)
+
+        # The counts start over after each send
+        self.assertEqual(
+            self.nodes['ona-one'].filter_stats, {'matched': 0, 'dropped': 0}
+        )
+
+    def test_update_filters(self):
+        get_data = self.watcher.api.get_data
+        self.watcher.execute(self.now)
+        get_data.assert_called_once_with('log-filters')
+
+        # The rules aren't retrieved again until it's time
+        self.watcher.execute(self.now + timedelta(seconds=599))
+        self.assertEqual(get_data.call_count, 1)
+
+        # If they can't be retrieved, the old rules stay in place
+        get_data.side_effect = requests_exceptions.HTTPError
+        self.watcher.execute(self.now + timedelta(seconds=600))
+        self.assertEqual(get_data.call_count, 2)
+        self.assertIsNotNone(self.nodes['ona-one'].line_filter)
+
+        # New rules replace the old ones
+        get_data.side_effect = None
+        get_data.return_value.json.return_value = {
+            'auth.log': {'include': ['sshd']},
+        }
+        self.watcher.execute(self.now + timedelta(seconds=1200))
+        self.assertIsNone(self.nodes['ona-one'].line_filter)
+        self.assertIsNotNone(self.nodes['auth.log'].line_filter)
+
+        # Rules that can't be built don't replace the old ones
+        line_filter = self.nodes['auth.log'].line_filter
+        get_data.return_value.json.return_value = {
+            '*': {'exclude': ['(?P<x>a)', '(?P<x>b)']},
+        }
+        self.watcher.execute(self.now + timedelta(seconds=1800))
+        self.assertIsNone(self.nodes['ona-one'].line_filter)
+        self.assertIs(self.nodes['auth.log'].line_filter, line_filter)
+        self.assertEqual(self.watcher.filter_rules, {
+            'auth.log': {'include': ['sshd']},
+        })
+
+    def test_disabled(self):
+        with patch.dict(
+            'ona_service.log_watcher.environ',
+            {
+                'OBSRVBL_LOG_WATCHER_FILTER': 'false',
+                'OBSRVBL_LOG_WATCHER_STATE_FILE': join(
+                    self.temp_dir.name, 'state'
+                ),
+            },
+        ):
+            watcher = LogWatcher(logs={})
+        watcher.api = MagicMock()
+        watcher.execute(self.now)
+        self.assertEqual(watcher.api.get_data.call_count, 0)
+
+
 class WatchNodeTestCase(TestCase):
     def setUp(self):
         self.mock_api = MagicMock()
@@ -284,6 +884,34 @@ class WatchNodeTestCase(TestCase):
             with gzip.open(file_path, 'rb') as infile:
                 self.assertEqual(infile.read(), b''.join(self.test_data))
 
+        self.assertEqual(self.inst.compression_stats['raw_bytes'], 14)
+
+    def test_write_compressed(self):
+        lines = [b'Here is a line\n'] * 100
+        fileobj = BytesIO()
+        stats = write_compressed(lines, fileobj, 1)
+
+        # One gzip member for all of the lines
+        self.assertEqual(
+            gzip.decompress(fileobj.getvalue()), b''.join(lines)
+        )
+        self.assertEqual(fileobj.getvalue().count(b'\x1f\x8b'), 1)
+
+        self.assertEqual(stats['raw_bytes'], 1500)
+        self.assertEqual(stats['compressed_bytes'], len(fileobj.getvalue()))
+        self.assertGreater(stats['ratio'], 10)
+        self.assertGreaterEqual(stats['seconds'], 0)
+
+    @patch.dict(
+        'ona_service.log_watcher.environ',
+        {'OBSRVBL_LOG_WATCHER_COMPRESS_LEVEL': '1'},
+    )
+    def test_compresslevel(self):
+        self.assertEqual(WatchNode('test_type', None).compresslevel, 1)
+        self.assertEqual(
+            WatchNode('test_type', None, compresslevel=9).compresslevel, 9
+        )
+
     def test_flush_data_uncompressed(self):
         patch_src = 'ona_service.log_watcher.NamedTemporaryFile'
         with patch(patch_src, self.fixed_temp_file):
@@ -308,3 +936,122 @@ class WatchNodeTestCase(TestCase):
         # Data is present, enough time has passed -> one call
         self.inst.flush_data(self.test_data, self.later)
         self.assertEqual(self.mock_api.send_signal.call_count, 1)
+
+    def _spill_node(self, **kwargs):
+        kwargs.setdefault('max_memory', 10)
+        kwargs.setdefault('max_disk', 1024)
+        inst = WatchNode(
+            'test_type',
+            self.mock_api,
+            timedelta(seconds=1),
+            spill_dir=self.temp_dir.name,
+            **kwargs
+        )
+        inst.last_send = self.now
+        return inst
+
+    def test_spill(self):
+        inst = self._spill_node()
+        spill_dir = join(self.temp_dir.name, 'test_type')
+
+        # Under the limit - kept in memory
+        inst.flush_data([b'line_1\n'], self.now)
+        self.assertEqual(inst.data, [b'line_1\n'])
+        self.assertEqual(len(inst.segments), 0)
+
+        # Over the limit - spilled to disk
+        inst.flush_data([b'line_2\n'], self.now)
+        self.assertEqual(inst.data, [])
+        self.assertEqual(len(listdir(spill_dir)), 1)
+        with gzip.open(inst.segments[0]) as infile:
+            self.assertEqual(infile.read(), b'line_1\nline_2\n')
+
+        # A new node picks up the spilled data
+        self.assertEqual(len(self._spill_node().segments), 1)
+
+    def test_spill_budget(self):
+        inst = self._spill_node(max_disk=100)
+        for i in range(10):
+            inst.flush_data([b'line_' + str(i).encode('ascii')] * 2, self.now)
+
+        # The oldest segments were dropped
+        self.assertLessEqual(
+            sum(len(open(x, 'rb').read()) for x in inst.segments), 100
+        )
+        with gzip.open(inst.segments[-1]) as infile:
+            self.assertEqual(infile.read(), b'line_9line_9')
+
+    def test_spill_drain(self):
+        inst = self._spill_node()
+        sent = []
+
+        def send_file(data_type, path, now, suffix=None):
+            with gzip.open(path) as infile:
+                sent.append(infile.read())
+            return path
+
+        # Sending fails - everything is kept
+        self.mock_api.send_file.side_effect = (
+            requests_exceptions.ConnectionError
+        )
+        inst.flush_data([b'line_1\n', b'line_2\n'], self.later)
+        inst.flush_data([b'line_3\n'], self.later)
+        self.assertEqual(len(inst.segments), 1)
+        self.assertEqual(inst.data, [b'line_3\n'])
+        self.assertEqual(inst.last_send, self.later)
+
+        # Sending works again - oldest data goes first
+        self.mock_api.send_file.side_effect = send_file
+        inst.flush_data([], self.later + timedelta(seconds=1), compress=True)
+        self.assertEqual(sent, [b'line_1\nline_2\n', b'line_3\n'])
+        self.assertEqual(len(inst.segments), 0)
+        self.assertEqual(listdir(join(self.temp_dir.name, 'test_type')), [])
+        self.assertEqual(inst.data, [])
+
+    def test_flush_triggers(self):
+        inst = WatchNode(
+            'test_type',
+            self.mock_api,
+            timedelta(seconds=60),
+            flush_bytes=20,
+            flush_lines=3,
+        )
+        inst.last_send = self.now
+
+        # Not enough data, not enough time
+        inst.flush_data([b'line_1\n'], self.later)
+        self.assertEqual(self.mock_api.send_file.call_count, 0)
+
+        # Enough bytes
+        inst.flush_data([b'line_2\n', b'line_3\n'], self.later)
+        self.assertEqual(self.mock_api.send_file.call_count, 1)
+
+        # Enough lines
+        inst.flush_data([b'1\n', b'2\n', b'3\n'], self.later)
+        self.assertEqual(self.mock_api.send_file.call_count, 2)
+
+        # After a failure, wait for the interval
+        self.mock_api.send_file.side_effect = (
+            requests_exceptions.ConnectionError
+        )
+        inst.flush_data([b'1\n', b'2\n', b'3\n'], self.later)
+        self.assertEqual(self.mock_api.send_file.call_count, 3)
+        inst.flush_data([b'4\n'], self.later)
+        self.assertEqual(self.mock_api.send_file.call_count, 3)
+
+    @patch('ona_service.log_watcher.TARGET_SEND_BYTES', 1000)
+    def test_adaptive(self):
+        inst = WatchNode(
+            'test_type', self.mock_api, timedelta(seconds=60), adaptive=True
+        )
+        inst.last_send = self.now
+
+        # Quiet log - the interval stretches, up to the limit
+        inst.flush_data([b'x' * 10], self.now + timedelta(seconds=60))
+        self.assertEqual(inst.send_delta, timedelta(seconds=600))
+
+        # Busy log - the interval shrinks, down to the limit
+        inst.flush_data([b'x' * 20000], self.now + timedelta(seconds=660))
+        self.assertEqual(inst.send_delta, timedelta(seconds=30))
+        inst.flush_data([b'x' * 100000], self.now + timedelta(seconds=690))
+        self.assertEqual(inst.send_delta, timedelta(seconds=10))
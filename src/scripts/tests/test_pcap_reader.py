@@ -0,0 +1,158 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+
+from os.path import join
+from struct import pack
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ona_service.pcap_reader import (
+    iter_packets,
+    iter_udp,
+    LINKTYPE_ETHERNET,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_RAW,
+    UdpPacket,
+)
+
+
+def make_ip_udp(src, dst, sport, dport, payload, protocol=17):
+    """
+    Returns an IPv4 or IPv6 packet (depending on the addresses) with a UDP
+    header and `payload`.
+    """
+    udp = pack('!HHHH', sport, dport, len(payload) + 8, 0) + payload
+    if ':' not in src:
+        return pack(
+            '!BBHHHBBH4s4s',
+            0x45, 0, len(udp) + 20, 0, 0, 64, protocol, 0,
+            socket.inet_aton(src), socket.inet_aton(dst)
+        ) + udp
+    return pack(
+        '!IHBB16s16s',
+        0x60000000, len(udp), protocol, 64,
+        socket.inet_pton(socket.AF_INET6, src),
+        socket.inet_pton(socket.AF_INET6, dst),
+    ) + udp
+
+
+def make_ethernet(packet, vlan=None):
+    ethertype = 0x86dd if (packet[0] >> 4 == 6) else 0x0800
+    header = b'\x00' * 12
+    if vlan is not None:
+        header += pack('!HH', 0x8100, vlan)
+    return header + pack('!H', ethertype) + packet
+
+
+def make_pcap(frames, linktype=LINKTYPE_ETHERNET, endian='<', nano=False):
+    """
+    Returns a pcap file with `frames`, a list of (timestamp, frame) tuples.
+    """
+    magic = 0xa1b23c4d if nano else 0xa1b2c3d4
+    ret = [pack(endian + 'IHHiIII', magic, 2, 4, 0, 0, 65535, linktype)]
+    for ts, frame in frames:
+        frac = round((ts % 1) * (1e9 if nano else 1e6))
+        ret.append(
+            pack(endian + 'IIII', int(ts), frac, len(frame), len(frame))
+        )
+        ret.append(frame)
+    return b''.join(ret)
+
+
+class PcapReaderTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.file_path = join(self.temp_dir.name, 'test.pcap')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write(self, data):
+        with open(self.file_path, 'wb') as outfile:
+            outfile.write(data)
+
+    def _read_udp(self):
+        return [
+            x._replace(payload=bytes(x.payload))
+            for x in iter_udp(self.file_path)
+        ]
+
+    def test_iter_udp(self):
+        v4 = make_ip_udp('192.0.2.1', '192.0.2.2', 53, 1024, b'four')
+        v6 = make_ip_udp('2001:db8::1', '2001:db8::2', 53, 1024, b'six')
+        tcp = make_ip_udp('192.0.2.1', '192.0.2.2', 53, 1024, b'x', 6)
+        self._write(
+            make_pcap(
+                [
+                    (1.5, make_ethernet(v4)),
+                    (2.25, make_ethernet(v6, vlan=100)),
+                    (3.0, make_ethernet(tcp)),
+                    # Truncated in the UDP header
+                    (4.0, make_ethernet(v4)[:40]),
+                    # Not IP
+                    (5.0, b'\x00' * 12 + pack('!H', 0x0806) + v4),
+                ]
+            )
+        )
+        self.assertEqual(
+            self._read_udp(),
+            [
+                UdpPacket(
+                    1.5, socket.inet_aton('192.0.2.1'),
+                    socket.inet_aton('192.0.2.2'), 53, 1024, b'four'
+                ),
+                UdpPacket(
+                    2.25,
+                    socket.inet_pton(socket.AF_INET6, '2001:db8::1'),
+                    socket.inet_pton(socket.AF_INET6, '2001:db8::2'),
+                    53, 1024, b'six'
+                ),
+            ],
+        )
+
+    def test_link_types(self):
+        packet = make_ip_udp('192.0.2.1', '192.0.2.2', 53, 1024, b'data')
+        for linktype, frame in [
+            (LINKTYPE_RAW, packet),
+            (LINKTYPE_LINUX_SLL, b'\x00' * 14 + pack('!H', 0x0800) + packet),
+            (147, packet),
+        ]:
+            self._write(make_pcap([(1.0, frame)], linktype=linktype))
+            actual = [x.payload for x in self._read_udp()]
+            expected = [b'data'] if (linktype != 147) else []
+            self.assertEqual(actual, expected)
+
+    def test_iter_packets(self):
+        # Big-endian files with nanosecond timestamps
+        self._write(
+            make_pcap(
+                [(1.25, b'one'), (2.5, b'two')], endian='>', nano=True
+            )[:-1]
+        )
+        actual = [
+            (ts, linktype, bytes(frame))
+            for ts, linktype, frame in iter_packets(self.file_path)
+        ]
+        # The truncated packet at the end is skipped
+        self.assertEqual(actual, [(1.25, LINKTYPE_ETHERNET, b'one')])
+
+        # Empty files have no packets
+        self._write(b'')
+        self.assertEqual(list(iter_packets(self.file_path)), [])
+
+        # Other files are rejected
+        self._write(b'\x0a\x0d\x0d\x0a' + b'\x00' * 28)
+        with self.assertRaises(ValueError):
+            list(iter_packets(self.file_path))
@@ -11,17 +11,75 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bz2
+import gzip
+import json
+import lzma
+import socket
+
 from datetime import datetime
-from os import listdir
+from os import environ, listdir, remove
 from os.path import exists, join
 from shutil import rmtree
 from unittest import TestCase
 from unittest.mock import call, MagicMock, patch
 
-from ona_service.pdns_pusher import PdnsPusher
+from ona_service.api import requests_exceptions
+from ona_service.pdns_pusher import (
+    aggregate_records,
+    extract_records,
+    PdnsPusher,
+)
+from ona_service.tcpdump_pusher import compress_file, iter_compressed
+
+from tests.test_dns_decoder import encode_name, make_dns_response
+from tests.test_pcap_reader import make_ethernet, make_ip_udp, make_pcap
 
 PATCH_PATH = 'ona_service.pdns_pusher.{}'
 
+EXPECTED_RECORDS = [
+    {
+        'ts': 1.5,
+        'client': '192.0.2.2',
+        'resolver': '192.0.2.1',
+        'qname': 'www.example.com',
+        'qtype': 1,
+        'rcode': 0,
+        'answers': [[5, 'cdn.example.net'], [1, '192.0.2.3']],
+        'ttls': [300, 60],
+    },
+    {
+        'ts': 2.0,
+        'client': '2001:db8::2',
+        'resolver': '2001:db8::1',
+        'qname': 'nope.example.com',
+        'qtype': 28,
+        'rcode': 3,
+        'answers': [],
+        'ttls': [],
+    },
+]
+
+
+def make_dns_pcap():
+    answers = [
+        (5, 300, encode_name('cdn.example.net')),
+        (1, 60, socket.inet_aton('192.0.2.3')),
+    ]
+    response_1 = make_dns_response('www.example.com', 1, answers)
+    response_2 = make_dns_response('nope.example.com', 28, [], rcode=3)
+    query = make_dns_response('www.example.com', 1, [], flags=0x0100)
+    frames = [
+        make_ip_udp('192.0.2.2', '192.0.2.1', 1024, 53, query),
+        make_ip_udp('192.0.2.1', '192.0.2.2', 53, 1024, response_1),
+        make_ip_udp('2001:db8::1', '2001:db8::2', 53, 1024, response_2),
+        # Not DNS
+        make_ip_udp('192.0.2.1', '192.0.2.2', 53, 1024, b'junk'),
+    ]
+    return make_pcap(
+        [(ts, make_ethernet(x)) for ts, x in zip([1.0, 1.5, 2.0, 3.0], frames)]
+    )
+
 
 class PdnsPusherTestCase(TestCase):
     def setUp(self):
@@ -52,6 +110,136 @@ class PdnsPusherTestCase(TestCase):
         expected = ['pdns_1.pcap.gz', 'pdns_2.pcap.gz', 'pdns_3.pcap']
         self.assertEqual(actual, expected)
 
+    def test_compress_pcaps_codecs(self):
+        data = b'\xd4\xc3\xb2\xa1' + bytes(range(256)) * 1000
+        for codec, suffix, upload_suffix, decompress in [
+            ('gzip', '.gz', '', gzip.decompress),
+            ('bz2', '.bz2', '.bz2', bz2.decompress),
+            ('xz', '.xz', '.xz', lzma.decompress),
+        ]:
+            env = {
+                'OBSRVBL_PCAP_COMPRESS_CODEC': codec,
+                'OBSRVBL_PCAP_COMPRESS_LEVEL': '1',
+                'OBSRVBL_PCAP_COMPRESS_THREADS': '3',
+            }
+            with patch.dict(environ, env):
+                inst = PdnsPusher()
+            for n in (1, 2, 3, 4):
+                file_path = join(inst.pcap_dir, 'pdns_{}.pcap'.format(n))
+                with open(file_path, 'wb') as outfile:
+                    outfile.write(data)
+
+            inst.compress_pcaps()
+            actual = sorted(listdir(inst.pcap_dir))
+            expected = ['pdns_{}.pcap{}'.format(n, suffix) for n in (1, 2, 3)]
+            expected.append('pdns_4.pcap')
+            self.assertEqual(actual, expected)
+            for file_name in expected[:-1]:
+                with open(join(inst.pcap_dir, file_name), 'rb') as infile:
+                    self.assertEqual(decompress(infile.read()), data)
+
+            # Only files for the codec are pushed, and the uploads are named
+            # for the codec
+            inst.api.send_file = MagicMock()
+            inst.push_files(datetime(2015, 3, 10, 16, 39, 56))
+            self.assertEqual(inst.api.send_file.call_count, 3)
+            for i, call_args in enumerate(inst.api.send_file.call_args_list):
+                self.assertEqual(
+                    call_args[1]['suffix'], '{:04}{}'.format(i, upload_suffix)
+                )
+            self.assertEqual(listdir(inst.pcap_dir), ['pdns_4.pcap'])
+            remove(join(inst.pcap_dir, 'pdns_4.pcap'))
+
+    def test_compress_file_gzip(self):
+        # The original name is kept in the header, like with gzip(1)
+        file_path = join(self.inst.pcap_dir, 'pdns_1.pcap')
+        with open(file_path, 'wb') as outfile:
+            outfile.write(b'pcap')
+        self.assertEqual(compress_file(file_path), file_path + '.gz')
+        with open(file_path + '.gz', 'rb') as infile:
+            data = infile.read()
+        self.assertEqual(data[10:22], b'pdns_1.pcap\0')
+        self.assertEqual(gzip.decompress(data), b'pcap')
+
+    @patch('ona_service.tcpdump_pusher.copyfileobj', autospec=True)
+    def test_compress_pcaps_error(self, mock_copyfileobj):
+        mock_copyfileobj.side_effect = OSError('No space left on device')
+
+        # Leftovers from an interrupted run are removed
+        for file_name in ('pdns_0.pcap.gz.tmp', 'pdns_1.pcap', 'pdns_2.pcap'):
+            with open(join(self.inst.pcap_dir, file_name), 'wb'):
+                pass
+
+        # Partial files are cleaned up, and the original is kept
+        self.inst.compress_pcaps()
+        actual = sorted(listdir(self.inst.pcap_dir))
+        self.assertEqual(actual, ['pdns_1.pcap', 'pdns_2.pcap'])
+
+    def test_iter_compressed(self):
+        file_path = join(self.inst.pcap_dir, 'pdns_1.pcap')
+        data = bytes(range(256)) * 10000
+        with open(file_path, 'wb') as outfile:
+            outfile.write(data)
+
+        for codec, decompress in [
+            ('gzip', gzip.decompress),
+            ('bz2', bz2.decompress),
+            ('xz', lzma.decompress),
+        ]:
+            with patch(
+                'ona_service.tcpdump_pusher.COPY_BUFSIZE', 100000
+            ):
+                chunks = list(iter_compressed(file_path, codec, 1))
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(decompress(b''.join(chunks)), data)
+
+            # The output can be generated again to the same length
+            again = iter_compressed(file_path, codec, 1)
+            self.assertEqual(b''.join(again), b''.join(chunks))
+
+        # Nothing is written to disk
+        self.assertEqual(listdir(self.inst.pcap_dir), ['pdns_1.pcap'])
+
+    def test_push_files_stream(self):
+        with patch.dict(environ, {'OBSRVBL_PCAP_STREAM_UPLOAD': 'true'}):
+            self.inst = PdnsPusher()
+
+        for file_name in ('pdns_0.pcap.gz', 'pdns_1.pcap', 'pdns_2.pcap'):
+            with open(join(self.inst.pcap_dir, file_name), 'wb') as outfile:
+                outfile.write(file_name.encode())
+
+        # Uploads that fail are tried again next time
+        self.inst.api.send_file = MagicMock()
+        self.inst.api.send_stream = MagicMock()
+        self.inst.api.send_stream.side_effect = (
+            requests_exceptions.RequestException()
+        )
+        now = datetime(2015, 3, 10, 16, 39, 56, 1020)
+        with self.assertRaises(requests_exceptions.RequestException):
+            self.inst.execute(now)
+        actual = sorted(listdir(self.inst.pcap_dir))
+        self.assertEqual(actual, ['pdns_1.pcap', 'pdns_2.pcap'])
+
+        # Finished files are compressed into the upload, and removed after
+        sent = []
+
+        def send_stream(data_type, get_data, now, suffix=None):
+            sent.append((suffix, gzip.decompress(b''.join(get_data()))))
+            return 'remote_path!'
+
+        self.inst.api.send_stream.side_effect = send_stream
+        self.assertEqual(self.inst.execute(now), ['remote_path!'])
+        self.assertEqual(sent, [('0000', b'pdns_1.pcap')])
+        self.assertEqual(listdir(self.inst.pcap_dir), ['pdns_2.pcap'])
+        self.assertEqual(self.inst.api.send_file.call_count, 1)
+
+    def test_run(self):
+        # The compression threads are shut down when the service stops
+        self.inst.stop()
+        self.inst.run()
+        with self.assertRaises(RuntimeError):
+            self.inst.executor.submit(print)
+
     def test_push_files(self):
         # Touch some pcap.gz files
         for n in (1, 2):
@@ -88,3 +276,190 @@ class PdnsPusherTestCase(TestCase):
         self.inst.execute()
         self.assertEqual(mock_compress.call_count, 1)
         self.assertEqual(mock_push.call_count, 1)
+
+    def _write_dns_pcaps(self, inst):
+        for n in (1, 2, 3):
+            file_path = join(inst.pcap_dir, 'pdns_{}.pcap'.format(n))
+            with open(file_path, 'wb') as outfile:
+                outfile.write(make_dns_pcap())
+
+    def test_extract_records(self):
+        file_path = join(self.inst.pcap_dir, 'pdns_1.pcap')
+        with open(file_path, 'wb') as outfile:
+            outfile.write(make_dns_pcap())
+        self.assertEqual(list(extract_records(file_path)), EXPECTED_RECORDS)
+
+    def _execute_records(self, env):
+        with patch.dict(environ, env):
+            inst = PdnsPusher()
+        self._write_dns_pcaps(inst)
+
+        sent = {}
+
+        def send_file(data_type, path, now, suffix=None):
+            with gzip.open(path, 'rb') as infile:
+                sent[(data_type, suffix)] = infile.read()
+            return 'remote_path_{}'.format(len(sent))
+
+        inst.api.send_file = MagicMock(side_effect=send_file)
+        inst.api.send_signal = MagicMock()
+        now = datetime(2015, 3, 10, 16, 39, 56, 1020)
+        ret = inst.execute(now)
+        return inst, ret, sent
+
+    def test_execute_jsonl(self):
+        env = {'OBSRVBL_PDNS_FORMAT': 'jsonl'}
+        inst, ret, sent = self._execute_records(env)
+
+        # The finished pcaps are replaced by their records
+        self.assertEqual(ret, ['remote_path_1', 'remote_path_2'])
+        self.assertEqual(sorted(sent), [('logs', '0000'), ('logs', '0001')])
+        for data in sent.values():
+            actual = [json.loads(x) for x in data.decode().splitlines()]
+            self.assertEqual(actual, EXPECTED_RECORDS)
+        self.assertEqual(listdir(inst.pcap_dir), ['pdns_3.pcap'])
+
+        inst.api.send_signal.assert_has_calls(
+            [
+                call(
+                    'logs',
+                    data={'path': 'remote_path_1', 'log_type': 'pdns-jsonl'},
+                ),
+                call(
+                    'logs',
+                    data={'path': 'remote_path_2', 'log_type': 'pdns-jsonl'},
+                ),
+            ]
+        )
+
+    def test_execute_columnar(self):
+        env = {
+            'OBSRVBL_PDNS_FORMAT': 'columnar',
+            'OBSRVBL_PDNS_KEEP_PCAP': 'true',
+        }
+        inst, ret, sent = self._execute_records(env)
+
+        # The pcaps are uploaded after the records
+        self.assertEqual(len(ret), 4)
+        self.assertEqual(
+            sorted(sent),
+            [('logs', '0000'), ('logs', '0001'),
+             ('pdns', '0000'), ('pdns', '0001')],
+        )
+        actual = json.loads(sent[('logs', '0000')])
+        for field in ('qname', 'ttls'):
+            expected = [x[field] for x in EXPECTED_RECORDS]
+            self.assertEqual(actual[field], expected)
+        self.assertEqual(sent[('pdns', '0000')], make_dns_pcap())
+        self.assertEqual(listdir(inst.pcap_dir), ['pdns_3.pcap'])
+
+    def test_execute_stream_keep(self):
+        env = {
+            'OBSRVBL_PDNS_FORMAT': 'jsonl',
+            'OBSRVBL_PDNS_KEEP_PCAP': 'true',
+            'OBSRVBL_PCAP_STREAM_UPLOAD': 'true',
+        }
+        streamed = []
+
+        def send_stream(data_type, get_data, now, suffix=None):
+            # Nothing has been compressed to disk
+            for file_name in listdir(self.inst.pcap_dir):
+                self.assertFalse(file_name.endswith('.gz'))
+            streamed.append(gzip.decompress(b''.join(get_data())))
+            return 'remote_path!'
+
+        with patch(
+            'ona_service.api.Api.send_stream', side_effect=send_stream
+        ):
+            inst, ret, sent = self._execute_records(env)
+        self.inst = inst
+
+        # The kept pcaps are compressed as they're sent
+        self.assertEqual(sorted(sent), [('logs', '0000'), ('logs', '0001')])
+        self.assertEqual(streamed, [make_dns_pcap()] * 2)
+        self.assertEqual(ret[2:], ['remote_path!'] * 2)
+        self.assertEqual(listdir(inst.pcap_dir), ['pdns_3.pcap'])
+
+    def test_execute_extract_error(self):
+        with patch.dict(environ, {'OBSRVBL_PDNS_FORMAT': 'jsonl'}):
+            self.inst = PdnsPusher()
+        for file_name in ('pdns_1.pcap', 'pdns_2.pcap'):
+            with open(join(self.inst.pcap_dir, file_name), 'wb') as outfile:
+                outfile.write(b'bogus' * 10)
+        self.inst.api.send_file = MagicMock()
+        self.inst.api.send_signal = MagicMock()
+
+        # Pcaps that can't be read are removed rather than tried again
+        self.assertEqual(self.inst.execute(), [])
+        self.assertEqual(listdir(self.inst.pcap_dir), ['pdns_2.pcap'])
+        self.assertEqual(self.inst.api.send_file.call_count, 0)
+
+    def test_aggregate_records(self):
+        def record(ts, qname, answers, ttls, rcode=0):
+            return {
+                'ts': ts,
+                'client': '192.0.2.2',
+                'resolver': '192.0.2.1',
+                'qname': qname,
+                'qtype': 1,
+                'rcode': rcode,
+                'answers': answers,
+                'ttls': ttls,
+            }
+
+        records = [
+            record(10.0, 'a.example', [[1, '192.0.2.3']], [60]),
+            record(5.0, 'a.example', [[1, '192.0.2.3']], [30]),
+            record(
+                20.0, 'a.example', [[1, '192.0.2.3'], [1, '192.0.2.4']],
+                [45, 45]
+            ),
+            record(30.0, 'b.example', [], [], rcode=3),
+            record(40.0, 'b.example', [], [], rcode=3),
+            # Next window
+            record(60.0, 'a.example', [[1, '192.0.2.3']], [60]),
+        ]
+        actual = [
+            (
+                x['window'], x['qname'], x['rcode'], x['rtype'], x['data'],
+                x['first_seen'], x['last_seen'], x['count'],
+                x['min_ttl'], x['max_ttl'],
+            )
+            for x in aggregate_records(records, 60)
+        ]
+        expected = [
+            (0, 'a.example', 0, 1, '192.0.2.3', 5.0, 20.0, 3, 30, 60),
+            (0, 'a.example', 0, 1, '192.0.2.4', 20.0, 20.0, 1, 45, 45),
+            (0, 'b.example', 3, None, None, 30.0, 40.0, 2, None, None),
+            (60, 'a.example', 0, 1, '192.0.2.3', 60.0, 60.0, 1, 60, 60),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_execute_aggregate(self):
+        env = {
+            'OBSRVBL_PDNS_FORMAT': 'aggregate',
+            'OBSRVBL_PDNS_WINDOW_SECONDS': '1',
+        }
+        inst, ret, sent = self._execute_records(env)
+
+        self.assertEqual(ret, ['remote_path_1', 'remote_path_2'])
+        actual = [
+            json.loads(x) for x in sent[('logs', '0000')].decode().split()
+        ]
+        self.assertEqual(
+            [(x['window'], x['qname'], x['data'], x['count']) for x in actual],
+            [
+                (1, 'www.example.com', 'cdn.example.net', 1),
+                (1, 'www.example.com', '192.0.2.3', 1),
+                (2, 'nope.example.com', None, 1),
+            ],
+        )
+        self.assertEqual(
+            inst.api.send_signal.call_args[1]['data']['log_type'],
+            'pdns-aggregate',
+        )
+
+    def test_execute_unknown_format(self):
+        with patch.dict(environ, {'OBSRVBL_PDNS_FORMAT': 'parquet'}):
+            inst = PdnsPusher()
+        self.assertEqual(inst.pdns_format, 'pcap')
@@ -15,14 +15,35 @@ import gzip
 
 from datetime import datetime
 from os import environ
-from os.path import join
+from os.path import exists, join
 from tempfile import TemporaryDirectory
+from threading import Thread
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
-from ona_service.syslog_ad_watcher import SyslogADWatcher
+from ona_service.benchmarks.syslog_ad import (
+    generate_ad_lines,
+    parse_compiled,
+    parse_legacy,
+    process_multiline,
+    process_oneline,
+)
+from ona_service.syslog_ad_watcher import (
+    ADEventParser,
+    event_key,
+    format_events,
+    get_interesting_events,
+    parse_multiline,
+    parse_oneline,
+    ShardedADEventParser,
+    ShardedADLogNode,
+    SyslogADWatcher,
+)
+from ona_service.api import requests_exceptions
 from ona_service.utils import utc
 
+PATCH_PATH = 'ona_service.syslog_ad_watcher.{}'
+
 LOG_DATA_MULTILINE = (
     'obsrvbl_remote-ad|2016-05-21 06:49| May 21 06:49:34 2016\t4624\t'
     'Microsoft-Windows-Security-Auditing\t\tN/A\tAudit Success\t'
@@ -92,6 +113,18 @@ def _append_file(file_path, data):
         outfile.write(data.encode())
 
 
+def _received_messages():
+    # Returns (received time, messages) as the listener would queue them
+    multiline = LOG_DATA_MULTILINE.split('|', 2)[2].encode('cp1252')
+    oneline = LOG_DATA_ONELINE.split('|', 2)[2].encode('cp1252')
+    messages = [
+        b'<13>May 21 06:49:34 DC1 MSWinEventLog:' + multiline,
+        b'<13>1 2016-05-21T06:49:34Z DC1 - - - - ' + oneline[1:],
+        b'<13>May 21 06:49:34 DC1 MSWinEventLog:Bogus',
+    ]
+    return datetime(2016, 5, 21, 6, 49).timestamp(), messages
+
+
 class SyslogADWatcherTestCase(TestCase):
     def setUp(self):
         self.temp_dir = TemporaryDirectory()
@@ -132,7 +165,7 @@ class SyslogADWatcherTestCase(TestCase):
         ]
         self.assertEqual(actual, expected)
         self.assertEqual(self.inst.api.send_file.call_count, 1)
-        self.assertEqual(self.inst.log_node.parsed_data, [])
+        self.assertEqual(self.inst.row_count, 1)
 
         # No additional calls if there were no additional writes
         index = 1
@@ -175,8 +208,411 @@ class SyslogADWatcherTestCase(TestCase):
         ]
         self.assertEqual(actual, expected)
         self.assertEqual(self.inst.api.send_file.call_count, 1)
-        self.assertEqual(self.inst.log_node.parsed_data, [])
+        self.assertEqual(self.inst.row_count, 1)
 
         # No additional calls if there were no additional writes
         self.inst.execute(now=self.now)
         self.assertEqual(self.inst.api.send_file.call_count, 1)
+
+    def test_execute_retry(self):
+        sent = []
+
+        def send_file(data_type, path, now, suffix=None):
+            with gzip.open(path, 'rt') as infile:
+                sent.append((infile.read().splitlines(), suffix))
+            return 'remote_path_{}'.format(len(sent))
+
+        # The upload fails, so its events are kept
+        self.inst.api.send_file.side_effect = (
+            requests_exceptions.RequestException()
+        )
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        with self.assertRaises(requests_exceptions.RequestException):
+            self.inst.execute(now=self.now)
+        file_path = self.inst.pending[0]
+        self.assertTrue(exists(file_path))
+
+        # They're sent on the next tick, before anything new is read
+        self.inst.api.send_file.side_effect = send_file
+        _append_file(
+            self.log_path, LOG_DATA_ONELINE.replace('Account242', 'Other')
+        )
+        later = datetime(2016, 5, 21, 13, 10, 30, tzinfo=utc)
+        self.inst.execute(now=later)
+        header = '_time,Computer,TargetUserName,EventCode,ComputerAddress'
+        self.assertEqual(
+            sent,
+            [
+                (
+                    [
+                        header,
+                        '1482256140,wk242.obsrvbl.local,Account242,4624,'
+                        '192.0.2.2',
+                    ],
+                    '0570',
+                ),
+                (
+                    [
+                        header,
+                        '1482256140,wk242.obsrvbl.local,Other,4624,192.0.2.2',
+                    ],
+                    '0630',
+                ),
+            ],
+        )
+        self.assertIsNone(self.inst.pending)
+        self.assertFalse(exists(file_path))
+        self.assertEqual(self.inst.api.send_signal.call_count, 2)
+
+    def test_execute_other_events(self):
+        # Other types of events are skipped, and nothing is sent
+        _append_file(
+            self.log_path,
+            LOG_DATA_ONELINE.replace(',4624,', ',4625,') +
+            LOG_DATA_MULTILINE.replace('\t4624\t', '\t4634\t') +
+            LOG_DATA_MULTILINE.replace('\t4624\t', '\t4634\t')
+        )
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 0)
+        self.assertEqual(self.inst.api.send_file.call_count, 0)
+
+    def test_event_key(self):
+        row = (1482256140, 'wk242.obsrvbl.local', 'Account242', '4624', '')
+        self.assertEqual(event_key(row), event_key(row))
+        self.assertNotEqual(event_key(row), event_key(row[:-1] + ('-',)))
+        self.assertLess(event_key(row), 2 ** 64)
+
+    def test_execute_dedup(self):
+        dedup_path = join(self.temp_dir.name, 'dedup')
+        dedup_env = {
+            'OBSRVBL_SYSLOG_AD_DEDUP_SECONDS': '3600',
+            'OBSRVBL_SYSLOG_AD_DEDUP_FILE': dedup_path,
+        }
+        with patch.dict(environ, dedup_env):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.api = MagicMock()
+
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 1)
+        self.assertEqual(self.inst.api.send_file.call_count, 1)
+
+        # The same event on a later tick is suppressed
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 0)
+        self.assertEqual(self.inst.api.send_file.call_count, 1)
+        self.assertEqual(self.inst.dedup_cache.hits, 1)
+
+        # ...even after a restart
+        with patch.dict(environ, dedup_env):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.api = MagicMock()
+        self.assertEqual(len(self.inst.dedup_cache), 1)
+
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 0)
+
+        # The event is let through again once the window has passed
+        later = LOG_DATA_ONELINE.replace('12-20 12:49', '12-20 13:49')
+        _append_file(self.log_path, later)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 1)
+
+    def test_execute_dedup_retry(self):
+        dedup_path = join(self.temp_dir.name, 'dedup')
+        dedup_env = {
+            'OBSRVBL_SYSLOG_AD_DEDUP_SECONDS': '3600',
+            'OBSRVBL_SYSLOG_AD_DEDUP_FILE': dedup_path,
+        }
+        with patch.dict(environ, dedup_env):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.api = MagicMock()
+
+        # Events from a failed upload aren't remembered yet
+        self.inst.api.send_file.side_effect = (
+            requests_exceptions.RequestException()
+        )
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        with self.assertRaises(requests_exceptions.RequestException):
+            self.inst.execute(now=self.now)
+        self.assertEqual(len(self.inst.dedup_cache), 0)
+        self.assertFalse(exists(dedup_path))
+
+        # Once the upload succeeds they are, and they're saved
+        self.inst.api.send_file.side_effect = None
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.api.send_file.call_count, 2)
+        self.assertEqual(len(self.inst.dedup_cache), 1)
+        self.assertTrue(exists(dedup_path))
+
+        # Later repeats are suppressed
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 0)
+        self.assertEqual(self.inst.api.send_file.call_count, 2)
+
+    def test_execute_listen(self):
+        with patch.dict(environ, {'OBSRVBL_SYSLOG_AD_LISTEN': 'udp:0'}):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.api = MagicMock()
+        self.inst.utcoffset = -(5 * 60 * 60)
+
+        # Messages are parsed like the lines rsyslog would write
+        received, messages = _received_messages()
+        self.inst.receiver.queue.put(received, messages)
+        self.inst.receiver.queue.put(received, messages[:1])
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 2)
+        self.assertEqual(len(self.inst.receiver.queue), 0)
+
+        # The log isn't read
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        self.inst.execute(now=self.now)
+        self.assertEqual(self.inst.row_count, 0)
+
+    def test_run_listen(self):
+        with patch.dict(environ, {'OBSRVBL_SYSLOG_AD_LISTEN': 'udp:0'}):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.receiver = MagicMock()
+        self.inst.stop()
+        self.inst.run()
+        self.inst.receiver.start.assert_called_once_with()
+        self.inst.receiver.stop.assert_called_once_with()
+
+    def _run_received(self, env):
+        # Runs the service until its first upload, which stops it
+        env['OBSRVBL_SYSLOG_AD_LISTEN'] = 'udp:0'
+        with patch.dict(environ, env):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.receiver.start = MagicMock()
+        self.inst.api = MagicMock()
+        self.inst.api.send_file.side_effect = lambda *a, **kw: self.inst.stop()
+
+        received, messages = _received_messages()
+        self.inst.receiver.queue.put(received, messages)
+        thread = Thread(target=self.inst.run)
+        with patch(PATCH_PATH.format('MIN_FLUSH_SECONDS'), 0.01):
+            thread.start()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.inst.api.send_file.call_count, 1)
+        self.assertEqual(len(self.inst.receiver.queue), 0)
+
+    def test_run_received_messages(self):
+        # Enough messages are sent right away
+        self._run_received(
+            {
+                'OBSRVBL_SYSLOG_AD_FLUSH_MESSAGES': '3',
+                'OBSRVBL_SYSLOG_AD_FLUSH_SECONDS': '60',
+            }
+        )
+
+    def test_run_received_seconds(self):
+        # Fewer are sent once they've waited long enough
+        self._run_received(
+            {
+                'OBSRVBL_SYSLOG_AD_FLUSH_MESSAGES': '1000',
+                'OBSRVBL_SYSLOG_AD_FLUSH_SECONDS': '0.1',
+            }
+        )
+
+    def test_execute_workers(self):
+        with patch.dict(environ, {'OBSRVBL_SYSLOG_AD_WORKERS': '2'}):
+            self.inst = SyslogADWatcher(log_path=self.log_path)
+        self.inst.api = MagicMock()
+        self.inst.utcoffset = -(5 * 60 * 60)
+        self.assertIsInstance(self.inst.log_node, ShardedADLogNode)
+
+        # Split every batch into small chunks
+        self.inst.log_node.sharded_parser.chunk_lines = 10
+        for __ in range(3):
+            _append_file(self.log_path, LOG_DATA_MULTILINE)
+        _append_file(self.log_path, LOG_DATA_ONELINE)
+        _append_file(
+            self.log_path, LOG_DATA_MULTILINE.replace('ACCOUNT241', 'USER2')
+        )
+        try:
+            self.inst.execute(now=self.now)
+            self.assertEqual(self.inst.row_count, 2)
+
+            # The last entry is finished by the next batch
+            _append_file(self.log_path, LOG_DATA_MULTILINE)
+            self.inst.execute(now=self.now)
+            self.assertEqual(self.inst.row_count, 1)
+        finally:
+            self.inst.log_node.close()
+
+
+def _project(D):
+    # Resolves the output of the old parsers the way the formatting does
+    logon = D.get('New Logon', D)
+    network = D.get('Network Information', D)
+    ret = {'Received time': D['Received time'], 'Event Code': D['Event Code']}
+    for keys, values in (
+        (('Security ID', 'Account Name'), logon),
+        (('Workstation Name', 'Source Network Address'), network),
+    ):
+        for key in keys:
+            if key in values:
+                ret[key] = values[key]
+    return ret
+
+
+def _oneline(message, prefix='Dec 20 12:49:05 2016,4624,Logon,,'):
+    return (
+        'obsrvbl_remote-ad_oneline|2016-12-20 12:49| {}{},1045983 \n'
+    ).format(prefix, message).encode('cp1252')
+
+
+class ParserEquivalenceTestCase(TestCase):
+    def assertOnelineEqual(self, line):
+        expected = process_oneline(line.decode('cp1252'))
+        self.assertEqual(parse_oneline(line), expected, line)
+
+    def assertMultilineEqual(self, text):
+        entry = text.encode('cp1252').splitlines(keepends=True)
+        expected = _project(
+            process_multiline(
+                [x.decode('cp1252').rstrip() for x in entry]
+            )
+        )
+        self.assertEqual(parse_multiline(entry), expected, text)
+
+    def test_generated(self):
+        for seed, oneline_share in ((0, 0.5), (1, 0.0), (2, 1.0)):
+            lines = generate_ad_lines(500, seed, oneline_share)
+            expected = [_project(x) for x in parse_legacy(lines)]
+            self.assertEqual(parse_compiled(lines), expected)
+
+    def test_oneline(self):
+        for line in LOG_DATA_ONELINE.encode('cp1252').splitlines(True):
+            self.assertOnelineEqual(line)
+
+        for message in [
+            # Separators of different lengths
+            'x    Account Name:  a     Security ID:  s      Workstation '
+            'Name:  w',
+            # Other whitespace around the keys and values
+            'x   \tAccount Name\xa0: \ta\x1f   Security ID :\ts\t',
+            # Empty values don't replace earlier ones
+            'Account Name:  a   Account Name:     Account Name:  -',
+            'Account Name:  a   Account Name:',
+            # Values can have colons and up to two spaces
+            'Source Network Address: fe80::1   Workstation Name:  a  b',
+            'Source Network Address: ::1    Workstation Name:  a  ',
+            # Keys that don't start an item, or don't have a colon
+            'Target Account Name:  t   x Security ID:  s   Account Name  a',
+            'Account Name:  Account Name: n   Security ID   : s',
+            # Keys that are set from the header can be replaced
+            'Event Code:  4625   Received time:  now   Event Code:',
+            'Security ID:  s   Account Name:  a   Workstation Name:  w   '
+            'Source Network Address:  n',
+        ]:
+            self.assertOnelineEqual(_oneline(message))
+
+        # Only one field after the header
+        self.assertOnelineEqual(_oneline('Account Name:  a', prefix='x,'))
+        self.assertOnelineEqual(
+            _oneline('Account Name:  a   ', prefix='Account Name:  b,')
+        )
+
+    def test_multiline(self):
+        self.assertMultilineEqual(LOG_DATA_MULTILINE)
+
+        header = (
+            'obsrvbl_remote-ad|2016-05-21 06:49| May 21 06:49:34 2016\t4624\t'
+            'Microsoft-Windows-Security-Auditing\r\n'
+        )
+        for body in [
+            # No sections: everything is at the top level
+            'Security ID:\tS-1-5-18\nAccount Name:\t\ta\n'
+            'Workstation Name:\tw\nSource Network Address:\t::1\n',
+            # Sections that repeat start over
+            'New Logon:\n\tAccount Name:\ta\nNew Logon:\n'
+            '\tSecurity ID:\ts\n',
+            # Top-level values don't end the section
+            'New Logon:\n\tAccount Name:\ta\nLogon Type:\t3\n'
+            '\tSecurity ID:\ts\n',
+            # Lines with too many or too few values are skipped
+            'New Logon:\n\tAccount Name:\ta\tb\n\tSecurity ID:\n'
+            'Network Information:\t\n\tWorkstation Name:\tw\n',
+            # Trailing whitespace, and extra colons
+            'New Logon::\xa0\r\n\tAccount Name::\t\ta \t\r\n'
+            'Network Information:\n\tSource Network Address:\t\t-\n',
+            # Header values can be replaced
+            'Event Code:\t4625\nReceived time:\tnow\n',
+            # Sections with other names are ignored
+            'Subject:\n\tAccount Name:\ts\nAccount Name:\ttop\n',
+        ]:
+            self.assertMultilineEqual(header + body)
+
+    def test_event_codes(self):
+        line = _oneline('Account Name:  a', prefix='x,4625,')
+        self.assertIsNone(parse_oneline(line, event_codes={'4624'}))
+        self.assertIsNotNone(parse_oneline(line, event_codes={'4625'}))
+
+        # The code in the message wins
+        line = _oneline('Event Code:  4624', prefix='x,4625,')
+        self.assertIsNotNone(parse_oneline(line, event_codes={'4624'}))
+
+        entry = LOG_DATA_MULTILINE.encode('cp1252').splitlines()
+        self.assertIsNone(parse_multiline(entry, event_codes={'4625'}))
+        self.assertIsNotNone(parse_multiline(entry, event_codes={'4624'}))
+        entry.append(b'Event Code:\t4625')
+        self.assertIsNotNone(parse_multiline(entry, event_codes={'4625'}))
+        self.assertIsNone(parse_multiline(entry, event_codes={'4624'}))
+
+    def test_malformed(self):
+        self.assertIsNone(parse_oneline(b'obsrvbl_remote-ad_oneline|x'))
+        self.assertIsNone(parse_oneline(b'obsrvbl_remote-ad_oneline|x|y'))
+        self.assertIsNone(parse_multiline([b'obsrvbl_remote-ad|x']))
+        self.assertIsNone(parse_multiline([b'obsrvbl_remote-ad|x|y']))
+
+
+class ShardedParserTestCase(TestCase):
+    def _parse_serial(self, batches):
+        parser = ADEventParser(event_codes={'4624'})
+        ret = []
+        for batch in batches:
+            events = get_interesting_events(parser.parse(batch))
+            ret.extend(format_events(events, 0, '.local'))
+        return ret
+
+    def _parse_sharded(self, batches, workers):
+        parser = ShardedADEventParser(
+            ADEventParser(event_codes={'4624'}), workers, chunk_lines=50
+        )
+        ret = []
+        try:
+            for batch in batches:
+                ret.extend(parser.parse(batch, 0, '.local'))
+        finally:
+            parser.close()
+        return ret
+
+    def test_equivalence(self):
+        lines = generate_ad_lines(300, seed=3, oneline_share=0.3)
+        # Start in the middle of an entry, and split batches at arbitrary
+        # lines so that entries cross them
+        lines = lines[5:]
+        batches = [lines[i:i + 997] for i in range(0, len(lines), 997)]
+        batches.insert(1, [])
+        batches.insert(2, lines[:1])
+
+        expected = self._parse_serial(batches)
+        self.assertGreater(len(expected), 100)
+        for workers in (1, 3):
+            self.assertEqual(self._parse_sharded(batches, workers), expected)
+
+    def test_split(self):
+        parser = ShardedADEventParser(None, 2, chunk_lines=10)
+        lines = [b''] * 100
+        starts = [0, 3, 35, 36, 90, 99]
+        self.assertEqual(parser._split(lines, starts), [0, 35, 90, 100])
+
+        # No more than four chunks per worker
+        parser.workers = 1
+        starts = list(range(100))
+        self.assertEqual(parser._split(lines, starts), [0, 25, 50, 75, 100])
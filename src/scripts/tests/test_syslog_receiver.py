@@ -0,0 +1,172 @@
+#  Copyright 2015 Observable Networks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+
+from threading import Timer
+from time import sleep, time
+from unittest import TestCase
+from unittest.mock import patch
+
+from ona_service.syslog_receiver import (
+    MessageQueue,
+    parse_listen_spec,
+    strip_header,
+    SyslogReceiver,
+)
+
+PATCH_PATH = 'ona_service.syslog_receiver.{}'
+
+
+def _wait_for(queue, count, timeout=5):
+    # Collects messages from `queue` until there are `count` of them
+    ret = []
+    end = time() + timeout
+    while (len(ret) < count) and (time() < end):
+        for __, messages in queue.get_all():
+            ret.extend(messages)
+        sleep(0.01)
+    return ret
+
+
+class SyslogReceiverFunctionsTestCase(TestCase):
+    def test_parse_listen_spec(self):
+        self.assertEqual(
+            parse_listen_spec('udp:514, TCP:127.0.0.1:1514'),
+            [('udp', '0.0.0.0', 514), ('tcp', '127.0.0.1', 1514)],
+        )
+        for spec in ('udp', 'sctp:514', 'udp:a:b:514', 'tcp:port'):
+            with self.assertRaises(ValueError):
+                parse_listen_spec(spec)
+
+    def test_strip_header(self):
+        for message, expected in [
+            # RFC 3164, with the tag ended by a colon or a space
+            (b'<13>May 21 06:49:34 DC1 app[12]: Hello', b' Hello'),
+            (b'<13>May  1 06:49:34 DC1 MSWinEventLog\t1 Hi', b' Hi'),
+            (b'<13>2016-05-21T06:49:34Z DC1 app: Hi', b' Hi'),
+            # No timestamp: everything after the priority
+            (b'<13>Hello there', b'Hello there'),
+            # RFC 5424, with and without structured data
+            (b'<13>1 2016-05-21T06:49:34Z DC1 app 12 ID - Hi', b'Hi'),
+            (
+                b'<13>1 2016-05-21T06:49:34Z DC1 app - - '
+                b'[a b="\\"\\]"][c d="e"] \xef\xbb\xbfHi',
+                b'Hi',
+            ),
+            (b'<13>1 2016-05-21T06:49:34Z DC1 app - -', b''),
+            # No priority
+            (b'Hello', b'Hello'),
+        ]:
+            self.assertEqual(strip_header(message), expected)
+
+    def test_message_queue(self):
+        queue = MessageQueue(3)
+        self.assertEqual(queue.put(1, [b'a', b'b']), 0)
+        self.assertTrue(queue.has_room())
+        self.assertEqual(queue.put(2, [b'c', b'd']), 1)
+        self.assertEqual(len(queue), 3)
+        self.assertFalse(queue.has_room())
+        self.assertEqual(queue.put(3, [b'e']), 1)
+
+        self.assertEqual(queue.get_all(), [(1, [b'a', b'b']), (2, [b'c'])])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.pop_dropped(), 2)
+        self.assertEqual(queue.pop_dropped(), 0)
+
+    def test_message_queue_wait(self):
+        queue = MessageQueue(3)
+        self.assertFalse(queue.wait(1, 0.01))
+
+        # Waiters are woken up by other threads' messages
+        Timer(0.01, queue.put, args=(1, [b'a', b'b'])).start()
+        self.assertTrue(queue.wait(2, 5))
+        self.assertFalse(queue.wait(3, 0.01))
+
+
+class SyslogReceiverTestCase(TestCase):
+    def setUp(self):
+        listen = [('udp', '127.0.0.1', 0), ('tcp', '127.0.0.1', 0)]
+        self.inst = SyslogReceiver(listen, 100)
+        self.inst.start()
+        self.addresses = dict(self.inst.addresses)
+
+    def tearDown(self):
+        self.inst.stop()
+
+    def test_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for i in range(3):
+                sock.sendto(
+                    '<13>Message {}\n'.format(i).encode(),
+                    self.addresses['udp'],
+                )
+        finally:
+            sock.close()
+
+        self.assertEqual(
+            _wait_for(self.inst.queue, 3),
+            [b'<13>Message 0', b'<13>Message 1', b'<13>Message 2'],
+        )
+
+    def test_tcp(self):
+        sock = socket.create_connection(self.addresses['tcp'])
+        try:
+            sock.sendall(
+                # Octet counting, with a newline inside a message
+                b'11 <13>One\nTwo'
+                b'9 <13>Three'
+                # Newline framing, with a continued message
+                b'<13>Four\r\n'
+                b'<13>Five\n'
+                b'\tSix\n'
+                b'<13>Seven\n'
+            )
+            expected = [
+                b'<13>One\nTwo',
+                b'<13>Three',
+                b'<13>Four',
+                b'<13>Five\n\tSix',
+            ]
+            self.assertEqual(_wait_for(self.inst.queue, 4), expected)
+        finally:
+            sock.close()
+
+        # The last message is finished when the connection is
+        self.assertEqual(_wait_for(self.inst.queue, 1), [b'<13>Seven'])
+
+    @patch(PATCH_PATH.format('IDLE_SECONDS'), 0.05)
+    def test_tcp_idle(self):
+        sock = socket.create_connection(self.addresses['tcp'])
+        try:
+            sock.sendall(b'<13>One\n')
+            self.assertEqual(_wait_for(self.inst.queue, 1), [b'<13>One'])
+        finally:
+            sock.close()
+
+    def test_tcp_invalid(self):
+        # Over-long frames end the connection
+        sock = socket.create_connection(self.addresses['tcp'])
+        try:
+            sock.sendall(b'<13>One\n99999999 <13>Two')
+            self.assertEqual(_wait_for(self.inst.queue, 1), [b'<13>One'])
+            self.assertEqual(sock.recv(1), b'')
+        finally:
+            sock.close()
+
+    def test_bind_error(self):
+        listen = [('udp', '127.0.0.1', self.addresses['udp'][1])]
+        inst = SyslogReceiver(listen, 100)
+        with self.assertRaises(OSError):
+            inst.start()